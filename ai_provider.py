@@ -1,140 +1,264 @@
 # ai_provider.py
 
 import os
+import time
+import threading
 
 from typing import List, Dict, Any
+import httpx
 from openai import OpenAI
 
 from logger import log_system, log_chat
 from database import db_get_recent_messages
 from config_loader import config_get  # <--- НОВЫЙ ИМПОРТ
+from token_counter import tc_count_tokens, tc_split_tokens, TC_MESSAGE_OVERHEAD_TOKENS
+from prompt_registry import pr_get_system_messages
 
 # ЗАГРУЗКА .env
 from dotenv import load_dotenv
 load_dotenv('conf/.env')
 
 # ============ ФОРМИРОВАНИЕ СООБЩЕНИЙ ============
+# Раскладка stable: история начинается с закреплённого сообщения, пока окно не перерастёт лимит.
+# Якорь общий на процесс: бот ведёт один диалог (db_get_recent_messages не делит историю по чатам),
+# при нескольких чатах якорь пришлось бы хранить по ключу чата.
+_prompt_anchor = {'message_id': None, 'skipped': frozenset()}
+_prompt_anchor_lock = threading.Lock()
+
+
+def _ai_message_tokens(content: str) -> int:
+    return tc_count_tokens(content) + TC_MESSAGE_OVERHEAD_TOKENS
+
+
+def _ai_truncate(content: str, max_tokens: int) -> str:
+    """Оставляет начало текста в пределах max_tokens токенов"""
+    parts = tc_split_tokens(content, max_tokens)
+    if len(parts) <= 1:
+        return content
+    return parts[0].rstrip() + " …[обрезано]"
+
+
+def ai_select_history(history_messages: list, user_message: str, budget: int) -> tuple:
+    """
+    Отбирает историю (строки db_get_recent_messages, от новых к старым) в бюджет токенов.
+    Текущий ход (всё после последнего сообщения пользователя, включая поиск) и
+    ai.context_protected_messages последних сообщений берутся целиком.
+    Более старые — от новых к старым, пока хватает бюджета, длинные обрезаются до
+    ai.context_message_max_tokens. Если в бюджет влезает не всё, отбор повторяется без сообщений
+    с tag_weight ниже ai.context_min_tag_weight — место отдаётся более важным старым сообщениям.
+    Возвращает (сообщения в хронологическом порядке, статистика).
+    """
+    protected_count = config_get('ai.context_protected_messages', 6)
+    max_message_tokens = config_get('ai.context_message_max_tokens', 1000)
+    min_tag_weight = config_get('ai.context_min_tag_weight', 2)
+    
+    # Сообщения текущего хода: до текущего сообщения пользователя (оно добавляется в конец отдельно)
+    turn_start = None
+    for i, msg in enumerate(history_messages):
+        if msg['author'] != "kira" and msg['message'] == user_message:
+            turn_start = i
+            break
+    protected_until = max(protected_count, turn_start + 1 if turn_start is not None else 0)
+    
+    def select(skip_weight: int) -> tuple:
+        selected = []
+        stats = {'tokens': 0, 'kept': 0, 'truncated': 0, 'dropped': 0}
+        over_budget = False
+        for i, msg in enumerate(history_messages):
+            role = "assistant" if msg['author'] == "kira" else "user"
+            content = msg['message']
+            
+            # Текущее сообщение пользователя — в конец промпта, не в историю
+            if i == turn_start:
+                continue
+            
+            if i >= protected_until:
+                tag_weight = msg.get('tag_weight')
+                if skip_weight is not None and tag_weight is not None and tag_weight < skip_weight:
+                    stats['dropped'] += 1
+                    continue
+                
+                remaining = budget - stats['tokens'] - TC_MESSAGE_OVERHEAD_TOKENS
+                limit = min(max_message_tokens, remaining)
+                if limit < 50:
+                    # Бюджет исчерпан — остальное (ещё более старое) отбрасываем
+                    stats['dropped'] += len(history_messages) - i
+                    over_budget = True
+                    break
+                
+                truncated = _ai_truncate(content, limit)
+                if truncated is not content:
+                    stats['truncated'] += 1
+                    over_budget = over_budget or limit < max_message_tokens
+                content = truncated
+            
+            tokens = _ai_message_tokens(content)
+            selected.append({"role": role, "content": content})
+            stats['tokens'] += tokens
+            stats['kept'] += 1
+        return selected, stats, over_budget
+    
+    selected, stats, over_budget = select(None)
+    if over_budget:
+        selected, stats, _ = select(min_tag_weight)
+    
+    selected.reverse()
+    return selected, stats
+
+
+def ai_select_history_stable(history_messages: list, user_message: str, limit: int, budget: int) -> tuple:
+    """
+    Раскладка stable: история (строки db_get_recent_messages, от новых к старым) берётся
+    в хронологическом порядке с закреплённого сообщения, вместе с текущим сообщением пользователя
+    и результатами поиска. Пока окно не перерастёт limit + ai.prompt_anchor_step сообщений
+    или бюджет, новые сообщения только дописываются в конец — префикс промпта не меняется
+    и попадает в кэш провайдера. При переполнении окно перезакрепляется на последних limit сообщениях;
+    если и они не влезают в бюджет, как в ai_select_history выбрасываются сообщения с tag_weight ниже
+    ai.context_min_tag_weight (их id запоминаются, чтобы не вернуться в окно на следующих ходах).
+    Длинные сообщения обрезаются до ai.context_message_max_tokens (одинаково на каждом ходу),
+    текущий ход (текущее сообщение пользователя и всё после него) — никогда.
+    Возвращает (сообщения, статистика, есть ли текущее сообщение пользователя в истории).
+    """
+    max_message_tokens = config_get('ai.context_message_max_tokens', 1000)
+    protected_count = config_get('ai.context_protected_messages', 6)
+    min_tag_weight = config_get('ai.context_min_tag_weight', 2)
+    
+    # Текущее сообщение пользователя ищется по позиции (последнее сообщение не от kira с этим текстом),
+    # а не по тексту в окне: обрезанная копия с ним бы не совпала
+    turn_start = None
+    for i, msg in enumerate(history_messages):
+        if msg['author'] != "kira" and msg['message'] == user_message:
+            turn_start = i
+            break
+    
+    rows = []
+    truncated_count = 0
+    for i, msg in enumerate(history_messages):
+        role = "assistant" if msg['author'] == "kira" else "user"
+        content = msg['message']
+        if turn_start is None or i > turn_start:
+            content = _ai_truncate(content, max_message_tokens)
+            if content is not msg['message']:
+                truncated_count += 1
+        rows.append((msg['id'], role, content, _ai_message_tokens(content)))
+    current_row = rows[turn_start] if turn_start is not None else None
+    protected_until = max(protected_count, turn_start + 1 if turn_start is not None else 0)
+    
+    with _prompt_anchor_lock:
+        anchor = _prompt_anchor['message_id']
+        skipped = _prompt_anchor['skipped']
+        window = None
+        if anchor is not None and any(row[0] == anchor for row in rows):
+            # Несохранённые строки пачки (id ещё нет) — самые новые
+            window = [row for row in rows if row[0] is None or (row[0] >= anchor and row[0] not in skipped)]
+            if sum(row[3] for row in window) > budget:
+                window = None
+        
+        if window is None:
+            candidates = rows[:max(1, limit)]
+            skipped = frozenset()
+            if sum(row[3] for row in candidates) > budget:
+                # Не влезает — место отдаётся более важным сообщениям
+                skipped = frozenset(
+                    row[0] for i, (row, msg) in enumerate(zip(candidates, history_messages))
+                    if i >= protected_until and row[0] is not None
+                    and msg.get('tag_weight') is not None and msg['tag_weight'] < min_tag_weight
+                )
+                candidates = [row for row in candidates if row[0] not in skipped]
+            window = []
+            tokens = 0
+            for row in candidates:
+                if window and tokens + row[3] > budget:
+                    break
+                window.append(row)
+                tokens += row[3]
+            ids = [row[0] for row in window if row[0] is not None]
+            anchor = min(ids) if ids else None
+            _prompt_anchor['message_id'] = anchor
+            _prompt_anchor['skipped'] = frozenset(i for i in skipped if anchor is not None and i >= anchor)
+            log_system("info", f"Окно истории перезакреплено с сообщения {anchor}: {len(window)} сообщений, "
+                               f"без {len(skipped)} малозначимых (префикс промпта сменится)")
+    
+    window.reverse()
+    user_in_history = current_row is not None and any(row is current_row for row in window)
+    stats = {
+        'tokens': sum(row[3] for row in window),
+        'kept': len(window),
+        'truncated': truncated_count,
+        'dropped': len(rows) - len(window)
+    }
+    return [{"role": role, "content": content} for _, role, content, _ in window], stats, user_in_history
+
 
 def ai_build_messages(user_message: str, persona: str = None, 
                       include_history: bool = True,
-                      additional_context: list = None) -> List[Dict]:
+                      additional_context: list = None,
+                      provider_name: str = None) -> List[Dict]:
     """
     Формирует список сообщений для OpenAI API.
     Включает историю диалога из БД если include_history=True.
     additional_context: список дополнительных сообщений в формате {"role": "...", "content": "..."}
+    Размер промпта ограничен бюджетом ai.<provider>.context_budget_tokens (или ai.context_budget_tokens):
+    системные промпты, доп. контекст, текущее сообщение и последние ходы — всегда,
+    на старую историю — сколько останется.
+    ai.prompt_layout: chatlog — последние сообщения, текущее сообщение пользователя в конце;
+    stable — закреплённое окно истории, префикс промпта не меняется между ходами (см. ai_select_history_stable).
     """
     messages = []
-    system_count = 0
     history_count = 0
     additional_count = 0
     
-    # 1. Системные промпты (персона)
-    if persona:
-        persona_file = f"conf/{persona}.md"
-        if os.path.exists(persona_file):
-            with open(persona_file, 'r', encoding='utf-8') as f:
-                content = f.read().strip()
-            
-            # Разбиваем на блоки по ##
-            blocks = []
-            current_block = []
-            
-            for line in content.split('\n'):
-                line = line.strip()
-                if line.startswith('## '):
-                    if current_block:
-                        blocks.append('\n'.join(current_block))
-                        current_block = []
-                if line:
-                    current_block.append(line)
-            
-            if current_block:
-                blocks.append('\n'.join(current_block))
-            
-            # Обрабатываем каждый блок
-            for block_idx, block in enumerate(blocks, 1):
-                # Извлекаем заголовок блока (первая строка, начинающаяся с ##)
-                header = None
-                for line in block.split('\n'):
-                    if line.strip().startswith('## '):
-                        header = line.strip()[3:].strip()  # убираем ## и пробелы
-                        break
-                
-                # Убираем все строки, начинающиеся с ##
-                clean_lines = [line for line in block.split('\n') 
-                              if not line.strip().startswith('##')]
-                clean_content = '\n'.join(clean_lines).strip()
-                
-                if clean_content:
-                    # ЛОГИРУЕМ КАЖДОЕ СИСТЕМНОЕ СООБЩЕНИЕ
-                    log_system("debug", f"Системное сообщение [{system_count + 1}] '{header or 'без заголовка'}': {clean_content.replace('\n', ' ')}")
-                    
-                    messages.append({"role": "system", "content": clean_content})
-                    system_count += 1
-                
-        else:
-            fallback_content = f"Ты — {persona}. Отвечай как друг."
-            log_system("debug", f"Системное сообщение [{system_count + 1}]: {fallback_content.replace('\n', ' ')}")
-            
-            messages.append({"role": "system", "content": fallback_content})
-            system_count += 1
+    # 1. Системные промпты (персона) — из реестра, файл разбирается только при изменении
+    system_tokens = 0
+    persona_file = f"conf/{persona}.md" if persona else None
+    if persona_file and os.path.exists(persona_file):
+        persona_messages, persona_tokens = pr_get_system_messages(persona_file)
+        messages.extend(persona_messages)
+        system_tokens += persona_tokens
     else:
-        fallback_content = "Ты — полезный ассистент."
-        log_system("debug", f"Системное сообщение [{system_count + 1}]: {fallback_content.replace('\n', ' ')}")
-        
+        fallback_content = f"Ты — {persona}. Отвечай как друг." if persona else "Ты — полезный ассистент."
+        log_system("debug", f"Системное сообщение [{len(messages) + 1}]: {fallback_content}")
         messages.append({"role": "system", "content": fallback_content})
-        system_count += 1
+        system_tokens += _ai_message_tokens(fallback_content)
     
-    # 1.1. Промпт памяти (НОВЫЙ)
-    try:
-        memory_prompt_file = config_get('memory.memory_prompt_file')
-        if memory_prompt_file and os.path.exists(memory_prompt_file):
-            with open(memory_prompt_file, 'r', encoding='utf-8') as f:
-                memory_content_raw = f.read().strip()
-            
-            if memory_content_raw:
-                # Извлекаем заголовок (первую строку с ##)
-                header = None
-                for line in memory_content_raw.split('\n'):
-                    if line.strip().startswith('## '):
-                        header = line.strip()[3:].strip()  # убираем ## и пробелы
-                        break
-                
-                # Удаляем строки, начинающиеся с ## (как в обработке персонажа)
-                clean_lines = [line for line in memory_content_raw.split('\n') 
-                              if not line.strip().startswith('##')]
-                memory_content = '\n'.join(clean_lines).strip()
-                
-                if memory_content:
-                    # ЛОГИРУЕМ ПРОМПТ ПАМЯТИ С ЗАГОЛОВКОМ
-                    log_system("debug", f"Системное сообщение [{system_count + 1}] '{header or 'Промпт памяти'}': {memory_content.replace('\n', ' ')}")
-                    
-                    messages.append({"role": "system", "content": memory_content})
-                    system_count += 1
-        else:
-            log_system("error", f"Файл промпта алгоритма работы с памятью не найден или не указан: {memory_prompt_file}")
-    except Exception as e:
-        log_system("error", f"Ошибка загрузки промпта алгоритма работы с памятью: {e}")
+    # 1.1. Промпт памяти — одним системным сообщением
+    memory_prompt_file = config_get('memory.memory_prompt_file')
+    if memory_prompt_file and os.path.exists(memory_prompt_file):
+        memory_messages, memory_tokens = pr_get_system_messages(memory_prompt_file, split_blocks=False)
+        messages.extend(memory_messages)
+        system_tokens += memory_tokens
+    else:
+        log_system("error", f"Файл промпта алгоритма работы с памятью не найден или не указан: {memory_prompt_file}")
+    system_count = len(messages)
 
+    # Бюджет токенов: всё, кроме старой истории, входит обязательно
+    if provider_name is None:
+        provider_name = config_get('ai.default_provider', 'deepseek')
+    budget = config_get(f'ai.{provider_name}.context_budget_tokens') or config_get('ai.context_budget_tokens', 8000)
+    additional_tokens = sum(_ai_message_tokens(ctx["content"]) for ctx in additional_context or [])
+    user_tokens = _ai_message_tokens(user_message)
+    
     # 2. История диалога из БД (если нужно)
+    layout = config_get('ai.prompt_layout', 'chatlog')
+    history_tokens = 0
+    user_in_history = False
     if include_history:
         history_limit = config_get('ai.context_messages_limit', 10)
-        history_messages = db_get_recent_messages(limit=max(1, history_limit))
-        history_count = len(history_messages)
-        
-        # Форматируем историю
-        for msg in reversed(history_messages):
-            author = msg['author']
-            role = "assistant" if author == "kira" else "user"
-            msg_content = msg['message']
-            # tag_topics = msg.get('tag_topics', [])  # можно оставить на будущее, но не используем
-    
-            # Пропускаем, если это сообщение от пользователя и совпадает с текущим user_message
-            if role == "user" and msg_content == user_message:
-                history_count -= 1
-                continue
-    
-            messages.append({"role": role, "content": msg_content})
+        history_budget = budget - system_tokens - additional_tokens - user_tokens
+        if layout == 'stable':
+            anchor_step = config_get('ai.prompt_anchor_step', 20)
+            history_messages = db_get_recent_messages(limit=max(1, history_limit + anchor_step))
+            history, history_stats, user_in_history = ai_select_history_stable(
+                history_messages, user_message, history_limit, history_budget + user_tokens)
+        else:
+            history_messages = db_get_recent_messages(limit=max(1, history_limit))
+            history, history_stats = ai_select_history(history_messages, user_message, history_budget)
+        messages.extend(history)
+        history_count = len(history) - (1 if user_in_history else 0)
+        history_tokens = history_stats['tokens'] - (user_tokens if user_in_history else 0)
+        if history_stats['truncated'] or history_stats['dropped']:
+            log_system("info", f"История в бюджете {max(0, history_budget)} токенов: взято {history_stats['kept']} из {len(history_messages)}, "
+                               f"обрезано {history_stats['truncated']}, отброшено {history_stats['dropped']}")
     
     # 2.1. Дополнительный контекст (например, результаты поиска)
     if additional_context:
@@ -142,11 +266,17 @@ def ai_build_messages(user_message: str, persona: str = None,
             messages.append(ctx)  # предполагается, что ctx уже в формате {"role": "...", "content": "..."}
         additional_count = len(additional_context)
     
-    # 3. Текущее сообщение пользователя
-    messages.append({"role": "user", "content": user_message})
+    # 3. Текущее сообщение пользователя (в раскладке stable оно уже стоит на своём месте в истории)
+    if not user_in_history:
+        messages.append({"role": "user", "content": user_message})
     
     # Финальное логирование структуры
     log_system("info", f"Сформирован промпт из {len(messages)} сообщений. Системных: {system_count}, история: {history_count}, доп. контекст: {additional_count}, текущее: 1)")
+    total_tokens = system_tokens + history_tokens + additional_tokens + user_tokens
+    log_system("info", f"Токены промпта ({provider_name}): системные {system_tokens}, история {history_tokens}, "
+                       f"доп. контекст {additional_tokens}, текущее {user_tokens}, всего {total_tokens} из {budget}")
+    if total_tokens > budget:
+        log_system("warning", f"Промпт превышает бюджет на {total_tokens - budget} токенов (системные промпты и последние ходы не сокращаются)")
     
     # Дополнительно: логируем всю структуру на DEBUG уровне
     log_system("debug", "=== ПОЛНАЯ СТРУКТУРА ПРОМПТА ===")
@@ -158,63 +288,255 @@ def ai_build_messages(user_message: str, persona: str = None,
     return messages
 
 
-# ============ ПРОВАЙДЕРЫ API ============
+# ============ КЛИЕНТЫ API ============
+# Один долгоживущий клиент на (провайдер, base_url, ключ): пул HTTP-соединений и TLS-сессии
+# переиспользуются между запросами. Клиент OpenAI потокобезопасен.
+_clients = {}
+_clients_lock = threading.Lock()
 
-def ai_deepseek_request(messages: List[Dict], model: str = None) -> str:
-    """Запрос к DeepSeek API (синхронный)"""
-    api_key = os.getenv('API_KEY_DEEPSEEK')
+_PROVIDER_ENV_KEYS = {
+    'deepseek': 'API_KEY_DEEPSEEK',
+    'openai': 'API_KEY_OPENAI'
+}
+
+
+def ai_get_client(provider: str) -> OpenAI:
+    """Возвращает общий клиент для провайдера ('deepseek' или 'openai'), создаёт при первом обращении"""
+    env_key = _PROVIDER_ENV_KEYS.get(provider)
+    if env_key is None:
+        raise ValueError(f"Неизвестный провайдер: {provider}")
+    
+    api_key = os.getenv(env_key)
     if not api_key:
-        raise ValueError("API_KEY_DEEPSEEK не задан в .env")
+        raise ValueError(f"{env_key} не задан в .env")
+    
+    if provider == 'deepseek':
+        base_url = config_get('ai.deepseek.base_url', 'https://api.deepseek.com')
+    else:
+        base_url = config_get('ai.openai.base_url')
+    
+    key = (provider, base_url, api_key)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is not None:
+            return client
+        
+        http_client = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=config_get('ai.http.max_connections', 20),
+                max_keepalive_connections=config_get('ai.http.max_keepalive_connections', 10),
+                keepalive_expiry=config_get('ai.http.keepalive_expiry_seconds', 60)
+            ),
+            timeout=httpx.Timeout(
+                config_get('ai.http.timeout_seconds', 120),
+                connect=config_get('ai.http.connect_timeout_seconds', 10)
+            )
+        )
+        client = OpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            http_client=http_client,
+            max_retries=config_get('ai.http.max_retries', 2)
+        )
+        _clients[key] = client
+        log_system("info", f"Создан клиент API {provider} ({base_url or 'по умолчанию'})")
+        return client
+
+
+def ai_close_clients():
+    """Закрывает все клиенты API и их пулы соединений (при завершении работы)"""
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+# ============ КЭШ ПРЕФИКСА ПРОВАЙДЕРА ============
+_prompt_cache_stats = {}                # "назначение:провайдер/модель" -> счётчики запросов, токенов запроса и попаданий в кэш
+_prompt_cache_stats_lock = threading.Lock()
+
+
+def _ai_usage_cached_tokens(usage) -> tuple:
+    """
+    Возвращает (токены запроса, из них из кэша префикса) по usage ответа:
+    DeepSeek — prompt_cache_hit_tokens, OpenAI chat.completions — prompt_tokens_details.cached_tokens,
+    /responses — input_tokens_details.cached_tokens.
+    """
+    prompt_tokens = getattr(usage, 'prompt_tokens', None)
+    if prompt_tokens is None:
+        prompt_tokens = getattr(usage, 'input_tokens', None)
+    
+    cached_tokens = getattr(usage, 'prompt_cache_hit_tokens', None)
+    if cached_tokens is None:
+        details = getattr(usage, 'prompt_tokens_details', None) or getattr(usage, 'input_tokens_details', None)
+        cached_tokens = getattr(details, 'cached_tokens', None) if details is not None else None
+    return prompt_tokens or 0, cached_tokens or 0
+
+
+def _ai_usage_key(usage_label: str, provider: str, model: str) -> str:
+    """Ключ статистики кэша: запросы с разными назначением и моделью не смешиваются; None — не учитывать"""
+    return f"{usage_label}:{provider}/{model}" if usage_label else None
+
+
+def _ai_record_usage(usage_key: str, usage, elapsed: float):
+    """Учитывает usage ответа в статистике кэша префикса (под ключом _ai_usage_key) и пишет её в лог"""
+    if usage_key is None or usage is None:
+        return
+    prompt_tokens, cached_tokens = _ai_usage_cached_tokens(usage)
+    
+    with _prompt_cache_stats_lock:
+        stats = _prompt_cache_stats.setdefault(usage_key, {
+            'requests': 0, 'hit_requests': 0, 'prompt_tokens': 0, 'cached_tokens': 0,
+            'hit_seconds': 0.0, 'miss_seconds': 0.0
+        })
+        stats['requests'] += 1
+        stats['prompt_tokens'] += prompt_tokens
+        stats['cached_tokens'] += cached_tokens
+        if cached_tokens:
+            stats['hit_requests'] += 1
+            stats['hit_seconds'] += elapsed
+        else:
+            stats['miss_seconds'] += elapsed
+        total_rate = stats['cached_tokens'] / stats['prompt_tokens'] if stats['prompt_tokens'] else 0.0
+    
+    rate = cached_tokens / prompt_tokens if prompt_tokens else 0.0
+    log_system("info", f"Кэш префикса {usage_key}: {cached_tokens} из {prompt_tokens} токенов запроса ({rate:.0%}), "
+                       f"ответ за {elapsed:.1f} сек; за процесс {total_rate:.0%}")
+
+
+def ai_prompt_cache_stats() -> Dict[str, Dict[str, Any]]:
+    """
+    Статистика кэша префикса в этом процессе по ключам "назначение:провайдер/модель"
+    (chat.chatlog / chat.stable — ответы пользователю по раскладке промпта, tagger — тэгирование): requests, hit_requests (запросы с попаданием),
+    prompt_tokens, cached_tokens, hit_rate — доля токенов запроса из кэша,
+    avg_hit_seconds / avg_miss_seconds — среднее время ответа с попаданием и без.
+    """
+    with _prompt_cache_stats_lock:
+        result = {key: dict(stats) for key, stats in _prompt_cache_stats.items()}
+    for stats in result.values():
+        miss_requests = stats['requests'] - stats['hit_requests']
+        stats['hit_rate'] = stats['cached_tokens'] / stats['prompt_tokens'] if stats['prompt_tokens'] else 0.0
+        hit_seconds, miss_seconds = stats.pop('hit_seconds'), stats.pop('miss_seconds')
+        stats['avg_hit_seconds'] = hit_seconds / stats['hit_requests'] if stats['hit_requests'] else None
+        stats['avg_miss_seconds'] = miss_seconds / miss_requests if miss_requests else None
+    return result
+
+
+# ============ ПРОВАЙДЕРЫ API ============
+
+def _ai_stream_chat(client, usage_key: str, on_delta, **params) -> str:
+    """
+    Потоковый chat.completions: каждый кусок текста сразу уходит в on_delta.
+    Последний чанк потока (include_usage) несёт usage и не содержит choices.
+    Возвращает весь текст ответа.
+    """
+    parts = []
+    usage = None
+    started = time.monotonic()
+    stream = client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **params)
+    for chunk in stream:
+        if chunk.usage:
+            usage = chunk.usage
+            log_system("debug", f"Потоковый ответ: токенов запроса {usage.prompt_tokens}, ответа {usage.completion_tokens}")
+        if not chunk.choices:
+            continue
+        piece = chunk.choices[0].delta.content
+        if piece:
+            parts.append(piece)
+            on_delta(piece)
+    _ai_record_usage(usage_key, usage, time.monotonic() - started)
+    return ''.join(parts).strip()
+
+
+def _ai_stream_responses(client, usage_key: str, on_delta, **params) -> str:
+    """Потоковый /responses API: текст приходит событиями response.output_text.delta"""
+    parts = []
+    usage = None
+    started = time.monotonic()
+    stream = client.responses.create(stream=True, **params)
+    for event in stream:
+        if event.type == 'response.output_text.delta':
+            parts.append(event.delta)
+            on_delta(event.delta)
+        elif event.type == 'response.completed' and event.response.usage:
+            usage = event.response.usage
+            log_system("debug", f"Потоковый ответ: токенов запроса {usage.input_tokens}, ответа {usage.output_tokens}")
+    _ai_record_usage(usage_key, usage, time.monotonic() - started)
+    return ''.join(parts).strip()
+
+
+def ai_deepseek_request(messages: List[Dict], model: str = None, on_delta=None, usage_label: str = None) -> str:
+    """
+    Запрос к DeepSeek API (синхронный).
+    on_delta(text) — если задан, ответ запрашивается потоком и каждый кусок передаётся в него по мере прихода.
+    usage_label — назначение запроса для статистики кэша префикса (ai_prompt_cache_stats); None — не учитывать.
+    """
+    client = ai_get_client('deepseek')
     
     if model is None:
         model = config_get('ai.deepseek.model', 'deepseek-chat')
-    
-    client = OpenAI(
-        api_key=api_key,
-        base_url=config_get('ai.deepseek.base_url', 'https://api.deepseek.com')
-    )
+    usage_key = _ai_usage_key(usage_label, 'deepseek', model)
     
     try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=config_get('ai.deepseek.temperature', 0.99),
-            max_tokens=config_get('ai.deepseek.max_tokens', 1024)
-        )
+        params = {
+            'model': model,
+            'messages': messages,
+            'temperature': config_get('ai.deepseek.temperature', 0.99),
+            'max_tokens': config_get('ai.deepseek.max_tokens', 1024)
+        }
+        if on_delta is not None:
+            return _ai_stream_chat(client, usage_key, on_delta, **params)
+        
+        started = time.monotonic()
+        response = client.chat.completions.create(**params)
+        _ai_record_usage(usage_key, response.usage, time.monotonic() - started)
         return response.choices[0].message.content.strip()
     except Exception as e:
         log_system("error", f"Ошибка DeepSeek: {e}")
         raise
 
-def ai_openai_request(messages: List[Dict], model: str = None) -> str:
-    """Запрос к OpenAI API (синхронный)"""
-    api_key = os.getenv('API_KEY_OPENAI')
-    if not api_key:
-        raise ValueError("API_KEY_OPENAI не задан в .env")
+def ai_openai_request(messages: List[Dict], model: str = None, on_delta=None, usage_label: str = None) -> str:
+    """
+    Запрос к OpenAI API (синхронный).
+    on_delta(text) — если задан, ответ запрашивается потоком и каждый кусок передаётся в него по мере прихода.
+    usage_label — назначение запроса для статистики кэша префикса (ai_prompt_cache_stats); None — не учитывать.
+    """
+    client = ai_get_client('openai')
     
     if model is None:
         model = config_get('ai.openai.model', 'gpt-4o-mini')
-    
-    client = OpenAI(api_key=api_key)
+    usage_key = _ai_usage_key(usage_label, 'openai', model)
     
     try:
         # Проверяем, поддерживает ли модель старый chat.completions API
         if model.startswith('gpt-4') or model.startswith('gpt-3'):
             # Старый API
-            response = client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=config_get('ai.openai.temperature', 0.99),
-                max_tokens=config_get('ai.openai.max_tokens', 1024)
-            )
+            params = {
+                'model': model,
+                'messages': messages,
+                'temperature': config_get('ai.openai.temperature', 0.99),
+                'max_tokens': config_get('ai.openai.max_tokens', 1024)
+            }
+            if on_delta is not None:
+                return _ai_stream_chat(client, usage_key, on_delta, **params)
+            
+            started = time.monotonic()
+            response = client.chat.completions.create(**params)
+            _ai_record_usage(usage_key, response.usage, time.monotonic() - started)
             return response.choices[0].message.content.strip()
         else:
             # Новый /responses API для GPT-5+
-            response = client.responses.create(
-                model=model,
-                input=messages,
-                max_output_tokens=config_get('ai.openai.max_tokens', 1024)
-            )
+            params = {
+                'model': model,
+                'input': messages,
+                'max_output_tokens': config_get('ai.openai.max_tokens', 1024)
+            }
+            if on_delta is not None:
+                return _ai_stream_responses(client, usage_key, on_delta, **params)
+            
+            started = time.monotonic()
+            response = client.responses.create(**params)
+            _ai_record_usage(usage_key, response.usage, time.monotonic() - started)
             return response.output_text.strip()
     except Exception as e:
         log_system("error", f"Ошибка OpenAI (модель {model}): {e}")
@@ -228,11 +550,13 @@ def ai_get_response(
     user_message: str, 
     provider_name: str = None,
     persona: str = None,
-    additional_context: list = None  # <--- НОВЫЙ ПАРАМЕТР
+    additional_context: list = None,  # <--- НОВЫЙ ПАРАМЕТР
+    on_delta=None
 ) -> tuple[str, str]:
     """
     Основная функция для получения ответа от AI (синхронная).
     additional_context: список дополнительных сообщений в формате {"role": "...", "content": "..."}
+    on_delta: колбэк для потоковой выдачи — получает куски текста по мере генерации
     """
     # Определяем провайдера
     if provider_name is None:
@@ -245,18 +569,20 @@ def ai_get_response(
     # Формируем сообщения
     messages = ai_build_messages(user_message, persona, 
                                  include_history=True, 
-                                 additional_context=additional_context)
+                                 additional_context=additional_context,
+                                 provider_name=provider_name)
 
     # Логируем промпт
     if messages and messages[0]['role'] == 'system':
         log_system("info", f"Отправлено сообщение AI-моделе {provider_name}.")
     
-    # Вызываем провайдера
+    # Вызываем провайдера; статистика кэша префикса — отдельно для каждой раскладки промпта
+    usage_label = f"chat.{config_get('ai.prompt_layout', 'chatlog')}"
     try:
         if provider_name == "deepseek":
-            response_text = ai_deepseek_request(messages)
+            response_text = ai_deepseek_request(messages, on_delta=on_delta, usage_label=usage_label)
         elif provider_name == "openai":
-            response_text = ai_openai_request(messages)
+            response_text = ai_openai_request(messages, on_delta=on_delta, usage_label=usage_label)
         else:
             raise ValueError(f"Неизвестный провайдер: {provider_name}")
         
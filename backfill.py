@@ -0,0 +1,225 @@
+# backfill.py
+
+"""
+Перевекторизация всех чанков новой моделью эмбеддингов без остановки бота.
+
+Новые векторы пишутся в теневую колонку chunks.embedding_new параллельными пачками.
+Прогресс хранится в самой колонке (NULL — ещё не сделано), поэтому прерванный запуск
+продолжается с того же места. Когда готовы все чанки (включая появившиеся за время работы),
+колонка атомарно подменяет chunks.embedding и перестраивается ANN-индекс.
+
+    python backfill.py --model text-embedding-3-large
+    python backfill.py --model text-embedding-3-large --dimensions 1024 --concurrency 8
+    python backfill.py                  # продолжить прерванный запуск
+    python backfill.py --status
+    python backfill.py --abort
+    python backfill.py --dedup-report
+"""
+
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+
+from logger import setup_logging, log_system
+from config_loader import config_get
+from ai_provider import ai_get_client, ai_close_clients
+from rate_limiter import rl_get_limiter
+from memory_manager import mm_split_embedding_batches, mm_embed_chunks, mm_dedup_report
+from vector_index import vi_maintain_index
+from database import (
+    db_connection,
+    db_init_tables,
+    db_close_pool,
+    db_backfill_get_running,
+    db_backfill_start,
+    db_backfill_abort,
+    db_backfill_progress,
+    db_backfill_get_pending,
+    db_backfill_save,
+    db_backfill_switch
+)
+
+
+# ============ ВЕКТОРИЗАЦИЯ ============
+def bf_probe_vector_size(client, model: str, dimensions: int = None) -> int:
+    """Узнаёт размерность векторов модели пробным запросом"""
+    params = {'dimensions': dimensions} if dimensions else {}
+    response = client.embeddings.create(model=model, input="probe", encoding_format="float", **params)
+    return len(response.data[0].embedding)
+
+
+def bf_embed_batch(client, model: str, dimensions: int, batch: list, limiter) -> int:
+    """
+    Векторизует пачку чанков (повторы текста — из embedding_store и уже перевекторизованных чанков)
+    и пишет результат в embedding_new.
+    Возвращает число записанных чанков.
+    """
+    embeddings = mm_embed_chunks(client, model, dimensions, batch, limiter, column='embedding_new')
+    if not embeddings:
+        return 0
+
+    with db_connection() as conn:
+        return db_backfill_save(conn, embeddings)
+
+
+def _bf_format_eta(seconds: float) -> str:
+    """Секунды -> 'ЧЧ:ММ:СС'"""
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def bf_run_pass(client, run: dict, concurrency: int, started_at: float, done_at_start: int) -> int:
+    """
+    Один проход по чанкам без embedding_new (по возрастанию id, страницами).
+    Страница делится на пачки и векторизуется concurrency пачками одновременно.
+    Возвращает число перевекторизованных за проход чанков.
+    """
+    model = run['model']
+    dimensions = run['dimensions']
+    max_items = max(1, config_get('memory.embedding_batch_size', 64))
+    max_tokens = config_get('memory.embedding_batch_max_tokens', 50000)
+    page_size = config_get('memory.backfill.page_size', 1024)
+    limiter = rl_get_limiter(f"backfill.{model}",
+                             rpm=config_get('memory.backfill.rpm'),
+                             tpm=config_get('memory.backfill.tpm'))
+
+    saved = 0
+    after_id = 0
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="backfill") as pool:
+        while True:
+            with db_connection() as conn:
+                pending = db_backfill_get_pending(conn, after_id, page_size)
+            if not pending:
+                break
+            after_id = pending[-1]['id']
+
+            batches = mm_split_embedding_batches(pending, max_items, max_tokens, model)
+            futures = {pool.submit(bf_embed_batch, client, model, dimensions, batch, limiter): batch for batch in batches}
+            for future in as_completed(futures):
+                batch = futures[future]
+                try:
+                    saved += future.result()
+                except Exception as e:
+                    log_system("error", f"Ошибка записи пачки (чанки {batch[0]['id']}-{batch[-1]['id']}): {e}")
+
+            # Скорость и оставшееся время — по всему запуску
+            with db_connection() as conn:
+                total, done = db_backfill_progress(conn)
+            elapsed = time.monotonic() - started_at
+            rate = (done - done_at_start) / elapsed if elapsed > 0 else 0.0
+            eta = _bf_format_eta((total - done) / rate) if rate > 0 else "—"
+            log_system("info", f"Перевекторизация: {done}/{total} ({done / max(1, total):.1%}), {rate:.1f} чанков/сек, осталось ~{eta}")
+
+    return saved
+
+
+def bf_run(model: str = None, dimensions: int = None, concurrency: int = None, switch: bool = True) -> bool:
+    """
+    Перевекторизует все чанки и (если switch) переключает на них поиск.
+    Без model — продолжает незавершённый запуск. Возвращает True, если переключение выполнено.
+    """
+    if concurrency is None:
+        concurrency = config_get('memory.backfill.concurrency', 4)
+    concurrency = max(1, concurrency)
+    max_passes = config_get('memory.backfill.max_passes', 5)
+
+    client = ai_get_client('openai')
+
+    with db_connection() as conn:
+        run = db_backfill_get_running(conn)
+    if model is None:
+        if run is None:
+            log_system("error", "Нет незавершённой перевекторизации — укажите --model")
+            return False
+        model, dimensions = run['model'], run['dimensions']
+
+    if run is None or run['model'] != model or run['dimensions'] != dimensions:
+        vector_size = bf_probe_vector_size(client, model, dimensions)
+        run = db_backfill_start(model, dimensions, vector_size)
+
+    with db_connection() as conn:
+        total, done_at_start = db_backfill_progress(conn)
+    log_system("info", f"Перевекторизация #{run['id']} ({model}, векторы {run['vector_size']}): готово {done_at_start}/{total}, параллельно {concurrency}")
+
+    started_at = time.monotonic()
+    for attempt in range(1, max_passes + 1):
+        # Первый проход — основная работа; следующие добирают новые чанки и пачки с ошибками
+        saved = bf_run_pass(client, run, concurrency, started_at, done_at_start)
+
+        with db_connection() as conn:
+            total, done = db_backfill_progress(conn)
+        if done < total:
+            log_system("warning", f"Проход {attempt}: не готово {total - done} чанков, повторяем")
+            if saved == 0:
+                log_system("error", "Проход не продвинулся — проверьте ошибки API и перезапустите backfill.py")
+                return False
+            continue
+
+        if not switch:
+            log_system("info", f"Все {total} чанков перевекторизованы; переключение пропущено (--no-switch)")
+            return False
+
+        if db_backfill_switch(run['id']):
+            vi_maintain_index()
+            elapsed = time.monotonic() - started_at
+            log_system("info", f"Перевекторизация #{run['id']} завершена за {_bf_format_eta(elapsed)}, модель {model}")
+            return True
+        log_system("info", "Пока шло переключение, появились новые чанки — довекторизуем")
+
+    log_system("error", f"Не удалось завершить перевекторизацию за {max_passes} проходов, запустите backfill.py ещё раз")
+    return False
+
+
+def bf_status():
+    """Печатает состояние незавершённой перевекторизации"""
+    with db_connection() as conn:
+        run = db_backfill_get_running(conn)
+        if run is None:
+            print("Незавершённой перевекторизации нет")
+            return
+        total, done = db_backfill_progress(conn)
+    print(f"#{run['id']} {run['model']} (dimensions={run['dimensions']}, векторы {run['vector_size']}), "
+          f"начата {run['started_at']}: готово {done}/{total} ({done / max(1, total):.1%})")
+
+
+# ============ ЗАПУСК ============
+def main():
+    parser = argparse.ArgumentParser(description="Перевекторизация чанков новой моделью эмбеддингов")
+    parser.add_argument('--model', help="новая модель эмбеддингов (без неё — продолжить незавершённый запуск)")
+    parser.add_argument('--dimensions', type=int, help="укороченная размерность (для text-embedding-3)")
+    parser.add_argument('--concurrency', type=int, help="параллельных запросов к API (по умолчанию memory.backfill.concurrency)")
+    parser.add_argument('--no-switch', action='store_true', help="только заполнить embedding_new, не переключать")
+    parser.add_argument('--status', action='store_true', help="показать прогресс и выйти")
+    parser.add_argument('--abort', action='store_true', help="отменить незавершённый запуск и удалить embedding_new")
+    parser.add_argument('--dedup-report', action='store_true', help="отчёт о дедупликации эмбеддингов и выйти")
+    args = parser.parse_args()
+
+    load_dotenv('conf/.env')
+    setup_logging()
+
+    try:
+        db_init_tables()
+
+        if args.status:
+            bf_status()
+            return
+        if args.dedup_report:
+            mm_dedup_report()
+            return
+        if args.abort:
+            aborted = db_backfill_abort()
+            log_system("info", f"Отменено перевекторизаций: {len(aborted)}")
+            return
+
+        ok = bf_run(args.model, args.dimensions, args.concurrency, switch=not args.no_switch)
+        sys.exit(0 if ok or args.no_switch else 1)
+    finally:
+        ai_close_clients()
+        db_close_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,17 @@
 # database.py
 
 import os
+import time
+import bisect
+import socket
+import hashlib
+import threading
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
 import yaml
 
+from contextlib import contextmanager
 from datetime import date, datetime, timedelta
 from typing import List, Dict, Any, Optional
 
@@ -13,229 +20,829 @@ from config_loader import config_get
 
 # ============ БАЗОВЫЕ ФУНКЦИИ БД ============
 def db_get_connection():
-    """Возвращает подключение к БД"""
+    """
+    Возвращает новое (непулированное) подключение к БД.
+    Для обычной работы используйте db_connection() — он берёт подключение из пула.
+    """
     db_url = os.getenv('DB_URL')
     if not db_url:
         raise ValueError("DB_URL не задан в .env")
     return psycopg2.connect(db_url)
 
-def db_init_tables():
-    """Создаёт таблицы chatlog и chunks если их нет, добавляет индексы"""
-    conn = db_get_connection()
-    try:
-        cur = conn.cursor()
+
+# ============ ПУЛ ПОДКЛЮЧЕНИЙ ============
+_pool = None
+_pool_slots = None                  # ограничивает число одновременно выданных подключений
+_pool_lock = threading.Lock()
+_pool_last_used = {}                # id(conn) -> время последнего возврата в пул
+
+
+def db_init_pool():
+    """
+    Создаёт пул подключений (один раз на процесс).
+    Размеры берутся из db.pool_min_size / db.pool_max_size.
+    """
+    global _pool, _pool_slots
+    with _pool_lock:
+        if _pool is not None:
+            return _pool
         
-        # chatlog
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS chatlog (
-                id SERIAL PRIMARY KEY,
-                source VARCHAR(50) NOT NULL,
-                author VARCHAR(50) NOT NULL,
-                message TEXT NOT NULL,
-                tag_weight INTEGER,
-                tag_topics TEXT[],
-                session_id BIGINT,
-                created_at TIMESTAMP DEFAULT NOW()
-            )
-        ''')
+        db_url = os.getenv('DB_URL')
+        if not db_url:
+            raise ValueError("DB_URL не задан в .env")
         
-        # Индекс для быстрого чанкования (сортировка по времени)
-        cur.execute('''
-            CREATE INDEX IF NOT EXISTS idx_chatlog_created 
-            ON chatlog (created_at DESC)
-        ''')
+        min_size = config_get('db.pool_min_size', 1)
+        max_size = max(min_size, config_get('db.pool_max_size', 10))
         
-        # chunks
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS chunks (
-                id SERIAL PRIMARY KEY,
-                chunk_text TEXT NOT NULL,
-                message_ids INTEGER[] DEFAULT '{}',
-                created_at TIMESTAMP DEFAULT NOW(),
-                embedding vector(1536)
-            )
-        ''')
+        _pool = psycopg2.pool.ThreadedConnectionPool(min_size, max_size, db_url)
+        _pool_slots = threading.BoundedSemaphore(max_size)
+        log_system("info", f"Пул подключений к БД создан (min={min_size}, max={max_size})")
+        return _pool
+
+
+def db_close_pool():
+    """Закрывает все подключения пула (при завершении работы)"""
+    global _pool, _pool_slots
+    with _pool_lock:
+        if _pool is None:
+            return
+        _pool.closeall()
+        _pool = None
+        _pool_slots = None
+        _pool_last_used.clear()
+        log_system("info", "Пул подключений к БД закрыт")
+
+
+def _db_connection_alive(conn) -> bool:
+    """
+    Проверка здоровья подключения перед выдачей из пула.
+    SELECT 1 выполняется только если подключение простаивало дольше db.pool_healthcheck_idle_seconds.
+    """
+    if conn.closed:
+        return False
+    
+    idle_limit = config_get('db.pool_healthcheck_idle_seconds', 30)
+    last_used = _pool_last_used.get(id(conn))
+    if last_used is not None and time.monotonic() - last_used < idle_limit:
+        return True
+    
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT 1')
+        cur.fetchone()
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def _db_acquire():
+    """Берёт живое подключение из пула, ждёт свободный слот не дольше db.pool_acquire_timeout_seconds"""
+    pool = db_init_pool()
+    slots = _pool_slots
+    
+    timeout = config_get('db.pool_acquire_timeout_seconds', 30)
+    if not slots.acquire(timeout=timeout):
+        raise psycopg2.pool.PoolError(f"Нет свободных подключений в пуле за {timeout} сек")
+    
+    try:
+        # Битые подключения закрываем и берём следующее
+        for _ in range(pool.maxconn + 1):
+            conn = pool.getconn()
+            if _db_connection_alive(conn):
+                return pool, slots, conn
+            log_system("warning", "Подключение из пула не прошло проверку, пересоздаём")
+            _pool_last_used.pop(id(conn), None)
+            pool.putconn(conn, close=True)
+        raise psycopg2.pool.PoolError("Не удалось получить рабочее подключение из пула")
+    except Exception:
+        slots.release()
+        raise
+
+
+def _db_release(pool, slots, conn):
+    """Возвращает подключение в пул в чистом состоянии (без открытой транзакции)"""
+    try:
+        broken = conn.closed != 0
+        if not broken:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
         
-        # Векторный индекс для быстрого поиска (IVFFlat для pgvector)
+        if broken:
+            _pool_last_used.pop(id(conn), None)
+        else:
+            _pool_last_used[id(conn)] = time.monotonic()
+        pool.putconn(conn, close=broken)
+    finally:
+        slots.release()
+
+
+@contextmanager
+def db_connection():
+    """
+    Контекстный менеджер для работы с БД через пул:
+
+        with db_connection() as conn:
+            cur = conn.cursor()
+            ...
+
+    При нормальном выходе транзакция фиксируется, при исключении — откатывается.
+    Подключение возвращается в пул, а не закрывается.
+    """
+    pool, slots, conn = _db_acquire()
+    try:
+        yield conn
+        if not conn.closed:
+            conn.commit()
+    except Exception:
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+        raise
+    finally:
+        _db_release(pool, slots, conn)
+
+# ============ МИГРАЦИИ СХЕМЫ ============
+_MIGRATIONS_LOCK_KEY = 4_711_001    # произвольный ключ advisory-блокировки для миграций
+
+
+def db_list_migrations() -> list:
+    """
+    Возвращает миграции из папки db.migrations_dir, отсортированные по версии.
+    Файл миграции: NNN_описание.sql, где NNN — номер версии.
+    Список кортежей (version, name, path).
+    """
+    migrations_dir = config_get('db.migrations_dir', 'migrations')
+    migrations = []
+    for filename in os.listdir(migrations_dir):
+        if not filename.endswith('.sql'):
+            continue
+        prefix = filename.split('_', 1)[0]
+        if not prefix.isdigit():
+            log_system("warning", f"Пропущен файл миграции без номера версии: {filename}")
+            continue
+        migrations.append((int(prefix), filename[:-4], os.path.join(migrations_dir, filename)))
+    
+    migrations.sort()
+    versions = [m[0] for m in migrations]
+    if len(versions) != len(set(versions)):
+        raise ValueError(f"Повторяющиеся номера версий миграций в {migrations_dir}")
+    return migrations
+
+
+def db_run_migrations() -> int:
+    """
+    Применяет недостающие миграции по порядку, каждую в своей транзакции.
+    Применённые версии хранятся в schema_migrations.
+    Параллельный запуск из нескольких процессов сериализуется advisory-блокировкой.
+    Возвращает количество применённых миграций.
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
         cur.execute('''
-            CREATE INDEX IF NOT EXISTS idx_chunks_embedding 
-            ON chunks 
-            USING ivfflat (embedding vector_cosine_ops)
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name VARCHAR(200) NOT NULL,
+                applied_at TIMESTAMP DEFAULT NOW()
+            )
         ''')
+    
+    applied_count = 0
+    for version, name, path in db_list_migrations():
+        with open(path, 'r', encoding='utf-8') as f:
+            sql = f.read()
         
-        conn.commit()
-        log_system("info", "Таблицы и индексы БД инициализированы")
-    finally:
-        conn.close()
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT pg_advisory_xact_lock(%s)', (_MIGRATIONS_LOCK_KEY,))
+            cur.execute('SELECT 1 FROM schema_migrations WHERE version = %s', (version,))
+            if cur.fetchone():
+                continue
+            
+            log_system("info", f"Применяется миграция {name}")
+            cur.execute(sql)
+            cur.execute('''
+                INSERT INTO schema_migrations (version, name) VALUES (%s, %s)
+            ''', (version, name))
+            applied_count += 1
+    
+    return applied_count
+
+
+def db_init_tables():
+    """Приводит схему БД к актуальной версии (миграции из папки migrations)"""
+    applied_count = db_run_migrations()
+    if applied_count:
+        log_system("info", f"Применено миграций: {applied_count}")
+    log_system("info", "Таблицы и индексы БД инициализированы")
 
 # ============ ЛОГИКА СЕССИЙ ============
-def db_get_or_create_session_id():
-    """Возвращает текущий session_id, создаёт новый если сессия истекла"""
-    conn = db_get_connection()
-    try:
+class DbSessionState:
+    """
+    Состояние текущей сессии в памяти процесса.
+    Загружается из БД один раз (db_session_init), дальше обновляется при каждой записи в chatlog,
+    поэтому решение о новой сессии принимается без запросов к БД.
+    Рассчитано на один процесс-писатель: записи других процессов здесь не видны.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.session_id = None
+        self.last_activity = None
+        self.seeded = False
+
+
+_session_state = DbSessionState()
+
+
+def db_session_init():
+    """Загружает последнюю сессию из БД в память (вызывается при старте)"""
+    with db_connection() as conn:
         cur = conn.cursor()
-        
-        # Получаем последнюю сессию из БД
         cur.execute('''
             SELECT session_id, created_at 
             FROM chatlog 
-            ORDER BY created_at DESC 
+            ORDER BY created_at DESC, id DESC
             LIMIT 1
         ''')
         row = cur.fetchone()
-        
-        timeout_hours = config_get('memory.session_timeout_hours', 6)
-        now = datetime.now()
-        
+    
+    with _session_state.lock:
         if row:
-            last_session_id, last_created = row
-            # Проверяем, не истекла ли сессия
-            if (now - last_created) <= timedelta(hours=timeout_hours):
-                log_system("info", f"Продолжена сессия: {last_session_id}")
-                return last_session_id
-        
-        # Новая сессия
-        new_session_id = int(now.timestamp())
-        log_system("info", f"Создана новая сессия: {new_session_id}")
-        return new_session_id
+            _session_state.session_id, _session_state.last_activity = row
+        _session_state.seeded = True
+    
+    if row:
+        log_system("info", f"Загружена последняя сессия: {row[0]} (последняя активность {row[1]})")
+    else:
+        log_system("info", "Сессий в БД нет, первая будет создана с первым сообщением")
+
+
+def _db_session_resolve():
+    """
+    Определяет текущую сессию по состоянию в памяти.
+    Если сессия истекла — сразу заводит новую, чтобы параллельные вызовы получили тот же session_id.
+    Возвращает: (is_new_session, session_id, previous_activity)
+    """
+    if not _session_state.seeded:
+        db_session_init()
+    
+    timeout_hours = config_get('memory.session_timeout_hours', 6)
+    now = datetime.now()
+    
+    with _session_state.lock:
+        last_activity = _session_state.last_activity
+        if last_activity is not None and (now - last_activity) <= timedelta(hours=timeout_hours):
+            return False, _session_state.session_id, last_activity
         
-    finally:
-        conn.close()
+        _session_state.session_id = int(now.timestamp())
+        _session_state.last_activity = now
+        return True, _session_state.session_id, last_activity
+
+
+def _db_session_touch(session_id: int, activity: datetime):
+    """Обновляет состояние сессии после записи сообщения"""
+    with _session_state.lock:
+        if _session_state.last_activity is None or activity >= _session_state.last_activity:
+            _session_state.session_id = session_id
+            _session_state.last_activity = activity
+
+
+def db_get_or_create_session_id():
+    """Возвращает текущий session_id, создаёт новый если сессия истекла"""
+    is_new, session_id, _ = _db_session_resolve()
+    if is_new:
+        log_system("info", f"Создана новая сессия: {session_id}")
+    else:
+        log_system("info", f"Продолжена сессия: {session_id}")
+    return session_id
+
 
 def db_check_new_session():
     """
     Проверяет, началась ли новая сессия.
     Возвращает: (is_new_session, current_session_id, hours_passed)
     """
-    conn = db_get_connection()
-    try:
-        cur = conn.cursor()
-        
-        # 1. Получаем текущий session_id (создаёт новый если истекла)
-        current_session_id = db_get_or_create_session_id()
-        
-        # 2. Берём последний session_id из БД
-        cur.execute('''
-            SELECT session_id, created_at 
-            FROM chatlog 
-            ORDER BY created_at DESC 
-            LIMIT 1
-        ''')
-        row = cur.fetchone()
-        
-        if not row:
-            # Первое сообщение вообще
-            return True, current_session_id, 0
-        
-        last_session_id, last_created = row
-        
-        # 3. Проверяем, новая ли сессия
-        is_new_session = (last_session_id != current_session_id)
-        
-        # 4. Считаем разницу в часах
-        now = datetime.now()
-        hours_passed = int((now - last_created).total_seconds() / 3600) if last_created else 0
-        
-        return is_new_session, current_session_id, hours_passed
-        
-    finally:
-        conn.close()
+    is_new_session, current_session_id, last_activity = _db_session_resolve()
+    
+    if last_activity is None:
+        # Первое сообщение вообще
+        return True, current_session_id, 0
+    
+    hours_passed = int((datetime.now() - last_activity).total_seconds() / 3600)
+    return is_new_session, current_session_id, hours_passed
+
 
 def db_save_message(source: str, author: str, message: str, tag_weight: int = 2, tag_topics: list = None, session_id: int = None):
     """Сохраняет сообщение. Если session_id не указан — определяет автоматически.
     По умолчанию tag_weight=2 (для обычных сообщений).
     Для служебных сообщений передавать tag_weight=0.
+    Внутри db_message_batch() сообщение не пишется сразу, а попадает в пакет текущего потока.
     """
     if session_id is None:
         session_id = db_get_or_create_session_id()
     
-    conn = db_get_connection()
-    try:
+    batch = getattr(_batch_local, 'batch', None)
+    if batch is not None:
+        batch.add(source, author, message, tag_weight, tag_topics, session_id)
+        _db_session_touch(session_id, datetime.now())
+        log_system("debug", f"Сообщение добавлено в пакет (сессия {session_id}, автор {author})")
+        return
+    
+    with db_connection() as conn:
         cur = conn.cursor()
         if tag_topics is not None:
             cur.execute('''
                 INSERT INTO chatlog (source, author, message, session_id, tag_weight, tag_topics)
                 VALUES (%s, %s, %s, %s, %s, %s)
+                RETURNING id, created_at
             ''', (source, author, message, session_id, tag_weight, tag_topics))
         else:
             cur.execute('''
                 INSERT INTO chatlog (source, author, message, session_id, tag_weight)
                 VALUES (%s, %s, %s, %s, %s)
+                RETURNING id, created_at
             ''', (source, author, message, session_id, tag_weight))
+        message_id, created_at = cur.fetchone()
         
         conn.commit()
         log_system("info", f"Сообщение сохранено в БД (сессия {session_id}, автор {author})")
+    
+    _db_history_append([{
+        'id': message_id,
+        'source': source,
+        'author': author,
+        'message': message,
+        'created_at': created_at,
+        'tag_weight': tag_weight,
+        'tag_topics': tag_topics
+    }])
+    _db_session_touch(session_id, datetime.now())
+
+
+# ============ ПАКЕТНАЯ ЗАПИСЬ СООБЩЕНИЙ ============
+_batch_local = threading.local()
+
+
+class DbMessageBatch:
+    """
+    Пакет сообщений одного хода роутера (unit of work).
+    Строки копятся в памяти в порядке добавления и пишутся одним многострочным INSERT в одной транзакции.
+    created_at назначает БД (clock_timestamp() для каждой строки, а не часы процесса), при равном
+    времени порядок задаёт id — строки INSERT получают id в порядке добавления.
+    """
+    
+    def __init__(self):
+        self.rows = []
+    
+    def add(self, source: str, author: str, message: str, tag_weight: int, tag_topics: list, session_id: int) -> dict:
+        """Добавляет строку в пакет и возвращает её"""
+        row = {
+            'source': source,
+            'author': author,
+            'message': message,
+            'tag_weight': tag_weight,
+            'tag_topics': tag_topics,
+            'session_id': session_id,
+            'created_at': None,             # id и created_at станут известны после flush
+            'id': None
+        }
+        self.rows.append(row)
+        return row
+    
+    def flush(self) -> int:
+        """Пишет накопленные строки одним INSERT и одним commit. Возвращает число записанных строк"""
+        if not self.rows:
+            return 0
+        
+        rows, self.rows = self.rows, []
+        try:
+            with db_connection() as conn:
+                cur = conn.cursor()
+                inserted = psycopg2.extras.execute_values(cur, '''
+                    INSERT INTO chatlog (source, author, message, session_id, tag_weight, tag_topics, created_at)
+                    VALUES %s
+                    RETURNING id, created_at
+                ''', [
+                    (r['source'], r['author'], r['message'], r['session_id'], r['tag_weight'], r['tag_topics'])
+                    for r in rows
+                ], template='(%s, %s, %s, %s, %s, %s::text[], clock_timestamp())', page_size=len(rows), fetch=True)
+                conn.commit()
+        except Exception:
+            # Неизвестно, что успело попасть в БД, — кэш истории перечитается из неё
+            _db_history_invalidate()
+            raise
+        
+        for row, (message_id, created_at) in zip(rows, inserted):
+            row['id'] = message_id
+            row['created_at'] = created_at
+        _db_history_append(rows)
+        
+        log_system("info", f"Сохранено {len(rows)} сообщений в БД одной транзакцией (сессия {rows[-1]['session_id']})")
+        return len(rows)
+
+
+@contextmanager
+def db_message_batch():
+    """
+    Собирает все db_save_message текущего потока и пишет их одной транзакцией при выходе:
+
+        with db_message_batch():
+            db_save_message(...)
+            db_save_message(...)
+
+    Пакет сбрасывается и при исключении — уже принятые сообщения не теряются.
+    Пока пакет открыт, db_get_recent_messages в этом потоке видит и ещё не записанные строки.
+    Вложенный вызов использует внешний пакет.
+    """
+    batch = getattr(_batch_local, 'batch', None)
+    if batch is not None:
+        yield batch
+        return
+    
+    batch = DbMessageBatch()
+    _batch_local.batch = batch
+    try:
+        yield batch
     finally:
-        conn.close()
+        _batch_local.batch = None
+        batch.flush()
+
+
+# ============ КЭШ ПОСЛЕДНИХ СООБЩЕНИЙ ============
+class DbHistoryCache:
+    """
+    Последние db.history_cache_size сообщений chatlog в памяти процесса — история для промпта без запросов к БД.
+    Write-through: строка попадает в кэш после коммита (db_save_message, flush db_message_batch),
+    строки держатся в порядке created_at независимо от того, какой поток записал раньше.
+    Записи и тэгирование в других процессах подхватываются перечитыванием из БД
+    раз в db.history_cache_ttl_seconds; при ошибке записи пакета кэш сбрасывается.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rows = []              # по возрастанию (created_at, id)
+        self.loaded_at = None       # time.monotonic() последней загрузки из БД; None — не загружен
+
+
+_history_cache = DbHistoryCache()
+
+
+def _db_history_key(row):
+    # id — при равном created_at
+    return (row['created_at'], row['id'])
+
+
+def db_history_init():
+    """
+    Загружает последние сообщения из БД в кэш (при старте и по истечении TTL).
+    Строки, записанные этим процессом, пока шёл запрос, не теряются.
+    """
+    capacity = config_get('db.history_cache_size', 100)
+    if capacity <= 0:
+        return
+    
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute('''
+            SELECT id, source, author, message, created_at, tag_weight, tag_topics
+            FROM chatlog
+            ORDER BY created_at DESC, id DESC
+            LIMIT %s
+        ''', (capacity,))
+        rows = [dict(row) for row in reversed(cur.fetchall())]
+    
+    with _history_cache.lock:
+        loaded_ids = {row['id'] for row in rows}
+        oldest = rows[0]['created_at'] if len(rows) >= capacity else None
+        for row in _history_cache.rows:
+            # Записано после запроса — в выборку не попало
+            if row['id'] not in loaded_ids and (oldest is None or row['created_at'] > oldest):
+                bisect.insort(rows, row, key=_db_history_key)
+        _history_cache.rows = rows[-capacity:]
+        _history_cache.loaded_at = time.monotonic()
+    
+    log_system("debug", f"Кэш истории загружен из БД: {len(rows[-capacity:])} сообщений")
+
+
+def _db_history_append(rows: list):
+    """Добавляет записанные строки в кэш (по месту created_at), лишние старые отбрасывает"""
+    capacity = config_get('db.history_cache_size', 100)
+    if capacity <= 0:
+        return
+    
+    with _history_cache.lock:
+        for row in rows:
+            bisect.insort(_history_cache.rows, {
+                'id': row['id'],
+                'source': row['source'],
+                'author': row['author'],
+                'message': row['message'],
+                'created_at': row['created_at'],
+                'tag_weight': row['tag_weight'],
+                'tag_topics': row['tag_topics']
+            }, key=_db_history_key)
+        del _history_cache.rows[:-capacity]
+
+
+def _db_history_invalidate():
+    """Помечает кэш устаревшим: следующее чтение перезагрузит его из БД"""
+    with _history_cache.lock:
+        _history_cache.loaded_at = None
+
+
+def _db_history_update_tags(updates: list):
+    """Обновляет теги закэшированных сообщений. updates: кортежи (message_id, weight, topics)"""
+    tags = {message_id: (weight, topics) for message_id, weight, topics in updates}
+    with _history_cache.lock:
+        for row in _history_cache.rows:
+            if row['id'] in tags:
+                row['tag_weight'], row['tag_topics'] = tags[row['id']]
+
+
+def _db_history_get(limit: int):
+    """Последние limit сообщений из кэша (от новых к старым) или None, если кэш не годится"""
+    if limit > config_get('db.history_cache_size', 100):
+        return None
+    
+    ttl = config_get('db.history_cache_ttl_seconds', 300)
+    with _history_cache.lock:
+        loaded_at = _history_cache.loaded_at
+        if loaded_at is None or time.monotonic() - loaded_at > ttl:
+            return None
+        return [dict(row) for row in reversed(_history_cache.rows[-limit:])] if limit > 0 else []
+
+
+# ============ ВОДЯНЫЕ ЗНАКИ КОНВЕЙЕРА ============
+def db_get_pipeline_watermark(conn, stage: str) -> int:
+    """Возвращает последний обработанный ID для этапа конвейера ('chunking'), 0 если записи нет"""
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT last_id FROM pipeline_state WHERE stage = %s
+    ''', (stage,))
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+def db_set_pipeline_watermark(conn, stage: str, last_id: int):
+    """
+    Сдвигает водяной знак этапа вперёд (назад не двигает).
+    Вызывается в той же транзакции, что и запись результата этапа.
+    """
+    cur = conn.cursor()
+    cur.execute('''
+        INSERT INTO pipeline_state (stage, last_id, updated_at)
+        VALUES (%s, %s, NOW())
+        ON CONFLICT (stage) DO UPDATE
+        SET last_id = GREATEST(pipeline_state.last_id, EXCLUDED.last_id),
+            updated_at = NOW()
+    ''', (stage, last_id))
+
+# ============ АРЕНДА ЗАДАЧ КОНВЕЙЕРА ============
+_CHUNKING_LOCK_KEY = 4_711_003      # advisory-блокировка транзакции: чанкует только один процесс
+
+def db_lease_owner() -> str:
+    """Идентификатор владельца аренды: хост:pid:поток"""
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+
+def _db_claim(conn, stage: str, candidates_sql: str, params: dict) -> list:
+    """
+    Захватывает элементы этапа конвейера в аренду (pipeline_leases).
+    candidates_sql выбирает id кандидатов (с FOR UPDATE SKIP LOCKED и без действующих аренд этапа);
+    аренда пишется на memory.worker.lease_seconds. Просроченная чужая аренда перехватывается.
+    Возвращает захваченные id. Аренда видна другим процессам после коммита транзакции.
+    """
+    lease_seconds = config_get('memory.worker.lease_seconds', 600)
+    
+    cur = conn.cursor()
+    cur.execute(f'''
+        WITH candidates AS ({candidates_sql})
+        INSERT INTO pipeline_leases (stage, item_id, owner, lease_until)
+        SELECT %(stage)s, id, %(owner)s, NOW() + %(lease_seconds)s * INTERVAL '1 second'
+        FROM candidates
+        ON CONFLICT (stage, item_id) DO UPDATE
+        SET owner = EXCLUDED.owner,
+            lease_until = EXCLUDED.lease_until
+        WHERE pipeline_leases.lease_until <= NOW()
+        RETURNING item_id
+    ''', {**params, 'stage': stage, 'owner': db_lease_owner(), 'lease_seconds': lease_seconds})
+    return [row[0] for row in cur.fetchall()]
+
+def db_release_leases(conn, stage: str, item_ids: list):
+    """Снимает аренду с обработанных элементов (в той же транзакции, что и запись результата)"""
+    if not item_ids:
+        return
+    cur = conn.cursor()
+    cur.execute('''
+        DELETE FROM pipeline_leases
+        WHERE stage = %s AND item_id = ANY(%s)
+    ''', (stage, list(item_ids)))
+
+def db_try_lock_chunking(conn) -> bool:
+    """Берёт advisory-блокировку чанкования до конца транзакции. False — чанкует другой процесс"""
+    cur = conn.cursor()
+    cur.execute('SELECT pg_try_advisory_xact_lock(%s)', (_CHUNKING_LOCK_KEY,))
+    return cur.fetchone()[0]
 
 # ============ ФУНКЦИИ ДЛЯ ТЕГИРОВАНИЯ ============
-def db_get_untagged_messages(conn, limit: int = 10):
+def db_claim_untagged_messages(conn, limit: int = 10):
     """
-    Возвращает сообщения без тегов (tag_weight IS NULL)
-    Возвращает список словарей с ключами: id, source, author, message
+    Захватывает в аренду (этап 'tagging') до limit самых старых нетэгированных сообщений,
+    которые не обрабатывает другой процесс. Ключи: id, source, author, message
     """
+    claimed = _db_claim(conn, 'tagging', '''
+        SELECT c.id
+        FROM chatlog c
+        WHERE c.tag_weight IS NULL
+          AND NOT EXISTS (
+              SELECT 1 FROM pipeline_leases l
+              WHERE l.stage = %(stage)s AND l.item_id = c.id AND l.lease_until > NOW()
+          )
+        ORDER BY c.created_at ASC, c.id ASC
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    ''', {'limit': limit})
+    if not claimed:
+        return []
+    
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
     cur.execute('''
         SELECT id, source, author, message
         FROM chatlog
-        WHERE tag_weight IS NULL
-        ORDER BY created_at ASC
-        LIMIT %s
-    ''', (limit,))
-    
-    rows = cur.fetchall()
-    # Преобразуем в список словарей для удобства
-    return [dict(row) for row in rows]
+        WHERE id = ANY(%s)
+        ORDER BY created_at ASC, id ASC
+    ''', (claimed,))
+    return [dict(row) for row in cur.fetchall()]
 
-def db_update_message_tags(conn, message_id: int, weight: int, topics: list):
+def db_update_messages_tags(conn, updates: list) -> int:
     """
-    Обновляет теги сообщения.
+    Обновляет теги пачки сообщений одним UPDATE ... FROM (VALUES ...).
+    updates: список кортежей (message_id, weight, topics)
+    Возвращает количество обновлённых строк.
     """
+    if not updates:
+        return 0
+    
     cur = conn.cursor()
-    cur.execute('''
-        UPDATE chatlog
-        SET tag_weight = %s, tag_topics = %s
-        WHERE id = %s
-    ''', (weight, topics, message_id))
+    updated = psycopg2.extras.execute_values(cur, '''
+        UPDATE chatlog AS c
+        SET tag_weight = v.weight, tag_topics = v.topics
+        FROM (VALUES %s) AS v(id, weight, topics)
+        WHERE c.id = v.id
+        RETURNING c.id
+    ''', updates, template='(%s::integer, %s::integer, %s::text[])', page_size=len(updates), fetch=True)
     
-    # Проверяем, что обновили именно одну строку
-    if cur.rowcount != 1:
-        log_system("warning", f"Обновлено {cur.rowcount} строк вместо 1 для message_id={message_id}")
+    # Проверяем, что каждое сообщение обновлено ровно один раз
+    updated_ids = [row[0] for row in updated]
+    if len(updated_ids) != len(updates):
+        missing = sorted({u[0] for u in updates} - set(updated_ids))
+        log_system("warning", f"Обновлено {len(updated_ids)} строк вместо {len(updates)}, не найдены message_id={missing}")
+    
+    if updated_ids:
+        _db_history_update_tags(updates)
+    return len(updated_ids)
 
 def db_get_recent_messages(limit: int = 10):
-    """Возвращает последние limit сообщений из chatlog"""
-    conn = db_get_connection()
-    try:
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cur.execute('''
-            SELECT source, author, message, created_at, tag_topics
-            FROM chatlog
-            ORDER BY created_at DESC
-            LIMIT %s
-        ''', (limit,))
-        rows = cur.fetchall()
-        return rows
-    finally:
-        conn.close()
+    """
+    Возвращает последние limit сообщений из chatlog (от новых к старым).
+    Ключи: id, source, author, message, created_at, tag_weight, tag_topics.
+    Берёт их из кэша истории; если кэш не загружен или устарел — перечитывает его,
+    если limit больше кэша — читает из БД напрямую.
+    Учитывает ещё не записанные сообщения из открытого db_message_batch() текущего потока (id = None).
+    """
+    rows = _db_history_get(limit)
+    if rows is None and limit <= config_get('db.history_cache_size', 100):
+        db_history_init()
+        rows = _db_history_get(limit)
+    
+    if rows is None:
+        with db_connection() as conn:
+            cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            cur.execute('''
+                SELECT id, source, author, message, created_at, tag_weight, tag_topics
+                FROM chatlog
+                ORDER BY created_at DESC, id DESC
+                LIMIT %s
+            ''', (limit,))
+            rows = [dict(row) for row in cur.fetchall()]
+    
+    batch = getattr(_batch_local, 'batch', None)
+    if batch is not None and batch.rows:
+        pending = [dict(r) for r in reversed(batch.rows)]
+        rows = (pending + list(rows))[:limit]
+    return rows
 
 def db_count_untagged_messages():
     """Возвращает количество нетэгированных сообщений"""
-    conn = db_get_connection()
-    try:
+    with db_connection() as conn:
         cur = conn.cursor()
         cur.execute('''
             SELECT COUNT(*) FROM chatlog 
             WHERE tag_weight IS NULL
         ''')
         return cur.fetchone()[0]
-    finally:
-        conn.close()
+
+def db_get_oldest_untagged_age():
+    """Возвращает возраст (в секундах) самого старого нетэгированного сообщения, None — если таких нет"""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            SELECT EXTRACT(EPOCH FROM NOW() - MIN(created_at))
+            FROM chatlog
+            WHERE tag_weight IS NULL
+        ''')
+        age = cur.fetchone()[0]
+        return float(age) if age is not None else None
+
+# ============ ПОВТОРНОЕ ТЕГИРОВАНИЕ ============
+def db_schedule_tagging_retries(conn, failures: list, base_delay: int, max_delay: int):
+    """
+    Ставит сообщения в очередь повторного тэгирования (или переносит следующую попытку).
+    failures: список кортежей (message_id, error). Задержка растёт экспоненциально:
+    base_delay * 2^(attempts - 1) секунд, но не больше max_delay.
+    """
+    if not failures:
+        return
+    
+    cur = conn.cursor()
+    psycopg2.extras.execute_values(cur, '''
+        INSERT INTO tagging_retries (message_id, attempts, next_attempt_at, last_error, updated_at)
+        SELECT v.message_id,
+               COALESCE(r.attempts, 0) + 1,
+               NOW() + LEAST(v.max_delay, v.base_delay * POWER(2, COALESCE(r.attempts, 0))) * INTERVAL '1 second',
+               v.error,
+               NOW()
+        FROM (VALUES %s) AS v(message_id, error, base_delay, max_delay)
+        LEFT JOIN tagging_retries r ON r.message_id = v.message_id
+        ON CONFLICT (message_id) DO UPDATE
+        SET attempts = EXCLUDED.attempts,
+            next_attempt_at = EXCLUDED.next_attempt_at,
+            last_error = EXCLUDED.last_error,
+            updated_at = NOW()
+    ''', [(message_id, error, base_delay, max_delay) for message_id, error in failures],
+    template='(%s::integer, %s::text, %s::integer, %s::integer)', page_size=len(failures))
+
+def db_clear_tagging_retries(conn, message_ids: list):
+    """Убирает успешно протэгированные сообщения из очереди повторов"""
+    if not message_ids:
+        return
+    cur = conn.cursor()
+    cur.execute('''
+        DELETE FROM tagging_retries WHERE message_id = ANY(%s)
+    ''', (list(message_ids),))
+
+def db_claim_due_tagging_retries(conn, limit: int, max_attempts: int):
+    """
+    Захватывает в аренду (этап 'tagging_retry') повторы, чей срок наступил.
+    Ключи: id, source, author, message, attempts
+    """
+    claimed = _db_claim(conn, 'tagging_retry', '''
+        SELECT r.message_id AS id
+        FROM tagging_retries r
+        WHERE r.next_attempt_at <= NOW()
+          AND r.attempts < %(max_attempts)s
+          AND NOT EXISTS (
+              SELECT 1 FROM pipeline_leases l
+              WHERE l.stage = %(stage)s AND l.item_id = r.message_id AND l.lease_until > NOW()
+          )
+        ORDER BY r.next_attempt_at ASC
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    ''', {'limit': limit, 'max_attempts': max_attempts})
+    if not claimed:
+        return []
+    
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    cur.execute('''
+        SELECT c.id, c.source, c.author, c.message, r.attempts
+        FROM tagging_retries r
+        JOIN chatlog c ON c.id = r.message_id
+        WHERE r.message_id = ANY(%s)
+        ORDER BY r.next_attempt_at ASC
+    ''', (claimed,))
+    return [dict(row) for row in cur.fetchall()]
+
+def db_count_tagging_retries(max_attempts: int) -> dict:
+    """Возвращает размер очереди повторов: due — пора повторять, waiting — ждут срока, exhausted — попытки исчерпаны"""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            SELECT
+                COUNT(*) FILTER (WHERE attempts < %s AND next_attempt_at <= NOW()),
+                COUNT(*) FILTER (WHERE attempts < %s AND next_attempt_at > NOW()),
+                COUNT(*) FILTER (WHERE attempts >= %s)
+            FROM tagging_retries
+        ''', (max_attempts, max_attempts, max_attempts))
+        due, waiting, exhausted = cur.fetchone()
+    return {'due': due, 'waiting': waiting, 'exhausted': exhausted}
 
 # ============ ФУНКЦИИ ДЛЯ ЧАНКОВАНИЯ ============
 def db_count_unchunked_messages():
-    """Возвращает количество сообщений, готовых для чанкования (tag_weight >= 1)"""
-    conn = db_get_connection()
-    try:
+    """Возвращает количество сообщений после водяного знака чанкования, готовых для окон (tag_weight >= 1)"""
+    with db_connection() as conn:
         cur = conn.cursor()
         # Находим последний зачанкованный ID
         last_id = db_get_last_chunked_message_id(conn)
@@ -244,28 +851,25 @@ def db_count_unchunked_messages():
             SELECT COUNT(*) 
             FROM chatlog 
             WHERE id > %s AND tag_weight >= 1
-        ''', (last_id,))
+              AND id < (
+                  SELECT COALESCE(MIN(id), 2147483647)
+                  FROM chatlog WHERE tag_weight IS NULL AND id > %s
+              )
+        ''', (last_id, last_id))
         
         return cur.fetchone()[0]
-    finally:
-        conn.close()
 
 def db_get_last_chunked_message_id(conn):
-    """Возвращает максимальный ID сообщения из последнего чанка, или 0 если чанков нет"""
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT message_ids[array_length(message_ids, 1)]
-        FROM chunks 
-        ORDER BY created_at DESC 
-        LIMIT 1
-    ''')
-    row = cur.fetchone()
-    return row[0] if row and row[0] is not None else 0
+    """
+    Возвращает водяной знак 'chunking': ID последнего сообщения, с которого уже начиналось окно чанка.
+    Следующее окно начинается с первого готового сообщения после него; 0 если чанков нет.
+    """
+    return db_get_pipeline_watermark(conn, 'chunking')
 
 def db_get_unchunked_messages(conn, limit: int):
     """
-    Возвращает сообщения, которых нет в чанках и с tag_weight >= 1.
-    Берёт начиная с последнего зачанкованного ID.
+    Возвращает сообщения с tag_weight >= 1 после водяного знака чанкования — начало следующего окна.
+    Берёт только до первого ещё не протэгированного сообщения.
     """
     last_id = db_get_last_chunked_message_id(conn)
     
@@ -275,55 +879,396 @@ def db_get_unchunked_messages(conn, limit: int):
         FROM chatlog
         WHERE id > %s 
           AND tag_weight >= 1
+          -- не перескакиваем ещё не протэгированные сообщения: водяной знак уйдёт дальше,
+          -- и они никогда не попадут в чанк
+          AND id < (
+              SELECT COALESCE(MIN(id), 2147483647)
+              FROM chatlog WHERE tag_weight IS NULL AND id > %s
+          )
         ORDER BY id ASC
         LIMIT %s
-    ''', (last_id, limit))
+    ''', (last_id, last_id, limit))
     
     rows = cur.fetchall()
     return [dict(row) for row in rows]
 
-def db_save_chunk(conn, chunk_text: str, message_ids: list):
-    """Сохраняет новый чанк"""
+def db_content_hash(text: str) -> str:
+    """sha256 текста чанка (hex) — ключ дедупликации эмбеддингов"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def db_save_chunks(conn, chunks: list, last_message_id: int) -> list:
+    """
+    Сохраняет пачку чанков одним INSERT (с content_hash текста) и сдвигает водяной знак 'chunking' в той же транзакции.
+    chunks — список (chunk_text, message_ids, token_count); last_message_id — последнее сообщение,
+    с которого окна уже начинались (следующее окно начнётся после него). Возвращает ID чанков.
+    """
+    if not chunks:
+        return []
+    
     cur = conn.cursor()
-    cur.execute('''
-        INSERT INTO chunks (chunk_text, message_ids, created_at)
-        VALUES (%s, %s, NOW())
+    rows = psycopg2.extras.execute_values(cur, '''
+        INSERT INTO chunks (chunk_text, message_ids, token_count, content_hash, created_at)
+        VALUES %s
         RETURNING id
-    ''', (chunk_text, message_ids))
+    ''', [(text, ids, tokens, db_content_hash(text)) for text, ids, tokens in chunks],
+    template='(%s, %s::integer[], %s, %s, clock_timestamp())', page_size=len(chunks), fetch=True)
     
-    chunk_id = cur.fetchone()[0]
-    log_system("info", f"Сохранён чанк {chunk_id} с {len(message_ids)} сообщениями")
-    return chunk_id     
+    chunk_ids = [row[0] for row in rows]
+    db_set_pipeline_watermark(conn, 'chunking', last_message_id)
+    log_system("info", f"Сохранено чанков: {len(chunk_ids)} (водяной знак чанкования {last_message_id})")
+    return chunk_ids
 
 # ============ ФУНКЦИИ ДЛЯ ВЕКТОРИЗАЦИИ ============
-def db_get_chunks_without_embeddings(conn, limit: int = 10):
+def db_claim_chunks_without_embeddings(conn, limit: int = 10):
     """
-    Возвращает чанки без эмбеддингов (embedding IS NULL)
+    Захватывает в аренду (этап 'embedding') до limit самых старых чанков без эмбеддингов,
+    которые не векторизует другой процесс. Ключи: id, chunk_text, message_ids, token_count, content_hash
     """
+    claimed = _db_claim(conn, 'embedding', '''
+        SELECT ch.id
+        FROM chunks ch
+        WHERE ch.embedding IS NULL
+          AND NOT EXISTS (
+              SELECT 1 FROM pipeline_leases l
+              WHERE l.stage = %(stage)s AND l.item_id = ch.id AND l.lease_until > NOW()
+          )
+        ORDER BY ch.created_at ASC
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    ''', {'limit': limit})
+    if not claimed:
+        return []
+    
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
     cur.execute('''
-        SELECT id, chunk_text, message_ids
+        SELECT id, chunk_text, message_ids, token_count, content_hash
         FROM chunks
-        WHERE embedding IS NULL
+        WHERE id = ANY(%s)
         ORDER BY created_at ASC
+    ''', (claimed,))
+    return [dict(row) for row in cur.fetchall()]
+
+def db_update_chunk_embeddings(conn, items: list, model_key: str = None) -> Optional[int]:
+    """
+    Обновляет эмбеддинги пачки чанков одним UPDATE ... FROM (VALUES ...).
+    items: список кортежей (chunk_id, embedding). Пишет только в чанки, у которых эмбеддинга ещё нет.
+    model_key — модель, которой посчитаны векторы: если в той же транзакции оказывается, что
+    действующая модель уже другая (backfill.py переключил чанки, пока шёл запрос к API), запись откатывается.
+    Возвращает количество обновлённых строк; None — модель сменилась и ничего не записано.
+    """
+    if not items:
+        return 0
+    
+    cur = conn.cursor()
+    # UPDATE берёт блокировку chunks, конфликтующую с db_backfill_switch: переключение либо уже
+    # закоммичено (и видно проверке ниже), либо ждёт конца этой транзакции
+    updated = psycopg2.extras.execute_values(cur, '''
+        UPDATE chunks AS c
+        SET embedding = v.embedding
+        FROM (VALUES %s) AS v(id, embedding)
+        WHERE c.id = v.id
+          AND c.embedding IS NULL
+        RETURNING c.id
+    ''', items, template='(%s::integer, %s::vector)', page_size=len(items), fetch=True)
+    
+    if model_key is not None:
+        settings = _db_read_embedding_settings(conn)
+        current_key = db_embedding_model_key(settings['model'], settings['dimensions'])
+        if current_key != model_key:
+            conn.rollback()
+            log_system("warning", f"Модель эмбеддингов сменилась ({model_key} -> {current_key}), векторы {len(items)} чанков не записаны")
+            return None
+    
+    updated_ids = [row[0] for row in updated]
+    if len(updated_ids) != len(items):
+        skipped = sorted({item[0] for item in items} - set(updated_ids))
+        log_system("warning", f"Обновлено {len(updated_ids)} строк вместо {len(items)}, уже векторизованы или не найдены chunk_id={skipped}")
+    return len(updated_ids)
+
+
+# ============ ПЕРЕВЕКТОРИЗАЦИЯ (BACKFILL) ============
+_embedding_settings = {'value': None, 'loaded_at': None}
+_embedding_settings_lock = threading.Lock()
+
+
+def _db_read_embedding_settings(conn) -> dict:
+    """Читает действующие параметры эмбеддингов из БД в транзакции conn (без кэша)"""
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT model, dimensions
+        FROM embedding_backfill
+        WHERE status = 'switched'
+        ORDER BY switched_at DESC
+        LIMIT 1
+    ''')
+    row = cur.fetchone()
+    
+    if row:
+        return {'model': row[0], 'dimensions': row[1]}
+    return {'model': config_get('memory.embedding_model', 'text-embedding-3-small'), 'dimensions': None}
+
+def db_get_embedding_settings(refresh: bool = False) -> dict:
+    """
+    Возвращает действующие параметры эмбеддингов чанков: {'model', 'dimensions'}.
+    После переключения backfill.py — модель последней завершённой перевекторизации,
+    иначе memory.embedding_model из конфига (dimensions = None — размерность модели по умолчанию).
+    Кэшируется в памяти процесса на db.embedding_settings_ttl_seconds: переключение в другом процессе
+    подхватывается не позже чем через TTL. refresh=True — прочитать из БД сейчас.
+    """
+    ttl = config_get('db.embedding_settings_ttl_seconds', 60)
+    with _embedding_settings_lock:
+        cached = _embedding_settings['value']
+        loaded_at = _embedding_settings['loaded_at']
+    if not refresh and cached is not None and time.monotonic() - loaded_at < ttl:
+        return dict(cached)
+    
+    with db_connection() as conn:
+        settings = _db_read_embedding_settings(conn)
+    
+    with _embedding_settings_lock:
+        _embedding_settings['value'] = settings
+        _embedding_settings['loaded_at'] = time.monotonic()
+    return dict(settings)
+
+def db_embedding_model_key(model: str, dimensions: int = None) -> str:
+    """Ключ модели для кэшей векторов: укороченные векторы той же модели хранятся отдельно"""
+    return f"{model}/{dimensions}" if dimensions else model
+
+def db_backfill_get_running(conn):
+    """Возвращает незавершённую перевекторизацию (id, model, dimensions, vector_size, started_at) или None"""
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    cur.execute('''
+        SELECT id, model, dimensions, vector_size, started_at
+        FROM embedding_backfill
+        WHERE status = 'running'
+    ''')
+    row = cur.fetchone()
+    return dict(row) if row else None
+
+def db_backfill_start(model: str, dimensions: int, vector_size: int) -> dict:
+    """
+    Начинает перевекторизацию: журнальная запись + теневая колонка chunks.embedding_new vector(vector_size).
+    Если незавершённая перевекторизация с теми же параметрами уже есть — продолжает её.
+    """
+    with db_connection() as conn:
+        running = db_backfill_get_running(conn)
+        if running:
+            if running['model'] != model or running['dimensions'] != dimensions:
+                raise RuntimeError(
+                    f"Уже идёт перевекторизация {running['model']} (dimensions={running['dimensions']}), "
+                    f"запустите с теми же параметрами или отмените её (--abort)"
+                )
+            log_system("info", f"Продолжаем перевекторизацию #{running['id']} от {running['started_at']}")
+            return running
+        
+        cur = conn.cursor()
+        cur.execute('ALTER TABLE chunks DROP COLUMN IF EXISTS embedding_new')
+        cur.execute(f'ALTER TABLE chunks ADD COLUMN embedding_new vector({int(vector_size)})')
+        cur.execute('''
+            INSERT INTO embedding_backfill (model, dimensions, vector_size)
+            VALUES (%s, %s, %s)
+            RETURNING id
+        ''', (model, dimensions, vector_size))
+        backfill_id = cur.fetchone()[0]
+        running = db_backfill_get_running(conn)
+    
+    log_system("info", f"Начата перевекторизация #{backfill_id}: {model}, векторы {vector_size}")
+    return running
+
+def db_backfill_abort():
+    """Отменяет незавершённую перевекторизацию и удаляет теневую колонку"""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            UPDATE embedding_backfill
+            SET status = 'aborted', updated_at = NOW()
+            WHERE status = 'running'
+            RETURNING id
+        ''')
+        aborted = [row[0] for row in cur.fetchall()]
+        cur.execute('ALTER TABLE chunks DROP COLUMN IF EXISTS embedding_new')
+    return aborted
+
+def db_backfill_progress(conn) -> tuple:
+    """Возвращает (всего чанков, уже перевекторизовано)"""
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT COUNT(*), COUNT(embedding_new) FROM chunks
+    ''')
+    return cur.fetchone()
+
+def db_backfill_get_pending(conn, after_id: int, limit: int):
+    """
+    Возвращает чанки без embedding_new с id > after_id (по возрастанию id).
+    Ключи: id, chunk_text, token_count, content_hash
+    """
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    cur.execute('''
+        SELECT id, chunk_text, token_count, content_hash
+        FROM chunks
+        WHERE embedding_new IS NULL
+          AND id > %s
+        ORDER BY id ASC
         LIMIT %s
-    ''', (limit,))
+    ''', (after_id, limit))
+    return [dict(row) for row in cur.fetchall()]
+
+def db_backfill_save(conn, items: list) -> int:
+    """
+    Записывает новые эмбеддинги в теневую колонку одним UPDATE ... FROM (VALUES ...).
+    items: список кортежей (chunk_id, embedding). Возвращает количество обновлённых строк.
+    """
+    if not items:
+        return 0
     
-    rows = cur.fetchall()
-    return [dict(row) for row in rows]
+    cur = conn.cursor()
+    updated = psycopg2.extras.execute_values(cur, '''
+        UPDATE chunks AS c
+        SET embedding_new = v.embedding
+        FROM (VALUES %s) AS v(id, embedding)
+        WHERE c.id = v.id
+        RETURNING c.id
+    ''', items, template='(%s::integer, %s::vector)', page_size=len(items), fetch=True)
+    
+    cur.execute('''
+        UPDATE embedding_backfill SET updated_at = NOW() WHERE status = 'running'
+    ''')
+    return len(updated)
+
+def db_backfill_switch(backfill_id: int) -> bool:
+    """
+    Атомарно переключает чанки на новые эмбеддинги: embedding_new становится embedding.
+    Таблица блокируется от записи, и если за это время появились чанки без embedding_new —
+    возвращает False (их нужно довекторизовать и повторить). Старый ANN-индекс удаляется вместе
+    с колонкой; новый строит vi_maintain_index().
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        # Вставки и обновления чанков ждут конца транзакции — новых чанков без embedding_new не появится
+        cur.execute('LOCK TABLE chunks IN SHARE ROW EXCLUSIVE MODE')
+        cur.execute('SELECT COUNT(*) FROM chunks WHERE embedding_new IS NULL')
+        if cur.fetchone()[0]:
+            conn.rollback()
+            return False
+        
+        cur.execute('ALTER TABLE chunks DROP COLUMN embedding')
+        cur.execute('ALTER TABLE chunks RENAME COLUMN embedding_new TO embedding')
+        # Частичный индекс очереди векторизации удалился вместе со старой колонкой
+        cur.execute('''
+            CREATE INDEX IF NOT EXISTS idx_chunks_without_embedding
+            ON chunks (created_at)
+            WHERE embedding IS NULL
+        ''')
+        cur.execute('DELETE FROM vector_index_state')
+        cur.execute('''
+            UPDATE embedding_backfill
+            SET status = 'switched', switched_at = NOW(), updated_at = NOW()
+            WHERE id = %s
+        ''', (backfill_id,))
+    
+    with _embedding_settings_lock:
+        _embedding_settings['value'] = None
+    log_system("info", f"Перевекторизация #{backfill_id}: чанки переключены на новые эмбеддинги")
+    return True
+
 
-def db_update_chunk_embedding(conn, chunk_id: int, embedding: list):
+# ============ ХРАНИЛИЩЕ ЭМБЕДДИНГОВ (ДЕДУПЛИКАЦИЯ) ============
+def db_get_stored_embeddings(conn, content_hashes: list, model_key: str) -> dict:
+    """Ищет векторы в embedding_store по хэшам текста и сразу отмечает попадания. Возвращает {content_hash: embedding}"""
+    if not content_hashes:
+        return {}
+    cur = conn.cursor()
+    cur.execute('''
+        UPDATE embedding_store
+        SET hits = hits + 1, last_used_at = NOW()
+        WHERE model = %s AND content_hash = ANY(%s)
+        RETURNING content_hash, embedding::real[]
+    ''', (model_key, list(content_hashes)))
+    return {row[0]: list(row[1]) for row in cur.fetchall()}
+
+def db_save_stored_embeddings(conn, items: list, model_key: str):
+    """Сохраняет новые векторы в embedding_store. items: список кортежей (content_hash, embedding)"""
+    if not items:
+        return
+    cur = conn.cursor()
+    psycopg2.extras.execute_values(cur, '''
+        INSERT INTO embedding_store (content_hash, model, embedding)
+        VALUES %s
+        ON CONFLICT (content_hash, model) DO NOTHING
+    ''', [(content_hash, model_key, embedding) for content_hash, embedding in items],
+    template='(%s, %s, %s::vector)', page_size=len(items))
+
+def db_get_chunk_embeddings_by_hash(conn, content_hashes: list, column: str = 'embedding') -> dict:
     """
-    Обновляет эмбеддинг чанка.
-    embedding: список из 1536 float
+    Ищет готовые векторы у уже векторизованных чанков с тем же текстом (idx_chunks_content_hash).
+    column — 'embedding' (действующая модель) или 'embedding_new' (идущая перевекторизация).
+    Возвращает {content_hash: embedding}
     """
+    if column not in ('embedding', 'embedding_new'):
+        raise ValueError(f"Неизвестная колонка эмбеддингов: {column}")
+    if not content_hashes:
+        return {}
+    cur = conn.cursor()
+    cur.execute(f'''
+        SELECT DISTINCT ON (content_hash) content_hash, {column}::real[]
+        FROM chunks
+        WHERE content_hash = ANY(%s)
+          AND {column} IS NOT NULL
+    ''', (list(content_hashes),))
+    return {row[0]: list(row[1]) for row in cur.fetchall()}
+
+def db_add_embedding_dedup_stats(conn, model_key: str, stats: dict):
+    """Прибавляет счётчики дедупликации (store_hits, chunk_reuses, batch_duplicates, embedded, tokens_saved) к итогам модели"""
     cur = conn.cursor()
-    # Преобразуем список в PostgreSQL vector
     cur.execute('''
-        UPDATE chunks
-        SET embedding = %s
-        WHERE id = %s
-    ''', (embedding, chunk_id))
+        INSERT INTO embedding_dedup_stats (model, store_hits, chunk_reuses, batch_duplicates, embedded, tokens_saved, updated_at)
+        VALUES (%(model)s, %(store_hits)s, %(chunk_reuses)s, %(batch_duplicates)s, %(embedded)s, %(tokens_saved)s, NOW())
+        ON CONFLICT (model) DO UPDATE
+        SET store_hits = embedding_dedup_stats.store_hits + EXCLUDED.store_hits,
+            chunk_reuses = embedding_dedup_stats.chunk_reuses + EXCLUDED.chunk_reuses,
+            batch_duplicates = embedding_dedup_stats.batch_duplicates + EXCLUDED.batch_duplicates,
+            embedded = embedding_dedup_stats.embedded + EXCLUDED.embedded,
+            tokens_saved = embedding_dedup_stats.tokens_saved + EXCLUDED.tokens_saved,
+            updated_at = NOW()
+    ''', {**stats, 'model': model_key})
+
+def db_embedding_dedup_report(model_key: str) -> dict:
+    """
+    Отчёт о дедупликации для model_key: чанков, уникальных текстов, векторов в embedding_store и его размер на диске
+    (хранилище — дополнительная копия векторов, chunks.embedding хранит свою у каждого чанка),
+    накопленные счётчики из embedding_dedup_stats (сэкономленные запросы к API).
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            SELECT COUNT(*), COUNT(DISTINCT content_hash)
+            FROM chunks
+        ''')
+        chunks_total, unique_texts = cur.fetchone()
+        cur.execute('''
+            SELECT COUNT(*), pg_total_relation_size('embedding_store')
+            FROM embedding_store
+            WHERE model = %s
+        ''', (model_key,))
+        stored, store_bytes = cur.fetchone()
+        cur.execute('''
+            SELECT store_hits, chunk_reuses, batch_duplicates, embedded, tokens_saved
+            FROM embedding_dedup_stats
+            WHERE model = %s
+        ''', (model_key,))
+        row = cur.fetchone() or (0, 0, 0, 0, 0)
     
-    if cur.rowcount != 1:
-        log_system("warning", f"Обновлено {cur.rowcount} строк вместо 1 для chunk_id={chunk_id}")
\ No newline at end of file
+    store_hits, chunk_reuses, batch_duplicates, embedded, tokens_saved = row
+    reused = store_hits + chunk_reuses + batch_duplicates
+    return {
+        'chunks': chunks_total,
+        'unique_texts': unique_texts,
+        'stored_vectors': stored,
+        'store_bytes': store_bytes,
+        'store_hits': store_hits,
+        'chunk_reuses': chunk_reuses,
+        'batch_duplicates': batch_duplicates,
+        'embedded': embedded,
+        'tokens_saved': tokens_saved,
+        'saved_rate': reused / (reused + embedded) if reused + embedded else 0.0
+    }
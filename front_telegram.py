@@ -1,13 +1,16 @@
 # front_telegram.py
 
 import os
+import time
 import asyncio
+import threading
 
 from telegram.ext import Application, MessageHandler, filters
 
 import router
 from logger import setup_logging, log_system
 from security import security
+from config_loader import config_get
 # from config_loader import config_get_aliases
 
 # alias_user, alias_ai = config_get_aliases()
@@ -24,6 +27,98 @@ def tg_init_bot():
     log_system("info", f"Telegram бот инициализирован, токен: {token[:11]}...")
     return Application.builder().token(token).build()
 
+_TG_MESSAGE_LIMIT = 4096      # максимальная длина сообщения Telegram
+
+
+def _tg_split_text(text: str, limit: int = _TG_MESSAGE_LIMIT) -> list:
+    """Делит длинный текст на части не длиннее limit, по возможности по переносам строк"""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    if text:
+        parts.append(text)
+    return parts
+
+
+class TgStreamWriter:
+    """
+    Потоковая выдача ответа в Telegram для router.route_message(stream=...).
+    Методы вызываются из потока роутера: delta(text) дописывает текущее сообщение,
+    complete(text) фиксирует его окончательный текст, следующий delta начинает новое.
+    Текст показывается первым сообщением и дальше правится через edit_text
+    не чаще раза в telegram.stream_edit_interval_seconds.
+    """
+    
+    def __init__(self, message, loop):
+        self.message = message              # входящее сообщение: ответы идут reply_text на него
+        self.loop = loop
+        self.interval = config_get('telegram.stream_edit_interval_seconds', 1.0)
+        self.lock = threading.Lock()
+        self.text = ""                      # накопленный текст текущего сообщения
+        self.last_flush = 0.0
+        self.futures = []
+        self.delivered = 0
+        self.failed = False                 # какая-то отправка или правка не прошла — ответ мог дойти не целиком
+        self._async_lock = asyncio.Lock()
+        self._sent = None                   # отправленное сообщение Telegram текущего ответа
+        self._sent_text = ""
+    
+    def delta(self, text: str):
+        with self.lock:
+            self.text += text
+            now = time.monotonic()
+            if now - self.last_flush < self.interval:
+                return
+            self.last_flush = now
+            self._schedule(self._flush(self.text, final=False))
+    
+    def complete(self, text: str):
+        with self.lock:
+            self._schedule(self._flush(text, final=True))
+            self.text = ""
+            self.last_flush = 0.0
+    
+    def _schedule(self, coro):
+        self.futures.append(asyncio.run_coroutine_threadsafe(coro, self.loop))
+    
+    async def _flush(self, text: str, final: bool):
+        """Отправляет или правит текущее сообщение (корутины выполняются по очереди)"""
+        async with self._async_lock:
+            try:
+                parts = _tg_split_text(text.strip())
+                if not parts:
+                    # Ответ целиком оказался служебным (например, только <SEARCH>) — убираем черновик
+                    if final and self._sent is not None:
+                        await self._sent.delete()
+                elif self._sent is None:
+                    self._sent = await self.message.reply_text(parts[0])
+                    self._sent_text = parts[0]
+                elif parts[0] != self._sent_text:
+                    await self._sent.edit_text(parts[0])
+                    self._sent_text = parts[0]
+                
+                if final:
+                    # Хвост длинного ответа — отдельными сообщениями
+                    for part in parts[1:]:
+                        await self.message.reply_text(part)
+                    if parts:
+                        self.delivered += 1
+                    self._sent = None
+                    self._sent_text = ""
+            except Exception as e:
+                self.failed = True
+                log_system("warning", f"Ошибка потоковой отправки в Telegram: {e}")
+    
+    async def wait(self):
+        """Дожидается отправки всех запланированных правок"""
+        for future in self.futures:
+            await asyncio.wrap_future(future)
+
+
 async def tg_handle_message(update, context):
     """
     Обработчик входящих сообщений Telegram.
@@ -60,20 +155,33 @@ async def tg_handle_message(update, context):
         }
     }
     
+    # Потоковый режим: текст появляется по мере генерации, промежуточные ответы — сразу
+    writer = None
+    if config_get('telegram.streaming', True):
+        writer = TgStreamWriter(update.message, asyncio.get_running_loop())
+    
     # 5. ПЕРЕДАЁМ В РОУТЕР И ПОЛУЧАЕМ ОТВЕТ (синхронный вызов в отдельном потоке)
+    streamed = False
     try:
         # Запускаем синхронный router в отдельном потоке, чтобы не блокировать event loop
-        result = await asyncio.to_thread(router.route_message, user_data)
+        result = await asyncio.to_thread(router.route_message, user_data, writer)
         response_text = result["message"]
+        streamed = result.get("streamed", False)
     except Exception as e:
         log_system("error", f"Ошибка в роутере: {e}")
         response_text = "Ошибка обработки сообщения. Попробуйте позже."
     
+    if writer is not None:
+        await writer.wait()
+        streamed = streamed and writer.delivered > 0 and not writer.failed
+    
     # 6. Логируем и отправляем ответ
     log_system("info", f"Отправлено ответное сообщение пользователю {user_display_name} (TG ID: {user_id})")
     # log_system("debug", f"{alias_ai}: {response_text}")     # логировать полное сообщение будем в роутере, не тут
     
-    await update.message.reply_text(response_text)
+    if not streamed:
+        for part in _tg_split_text(response_text) or [response_text]:
+            await update.message.reply_text(part)
 
 async def tg_error_handler(update, context):
     """Обработчик ошибок"""
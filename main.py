@@ -21,7 +21,11 @@ from dotenv import load_dotenv
 
 from logger import setup_logging, log_system
 from front_telegram import tg_run_bot
-from database import db_init_tables
+from database import db_init_tables, db_session_init, db_history_init, db_close_pool
+from vector_index import vi_maintain_index
+from ai_provider import ai_close_clients, ai_prompt_cache_stats
+from memory_manager import mm_start_background, mm_stop_background
+from config_loader import config_get
 
 # Добавляем текущую директорию в путь Python
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -37,14 +41,29 @@ def main():
     # ИНИЦИАЛИЗАЦИЯ БАЗЫ ДАННЫХ
     try:
         db_init_tables()
+        db_session_init()
+        db_history_init()
+        vi_maintain_index()
         log_system("info", "База данных инициализирована")
     except Exception as e:
         log_system("error", f"Ошибка инициализации БД: {e}")
         log_system("error", "Kira Copilot не может работать без БД. Завершение.")
         return  # Выходим, не запускаем бота
 
+    # Фоновая обработка памяти (тэгирование, чанкование, векторизация)
+    if config_get('memory.worker.enabled', True):
+        mm_start_background()
+
     # Запускаем Telegram бота
-    tg_run_bot()
+    try:
+        tg_run_bot()
+    finally:
+        mm_stop_background()
+        for usage_key, stats in ai_prompt_cache_stats().items():
+            log_system("info", f"Кэш префикса {usage_key}: {stats['cached_tokens']} из {stats['prompt_tokens']} токенов ({stats['hit_rate']:.0%}), "
+                               f"попаданий {stats['hit_requests']} из {stats['requests']} запросов")
+        ai_close_clients()
+        db_close_pool()
     
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,39 +1,160 @@
 # memory_manager.py
 
-import os
 import time
 import threading
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import re
-from typing import List, Dict, Any
+import unicodedata
+from typing import List, Dict, Any, Optional
+from openai import BadRequestError
 from logger import log_system
-from ai_provider import ai_deepseek_request, ai_openai_request
+from ai_provider import ai_deepseek_request, ai_openai_request, ai_get_client
 from config_loader import config_get
+from token_counter import tc_count_tokens, tc_split_tokens
+from prompt_registry import pr_get_text
+from rate_limiter import rl_get_limiter
+from vector_index import vi_maintain_index
 from database import (
-    db_get_connection,
-    db_get_untagged_messages,
-    db_update_message_tags,
+    db_connection,
+    db_count_untagged_messages,
+    db_get_oldest_untagged_age,
+    db_count_unchunked_messages,
+    db_claim_untagged_messages,
+    db_update_messages_tags,
+    db_schedule_tagging_retries,
+    db_clear_tagging_retries,
+    db_claim_due_tagging_retries,
+    db_release_leases,
+    db_try_lock_chunking,
+    db_count_tagging_retries,
     db_get_recent_messages,
     db_get_unchunked_messages,
-    db_save_chunk,
-    db_get_chunks_without_embeddings,
-    db_update_chunk_embedding
+    db_save_chunks,
+    db_claim_chunks_without_embeddings,
+    db_update_chunk_embeddings,
+    db_get_embedding_settings,
+    db_embedding_model_key,
+    db_get_stored_embeddings,
+    db_save_stored_embeddings,
+    db_get_chunk_embeddings_by_hash,
+    db_add_embedding_dedup_stats,
+    db_embedding_dedup_report
 )
 
 
+# ============ ПРЕДФИЛЬТР ТЭГИРОВАНИЯ ============
+_MM_TRASH_TOPIC = "#_мусор"
+_MM_TAG_ERROR_TOPIC = "#_ошибка_тегирования"    # временная разметка: сообщение ждёт повтора в tagging_retries
+
+_prefilter_stats = {'local': 0, 'ai': 0}
+_prefilter_stats_lock = threading.Lock()
+
+
+def mm_prefilter_stats() -> Dict[str, Any]:
+    """Статистика предфильтра: сколько сообщений размечено локально, сколько ушло в AI, доля пропущенных"""
+    with _prefilter_stats_lock:
+        stats = dict(_prefilter_stats)
+    total = stats['local'] + stats['ai']
+    stats['skip_rate'] = stats['local'] / total if total else 0.0
+    return stats
+
+
+def _mm_normalize_phrase(text: str) -> str:
+    """Нижний регистр, без знаков препинания, символов, эмодзи и модификаторов, пробелы схлопнуты"""
+    kept = ''.join(
+        ' ' if unicodedata.category(ch)[0] in ('P', 'S', 'Z', 'C', 'M') else ch
+        for ch in text.lower()
+    )
+    return ' '.join(kept.split())
+
+
+def mm_prefilter_message(text: str, min_length: int = None, stop_phrases: set = None) -> Optional[Dict[str, Any]]:
+    """
+    Быстрая локальная разметка без AI.
+    Пусто, только эмодзи / знаки препинания, короче min_length букв и цифр или фраза из stop_phrases —
+    вес 1 и #_мусор. Короткие ответы с цифрами ("5", "2й") — не мусор: это ответ на вопрос,
+    они уходят AI. Однобуквенные ("я") при min_length 2 считаются мусором.
+    Возвращает теги или None, если сообщение нужно отдать AI.
+    """
+    if min_length is None:
+        min_length = config_get('memory.prefilter.min_length', 2)
+    if stop_phrases is None:
+        stop_phrases = {_mm_normalize_phrase(p) for p in config_get('memory.prefilter.stop_phrases', [])}
+    
+    normalized = _mm_normalize_phrase(text or '')
+    # Буквы и цифры без пробелов: нет ни одной — значит только эмодзи и пунктуация
+    compact = normalized.replace(' ', '')
+    if not compact or (len(compact) < min_length and not any(ch.isdigit() for ch in compact)):
+        return {'weight': 1, 'topics': [_MM_TRASH_TOPIC]}
+    if normalized in stop_phrases:
+        return {'weight': 1, 'topics': [_MM_TRASH_TOPIC]}
+    return None
+
+
+def _mm_prefilter_split(untagged: list, count_stats: bool = True) -> tuple:
+    """
+    Делит нетэгированные сообщения на размеченные локально и требующие AI.
+    count_stats=False — не учитывать в mm_prefilter_stats (повторное тэгирование: сообщения уже посчитаны).
+    Возвращает (updates, ambiguous): updates — кортежи для db_update_messages_tags.
+    """
+    if not config_get('memory.prefilter.enabled', True):
+        return [], untagged
+    
+    min_length = config_get('memory.prefilter.min_length', 2)
+    stop_phrases = {_mm_normalize_phrase(p) for p in config_get('memory.prefilter.stop_phrases', [])}
+    
+    updates = []
+    ambiguous = []
+    for msg in untagged:
+        tags = mm_prefilter_message(msg['message'], min_length, stop_phrases)
+        if tags is None:
+            ambiguous.append(msg)
+        else:
+            updates.append((msg['id'], tags['weight'], tags['topics']))
+    
+    if not count_stats:
+        return updates, ambiguous
+    
+    with _prefilter_stats_lock:
+        _prefilter_stats['local'] += len(updates)
+        _prefilter_stats['ai'] += len(ambiguous)
+    
+    if updates:
+        stats = mm_prefilter_stats()
+        log_system("info", f"Предфильтр: {len(updates)} из {len(untagged)} сообщений размечены без AI "
+                           f"(всего пропущено {stats['local']} из {stats['local'] + stats['ai']}, {stats['skip_rate']:.0%})")
+    return updates, ambiguous
+
+
+def _mm_save_prefiltered(updates: list, stage: str) -> int:
+    """Пишет локальную разметку предфильтра одним UPDATE и снимает аренду этапа stage"""
+    if not updates:
+        return 0
+    message_ids = [u[0] for u in updates]
+    with db_connection() as conn:
+        db_clear_tagging_retries(conn, message_ids)
+        db_release_leases(conn, stage, message_ids)
+        return db_update_messages_tags(conn, updates)
+
+
 # ============ ТЭГИРОВАНИЕ ============
+def _mm_tag_error(error) -> Dict[str, Any]:
+    """Запасная разметка для сообщения, которое не удалось протэгировать (error — причина для очереди повторов)"""
+    return {'weight': 2, 'topics': [_MM_TAG_ERROR_TOPIC], 'error': str(error)}
+
+
 def mm_ai_message_tagger(messages_batch):
     """Тэгирует пачку сообщений через AI"""
     batch_size = len(messages_batch)
     
-    # 1. Загружаем промпт
-    try:
-        prompt_file = config_get('memory.tagger_prompt_file', 'conf/prompt_tags.md')
-        with open(prompt_file, 'r', encoding='utf-8') as f:
-            prompt_template = f.read().strip()
-    except Exception as e:
-        log_system("error", f"Ошибка загрузки промпта: {e}")
-        return [{'weight': 2, 'topics': ["#_ошибка_тегирования"]} for _ in range(batch_size)]
+    # 1. Загружаем промпт (из реестра — файл перечитывается только при изменении)
+    prompt_file = config_get('memory.tagger_prompt_file', 'conf/prompt_tags.md')
+    prompt_template = pr_get_text(prompt_file)
+    if prompt_template is None:
+        error = f"Промпт тэгирования не загружен: {prompt_file}"
+        log_system("error", error)
+        return [_mm_tag_error(error) for _ in range(batch_size)]
     
     # 2. Подставляем сообщения с авторами
     messages_text = ""
@@ -49,11 +170,18 @@ def mm_ai_message_tagger(messages_batch):
 
     try:
         messages = [{"role": "user", "content": full_prompt}]
+        
+        # Лимит RPM/TPM провайдера тэгирования (общий для всех параллельных пачек).
+        # Ответ — по короткой строке на сообщение, закладываем ~10 токенов на строку.
+        limiter = rl_get_limiter(f"tagger.{provider}",
+                                 rpm=config_get('memory.tagger_rpm'),
+                                 tpm=config_get('memory.tagger_tpm'))
+        limiter.acquire(tc_count_tokens(full_prompt) + batch_size * 10)
     
         if provider == "deepseek":
-            response = ai_deepseek_request(messages, model=model)
+            response = ai_deepseek_request(messages, model=model, usage_label='tagger')
         elif provider == "openai":
-            response = ai_openai_request(messages, model=model)
+            response = ai_openai_request(messages, model=model, usage_label='tagger')
         else:
             raise ValueError(f"Неизвестный провайдер: {provider}")
         
@@ -85,14 +213,14 @@ def mm_ai_message_tagger(messages_batch):
                     raise ValueError(f"Вес вне диапазона: {weight}")
                 
                 if weight == 1:
-                    if "#_мусор" not in tags:
-                        tags = ["#_мусор"]
+                    if _MM_TRASH_TOPIC not in tags:
+                        tags = [_MM_TRASH_TOPIC]
                 
                 results.append({'weight': weight, 'topics': tags})
                 
             except Exception as e:
                 log_system("error", f"Ошибка парсинга строки '{line}': {e}")
-                results.append({'weight': 2, 'topics': ["#_ошибка_тегирования"]})
+                results.append(_mm_tag_error(e))
         
         return results
         
@@ -101,141 +229,639 @@ def mm_ai_message_tagger(messages_batch):
         log_system("debug", f"Промпт: {full_prompt}")
         if hasattr(e, 'response'):
             log_system("warning", f"Статус: {e.response.status_code}, Тело: {e.response.text}")
-        return [{'weight': 2, 'topics': ["#_ошибка_тегирования"]} for _ in range(batch_size)]
+        return [_mm_tag_error(e) for _ in range(batch_size)]
+
+
+def _mm_tag_batch(untagged: list, stage: str = 'tagging') -> int:
+    """
+    Тэгирует пачку сообщений (строки из db_claim_untagged_messages / db_claim_due_tagging_retries)
+    и пишет теги одним UPDATE. Неудачные — в очередь повторов, удачные — из неё.
+    Аренда этапа stage снимается в той же транзакции.
+    """
+    messages_data = []
+    for msg in untagged:
+        messages_data.append({
+            'author': msg['author'],
+            'message': msg['message']
+        })
+    
+    tags_results = mm_ai_message_tagger(messages_data)
+    
+    updates = []
+    failures = []
+    succeeded = []
+    for i, msg in enumerate(untagged):
+        if i < len(tags_results):
+            tags = tags_results[i]
+            updates.append((msg['id'], tags['weight'], tags['topics']))
+            if _MM_TAG_ERROR_TOPIC in tags['topics']:
+                failures.append((msg['id'], tags.get('error', 'ошибка тэгирования')))
+            else:
+                succeeded.append(msg['id'])
+    
+    # Вся пачка пишется одним UPDATE, очередь повторов — в той же транзакции
+    with db_connection() as conn:
+        db_update_messages_tags(conn, updates)
+        if config_get('memory.tagging_retry.enabled', True):
+            db_schedule_tagging_retries(
+                conn, failures,
+                base_delay=config_get('memory.tagging_retry.base_delay_seconds', 60),
+                max_delay=config_get('memory.tagging_retry.max_delay_seconds', 3600)
+            )
+        db_clear_tagging_retries(conn, succeeded)
+        db_release_leases(conn, stage, [msg['id'] for msg in untagged])
+        conn.commit()
+    
+    if failures:
+        log_system("warning", f"Не удалось протэгировать {len(failures)} из {len(untagged)} сообщений, запланирован повтор")
+    return len(updates)
+
+
+def _mm_run_tag_batches(batches: list, concurrency: int, stage: str) -> int:
+    """Тэгирует пачки параллельно (до concurrency одновременно). Возвращает число протэгированных сообщений"""
+    tagged = 0
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(batches)), thread_name_prefix="tagger") as pool:
+        futures = {pool.submit(_mm_tag_batch, batch, stage): batch for batch in batches}
+        for future in as_completed(futures):
+            batch = futures[future]
+            try:
+                tagged += future.result()
+            except Exception as e:
+                log_system("error", f"Ошибка тэгирования пачки (сообщения {batch[0]['id']}-{batch[-1]['id']}): {e}")
+    return tagged
 
 
-def mm_create_tags(batch_size: int = None):
-    """Тэгирует batch_size нетэгированных сообщений через AI"""
+def mm_tag_backlog(max_batches: int = None, batch_size: int = None) -> int:
+    """
+    Разбирает очередь нетэгированных сообщений: до max_batches пачек по batch_size,
+    memory.tagging_concurrency пачек одновременно. Частоту запросов ограничивает
+    лимитер tagger_rpm / tagger_tpm внутри mm_ai_message_tagger.
+    Каждая пачка пишется сразу по готовности. Возвращает число протэгированных сообщений.
+    """
     if batch_size is None:
         batch_size = config_get('memory.tagging_batch_size', 10)
+    if max_batches is None:
+        max_batches = config_get('memory.worker.max_tag_batches_per_tick', 8)
+    concurrency = max(1, config_get('memory.tagging_concurrency', 4))
     
-    conn = db_get_connection()
     try:
-        untagged = db_get_untagged_messages(conn, limit=batch_size)
-        if not untagged:
-            log_system("debug", "Нет сообщений для тэгирования")
-            return
-        
-        log_system("info", f"Начинаем тэгирование {len(untagged)} сообщений")
-        
-        messages_data = []
-        for msg in untagged:
-            messages_data.append({
-                'author': msg['author'],
-                'message': msg['message']
-            })
+        with db_connection() as conn:
+            untagged = db_claim_untagged_messages(conn, limit=batch_size * max_batches)
+    except Exception as e:
+        log_system("error", f"Ошибка чтения очереди тэгирования: {e}")
+        return 0
+    
+    if not untagged:
+        log_system("debug", "Нет сообщений для тэгирования")
+        return 0
+    
+    # Очевидный мусор размечаем локально, в AI уходят только неоднозначные сообщения
+    updates, ambiguous = _mm_prefilter_split(untagged)
+    try:
+        tagged = _mm_save_prefiltered(updates, 'tagging')
+    except Exception as e:
+        log_system("error", f"Ошибка записи разметки предфильтра: {e}")
+        tagged = 0
+    
+    if not ambiguous:
+        return tagged
+    
+    batches = [ambiguous[i:i + batch_size] for i in range(0, len(ambiguous), batch_size)]
+    log_system("info", f"Начинаем тэгирование {len(ambiguous)} сообщений: {len(batches)} пачек, параллельно до {concurrency}")
+    
+    tagged += _mm_run_tag_batches(batches, concurrency, 'tagging')
+    
+    log_system("info", f"Тэгирование завершено для {tagged} из {len(untagged)} сообщений")
+    return tagged
+
+
+def mm_retry_failed_tags(max_batches: int = None, batch_size: int = None) -> int:
+    """
+    Повторно тэгирует сообщения из очереди tagging_retries, чей срок наступил.
+    Пачки собираются отдельно от свежей очереди: сбой провайдера не смешивает повторы с новыми сообщениями.
+    После memory.tagging_retry.max_attempts неудач сообщение остаётся с тегом ошибки.
+    Возвращает число обработанных сообщений.
+    """
+    if not config_get('memory.tagging_retry.enabled', True):
+        return 0
+    if batch_size is None:
+        batch_size = config_get('memory.tagging_batch_size', 10)
+    if max_batches is None:
+        max_batches = config_get('memory.tagging_retry.max_batches_per_tick', 2)
+    max_attempts = config_get('memory.tagging_retry.max_attempts', 5)
+    concurrency = max(1, config_get('memory.tagging_concurrency', 4))
+    
+    try:
+        with db_connection() as conn:
+            due = db_claim_due_tagging_retries(conn, limit=batch_size * max_batches, max_attempts=max_attempts)
+    except Exception as e:
+        log_system("error", f"Ошибка чтения очереди повторного тэгирования: {e}")
+        return 0
+    
+    if not due:
+        return 0
+    
+    updates, ambiguous = _mm_prefilter_split(due, count_stats=False)
+    try:
+        retried = _mm_save_prefiltered(updates, 'tagging_retry')
+    except Exception as e:
+        log_system("error", f"Ошибка записи разметки предфильтра: {e}")
+        retried = 0
+    
+    if ambiguous:
+        batches = [ambiguous[i:i + batch_size] for i in range(0, len(ambiguous), batch_size)]
+        log_system("info", f"Повторное тэгирование {len(ambiguous)} сообщений: {len(batches)} пачек")
+        retried += _mm_run_tag_batches(batches, concurrency, 'tagging_retry')
+    
+    try:
+        stats = db_count_tagging_retries(max_attempts)
+        log_system("info", f"Очередь повторов тэгирования: ждут {stats['waiting']}, к повтору {stats['due']}, попытки исчерпаны {stats['exhausted']}")
+    except Exception as e:
+        log_system("error", f"Ошибка подсчёта очереди повторного тэгирования: {e}")
+    return retried
+
+
+# ============ ЧАНКОВАНИЕ ============
+def _mm_window_chunks(messages: list, chunk_size: int, step: int, max_chunks: int, model: str) -> tuple:
+    """
+    Режим 'messages': окна по chunk_size сообщений с шагом step.
+    Возвращает (chunks, last_message_id); chunks — список (chunk_text, message_ids, token_count).
+    """
+    chunks = []
+    start = 0
+    while start + chunk_size <= len(messages) and len(chunks) < max_chunks:
+        window = messages[start:start + chunk_size]
+        chunk_text = "\n".join(f"{msg['author']}: {msg['message']}" for msg in window).strip()
+        chunks.append((chunk_text, [msg['id'] for msg in window], tc_count_tokens(chunk_text, model)))
+        start += step
+    
+    if not chunks:
+        return [], None
+    
+    # Водяной знак — последнее сообщение перед началом следующего окна:
+    # хвост последнего окна войдёт в следующие чанки как перекрытие
+    return chunks, messages[min(start, len(messages)) - 1]['id']
+
+
+def _mm_token_chunks(messages: list, min_tokens: int, max_tokens: int, max_chunks: int, model: str, more_pending: bool) -> tuple:
+    """
+    Режим 'tokens': сообщения подряд набираются в чанк, пока он не дорастёт до max_tokens.
+    Если следующее сообщение не влезает, а чанк ещё меньше min_tokens, чанк добивается началом
+    этого сообщения до max_tokens, а остаток сообщения начинает следующий чанк.
+    Сообщение длиннее max_tokens режется на куски, каждый кусок — отдельный чанк.
+    Хвост короче min_tokens ждёт новых сообщений (если выборка не упёрлась в лимит).
+    Возвращает (chunks, last_message_id); chunks — список (chunk_text, message_ids, token_count).
+    """
+    chunks = []
+    last_message_id = None
+    lines, ids, tokens_sum = [], [], 0
+    carried = False         # чанк начинается с остатка сообщения, часть которого уже в предыдущем чанке
+    
+    def close_chunk():
+        nonlocal lines, ids, tokens_sum, carried, last_message_id
+        chunk_text = "\n".join(lines)
+        chunks.append((chunk_text, ids, tc_count_tokens(chunk_text, model)))
+        last_message_id = ids[-1]
+        lines, ids, tokens_sum, carried = [], [], 0, False
+    
+    for msg in messages:
+        if len(chunks) >= max_chunks:
+            break
         
-        tags_results = mm_ai_message_tagger(messages_data)
+        prefix = f"{msg['author']}: "
+        text = msg['message']
+        tokens = tc_count_tokens(prefix + text, model)
         
-        for i, msg in enumerate(untagged):
-            if i < len(tags_results):
-                tags = tags_results[i]
-                db_update_message_tags(conn, msg['id'], tags['weight'], tags['topics'])
+        # Текущий чанк не вмещает сообщение
+        if ids and tokens_sum + tokens > max_tokens:
+            room = max_tokens - tokens_sum - tc_count_tokens(prefix, model) - 1
+            if tokens_sum < min_tokens and room > 0:
+                # Чанк меньше min_tokens — добиваем его началом сообщения, остаток идёт дальше
+                pieces = tc_split_tokens(text, room, model)
+                lines.append(prefix + pieces[0])
+                ids.append(msg['id'])
+                close_chunk()
+                text = ''.join(pieces[1:])
+                if not text.strip():
+                    continue
+                tokens = tc_count_tokens(prefix + text, model)
+                carried = True
+            else:
+                close_chunk()
         
-        conn.commit()
-        log_system("info", f"Тэгирование завершено для {len(untagged)} сообщений")
+        if tokens > max_tokens:
+            for piece in tc_split_tokens(text, max_tokens - tc_count_tokens(prefix, model), model):
+                chunk_text = prefix + piece
+                chunks.append((chunk_text, [msg['id']], tc_count_tokens(chunk_text, model)))
+            last_message_id = msg['id']
+            carried = False
+            continue
         
-    except Exception as e:
-        log_system("error", f"Ошибка тэгирования: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
+        lines.append(prefix + text)
+        ids.append(msg['id'])
+        tokens_sum += tokens
+    
+    # Хвост: достаточно большой — в чанк; иначе ждёт следующих сообщений.
+    # Остаток разрезанного сообщения ждать не может: водяной знак уже за этим сообщением.
+    # Если вся выборка мельче min_tokens, но сообщений больше, чем выбрали, — закрываем, чтобы не застрять
+    if ids and (tokens_sum >= min_tokens or carried or (not chunks and more_pending)):
+        close_chunk()
+    
+    return chunks, last_message_id
 
 
-# ============ ЧАНКОВАНИЕ ============
-def mm_create_chunks(chunk_size: int = None, overlap: int = None):
-    """Создаёт один чанк если накопилось достаточно сообщений"""
+def mm_create_chunks(chunk_size: int = None, step: int = None, max_chunks: int = None) -> int:
+    """
+    Нарезает накопившиеся сообщения на чанки, режим — memory.chunking_mode:
+    'messages' — скользящее окно chunk_size сообщений с шагом step
+    (соседние чанки перекрываются на chunk_size - step сообщений);
+    'tokens' — чанки от chunk_min_tokens до chunk_max_tokens токенов.
+    За один вызов создаёт все готовые чанки (не больше max_chunks) и сохраняет их одним INSERT.
+    Возвращает число созданных чанков.
+    """
     
     if chunk_size is None:
         chunk_size = config_get('memory.chunk_size', 10)
-    if overlap is None:
-        overlap = config_get('memory.chunk_step_size', 3)
+    if step is None:
+        step = config_get('memory.chunk_step_size', chunk_size)
+    if max_chunks is None:
+        max_chunks = config_get('memory.worker.max_chunks_per_tick', 20)
+    step = max(1, step)
+    
+    mode = config_get('memory.chunking_mode', 'messages')
+    model = config_get('memory.embedding_model', 'text-embedding-3-small')
     
-    conn = db_get_connection()
     try:
-        # Получаем сообщения для чанка
-        messages = db_get_unchunked_messages(conn, limit=chunk_size)
-        
-        if len(messages) < chunk_size:
-            log_system("info", f"Недостаточно сообщений для чанка: {len(messages)}/{chunk_size}")
-            return
-        
-        log_system("info", f"Создаём чанк из {len(messages)} сообщений")
-        
-        # Формируем текст чанка
-        chunk_text = ""
-        message_ids = []
-        
-        for msg in messages:
-            chunk_text += f"{msg['author']}: {msg['message']}\n"
-            message_ids.append(msg['id'])
-        
-        # Сохраняем чанк
-        db_save_chunk(conn, chunk_text.strip(), message_ids)
-        
-        conn.commit()
-        log_system("info", f"Чанк сохранён (сообщения {message_ids[0]}-{message_ids[-1]})")
+        with db_connection() as conn:
+            # Окна идут подряд от водяного знака — два процесса не должны резать одно и то же
+            if not db_try_lock_chunking(conn):
+                log_system("debug", "Чанкование уже выполняет другой процесс")
+                return 0
+            
+            if mode == 'tokens':
+                min_tokens = config_get('memory.chunk_min_tokens', 150)
+                max_tokens = config_get('memory.chunk_max_tokens', 600)
+                fetch_limit = max_chunks * chunk_size
+                messages = db_get_unchunked_messages(conn, limit=fetch_limit)
+                chunks, last_message_id = _mm_token_chunks(
+                    messages, min_tokens, max_tokens, max_chunks, model,
+                    more_pending=len(messages) >= fetch_limit
+                )
+            else:
+                # Сообщения для max_chunks окон подряд
+                messages = db_get_unchunked_messages(conn, limit=(max_chunks - 1) * step + chunk_size)
+                chunks, last_message_id = _mm_window_chunks(messages, chunk_size, step, max_chunks, model)
+            
+            if not chunks:
+                log_system("info", f"Недостаточно сообщений для чанка: {len(messages)} (режим {mode})")
+                return 0
+            
+            db_save_chunks(conn, chunks, last_message_id)
+            
+            total_tokens = sum(chunk[2] for chunk in chunks)
+            log_system("info", f"Создано чанков: {len(chunks)} (режим {mode}, сообщения {chunks[0][1][0]}-{chunks[-1][1][-1]}, токенов {total_tokens})")
+            return len(chunks)
         
     except Exception as e:
-        log_system("error", f"Ошибка создания чанка: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
+        log_system("error", f"Ошибка создания чанков: {e}")
+        return 0
 
 
 # ============ ВЕКТОРИЗАЦИЯ ============
-def mm_create_vectors(limit: int = None):
-    """Векторизует чанки без эмбеддингов через OpenAI Embeddings API"""
-    if limit is None:
-        limit = config_get('memory.embedding_batch_size', 1)
+def mm_split_embedding_batches(chunks: list, max_items: int, max_tokens: int, model: str) -> list:
+    """Делит чанки на пачки для одного запроса к Embeddings API: не больше max_items штук и max_tokens токенов"""
+    batches = []
+    current = []
+    current_tokens = 0
     
-    conn = db_get_connection()
+    for chunk in chunks:
+        tokens = chunk.get('token_count') or tc_count_tokens(chunk['chunk_text'], model)
+        if current and (len(current) >= max_items or current_tokens + tokens > max_tokens):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(chunk)
+        current_tokens += tokens
+    
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _mm_embedding_input(chunk: dict, model: str) -> str:
+    """
+    Текст чанка для Embeddings API. Чанк длиннее memory.embedding_max_input_tokens
+    (лимит входа модели) обрезается: иначе запрос отклоняется на каждом проходе и чанк не векторизуется никогда.
+    """
+    max_input_tokens = config_get('memory.embedding_max_input_tokens', 8191)
+    text = chunk['chunk_text']
+    tokens = chunk.get('token_count') or tc_count_tokens(text, model)
+    if tokens <= max_input_tokens:
+        return text
+    log_system("warning", f"Чанк {chunk['id']} ({tokens} токенов) длиннее лимита модели, векторизуем первые {max_input_tokens} токенов")
+    return tc_split_tokens(text, max_input_tokens, model)[0]
+
+
+def mm_embed_batch(client, model: str, batch: list, dimensions: int = None, limiter=None) -> list:
+    """
+    Векторизует пачку чанков одним запросом (dimensions — укороченная размерность для text-embedding-3).
+    limiter — необязательный RateLimiter: квота берётся на каждый запрос, включая повторы половинок.
+    Если API отклонил входные данные (BadRequestError), делит пачку пополам, чтобы найти плохой чанк.
+    Остальные ошибки (429, 5xx, таймауты) пробрасываются: дробление только умножило бы неудачные запросы.
+    Возвращает список кортежей (chunk_id, embedding) для успешно векторизованных чанков.
+    """
+    inputs = [_mm_embedding_input(chunk, model) for chunk in batch]
+    if limiter is not None:
+        limiter.acquire(sum(chunk.get('token_count') or tc_count_tokens(text, model) for chunk, text in zip(batch, inputs)))
     try:
-        chunks = db_get_chunks_without_embeddings(conn, limit=limit)
-        if not chunks:
-            log_system("info", "Нет чанков для векторизации")
-            return
+        params = {'dimensions': dimensions} if dimensions else {}
+        response = client.embeddings.create(
+            model=model,
+            input=inputs,
+            encoding_format="float",
+            **params
+        )
+        # Порядок ответа задаётся полем index, а не позицией в списке
+        return [(batch[item.index]['id'], item.embedding) for item in response.data]
+    
+    except BadRequestError as e:
+        if len(batch) == 1:
+            log_system("error", f"Ошибка векторизации чанка {batch[0]['id']}: {e}")
+            return []
         
-        log_system("info", f"Начинаем векторизацию {len(chunks)} чанков")
+        log_system("warning", f"Ошибка векторизации пачки из {len(batch)} чанков, делим пополам: {e}")
+        middle = len(batch) // 2
+        return (mm_embed_batch(client, model, batch[:middle], dimensions, limiter)
+                + mm_embed_batch(client, model, batch[middle:], dimensions, limiter))
+
+
+def mm_embed_chunks(client, model: str, dimensions: int, chunks: list, limiter=None, column: str = 'embedding') -> list:
+    """
+    Векторизует чанки с дедупликацией по content_hash: вектор сначала ищется в embedding_store
+    (ключ — хэш текста и модель), затем у уже векторизованного чанка с тем же текстом (колонка column:
+    'embedding' — действующая модель, 'embedding_new' — идущая перевекторизация). Одинаковые тексты
+    уходят в API один раз, новые векторы сохраняются в хранилище, счётчики — в embedding_dedup_stats.
+    limiter — необязательный RateLimiter на каждый запрос.
+    Возвращает список кортежей (chunk_id, embedding) для успешно векторизованных чанков.
+    """
+    model_key = db_embedding_model_key(model, dimensions)
+    max_items = max(1, config_get('memory.embedding_batch_size', 64))
+    max_tokens = config_get('memory.embedding_batch_max_tokens', 50000)
+    
+    hashes = {chunk['content_hash'] for chunk in chunks if chunk.get('content_hash')}
+    with db_connection() as conn:
+        stored = db_get_stored_embeddings(conn, hashes, model_key)
+        reused = db_get_chunk_embeddings_by_hash(conn, hashes - stored.keys(), column)
+    
+    result = []
+    unique = {}             # ключ текста -> чанк, который уйдёт в API
+    keys = {}               # chunk_id -> ключ текста
+    stats = {'store_hits': 0, 'chunk_reuses': 0, 'batch_duplicates': 0, 'embedded': 0, 'tokens_saved': 0}
+    for chunk in chunks:
+        content_hash = chunk.get('content_hash')
+        if content_hash in stored or content_hash in reused:
+            result.append((chunk['id'], stored.get(content_hash) or reused[content_hash]))
+            stats['store_hits' if content_hash in stored else 'chunk_reuses'] += 1
+            stats['tokens_saved'] += chunk.get('token_count') or 0
+            continue
+        key = content_hash or f"id:{chunk['id']}"
+        keys[chunk['id']] = key
+        if key in unique:
+            stats['batch_duplicates'] += 1
+            stats['tokens_saved'] += chunk.get('token_count') or 0
+        else:
+            unique[key] = chunk
+    
+    fresh = {}              # ключ текста -> новый вектор
+    batches = mm_split_embedding_batches(list(unique.values()), max_items, max_tokens, model)
+    if batches:
+        log_system("info", f"Векторизация {len(chunks)} чанков: из хранилища {stats['store_hits']}, от чанков с тем же текстом {stats['chunk_reuses']}, "
+                           f"в API {len(unique)} уникальных текстов ({len(batches)} запросов)")
+    for batch_idx, batch in enumerate(batches):
+        try:
+            embedded = mm_embed_batch(client, model, batch, dimensions, limiter)
+        except Exception as e:
+            # API недоступен — остальные пачки не отправляем, чанки вернутся в очередь следующего прохода
+            log_system("error", f"Ошибка Embeddings API, векторизация прервана на пачке {batch_idx + 1} из {len(batches)}: {e}")
+            break
+        for chunk_id, embedding in embedded:
+            fresh[keys[chunk_id]] = embedding
+    
+    for chunk_id, key in keys.items():
+        if key in fresh:
+            result.append((chunk_id, fresh[key]))
+    stats['embedded'] = len(fresh)
+    
+    to_store = [(key, embedding) for key, embedding in fresh.items() if not key.startswith("id:")]
+    with db_connection() as conn:
+        if to_store:
+            db_save_stored_embeddings(conn, to_store, model_key)
+        db_add_embedding_dedup_stats(conn, model_key, stats)
+    return result
+
+
+def mm_dedup_report() -> Dict[str, Any]:
+    """
+    Пишет в лог отчёт о дедупликации действующей модели: сэкономленные запросы к API и токены
+    (накопленные воркером и backfill.py) и сколько места занимает embedding_store.
+    """
+    settings = db_get_embedding_settings()
+    report = db_embedding_dedup_report(db_embedding_model_key(settings['model'], settings['dimensions']))
+    
+    log_system("info", f"Дедупликация эмбеддингов: чанков {report['chunks']}, уникальных текстов {report['unique_texts']}; "
+                       f"векторов из хранилища {report['store_hits']}, от чанков с тем же текстом {report['chunk_reuses']}, "
+                       f"повторов в выборке {report['batch_duplicates']}, отправлено в API {report['embedded']} — "
+                       f"сэкономлено {report['saved_rate']:.0%} векторов и {report['tokens_saved']} токенов")
+    log_system("info", f"embedding_store: {report['stored_vectors']} векторов этой модели, всё хранилище занимает {report['store_bytes'] / 1024 / 1024:.1f} МБ "
+                       f"сверх chunks.embedding (у каждого чанка остаётся своя копия вектора)")
+    return report
+
+
+def mm_create_vectors(limit: int = None) -> int:
+    """
+    Векторизует чанки без эмбеддингов через OpenAI Embeddings API.
+    limit — сколько чанков обработать за вызов. Уже известные тексты берутся из embedding_store,
+    остальные уходят в API пачками (memory.embedding_batch_size штук и
+    memory.embedding_batch_max_tokens токенов на запрос), результат пишется одним UPDATE.
+    Возвращает число векторизованных чанков.
+    """
+    if limit is None:
+        limit = config_get('memory.embedding_chunks_per_run', 256)
+    
+    try:
+        # Модель берётся из БД: после перевекторизации (backfill.py) она может отличаться от конфига.
+        # Читаем без кэша; если переключение случится во время запроса к API, запись векторов откатится
+        settings = db_get_embedding_settings(refresh=True)
         
-        api_key = os.getenv('API_KEY_OPENAI')
-        if not api_key:
-            log_system("error", "API_KEY_OPENAI не задан")
-            return
+        with db_connection() as conn:
+            chunks = db_claim_chunks_without_embeddings(conn, limit=limit)
         
-        from openai import OpenAI
-        client = OpenAI(api_key=api_key)
+        if not chunks:
+            log_system("info", "Нет чанков для векторизации")
+            return 0
         
-        for chunk in chunks:
-            try:
-                response = client.embeddings.create(
-                    model="text-embedding-3-small",
-                    input=chunk['chunk_text'],
-                    encoding_format="float"
-                )
-                
-                embedding = response.data[0].embedding
-                db_update_chunk_embedding(conn, chunk['id'], embedding)
-                log_system("info", f"Чанк #{chunk['id']} векторизован")
+        chunk_ids = [chunk['id'] for chunk in chunks]
+        released = False
+        try:
+            client = ai_get_client('openai')
+            
+            # Модель сменилась, пока шёл запрос к API, — перечитываем параметры и векторизуем заново (один раз)
+            for attempt in range(2):
+                model_key = db_embedding_model_key(settings['model'], settings['dimensions'])
+                embeddings = mm_embed_chunks(client, settings['model'], settings['dimensions'], chunks)
                 
-            except Exception as e:
-                log_system("error", f"Ошибка векторизации чанка {chunk['id']}: {e}")
-                continue
+                # Аренда снимается со всей выборки: неудачные чанки вернутся в очередь следующего прохода
+                with db_connection() as conn:
+                    written = db_update_chunk_embeddings(conn, embeddings, model_key)
+                    if written is None and attempt == 0:
+                        settings = db_get_embedding_settings(refresh=True)
+                        log_system("info", f"Повторная векторизация {len(chunks)} чанков моделью {settings['model']}")
+                        continue
+                    db_release_leases(conn, 'embedding', chunk_ids)
+                    conn.commit()
+                    released = True
+                break
+        finally:
+            # При ошибке аренда не должна висеть до истечения срока
+            if not released:
+                try:
+                    with db_connection() as conn:
+                        db_release_leases(conn, 'embedding', chunk_ids)
+                        conn.commit()
+                except Exception as e:
+                    log_system("error", f"Не удалось снять аренду векторизации: {e}")
         
-        conn.commit()
-        log_system("info", f"Векторизация завершена для {len(chunks)} чанков")
+        if written is None:
+            return 0
+        log_system("info", f"Векторизация завершена: {len(embeddings)} из {len(chunks)} чанков")
+        
+        # Корпус вырос — возможно, пора перестроить ANN-индекс
+        if embeddings:
+            vi_maintain_index()
+        return len(embeddings)
         
     except Exception as e:
         log_system("error", f"Ошибка при работе функции mm_create_vectors: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
+        return 0
+
+
+# ============ ФОНОВЫЙ КОНВЕЙЕР ============
+_worker_wake = threading.Event()        # новые сообщения: пора проверить очереди
+_worker_stop = threading.Event()
+_worker_thread = None
+
+
+def mm_notify_new_messages():
+    """Будит фоновую задачу памяти (вызывается роутером после записи сообщений)"""
+    _worker_wake.set()
+
+
+def mm_background_running() -> bool:
+    """Работает ли фоновая задача памяти"""
+    return _worker_thread is not None and _worker_thread.is_alive()
+
+
+def mm_run_pipeline_tick() -> int:
+    """
+    Один проход конвейера памяти: тэгирование -> чанкование -> векторизация.
+    Работа за проход ограничена бюджетом memory.worker.*, остаток доделают следующие проходы.
+    Возвращает объём сделанной работы (сообщения + чанки + векторы), 0 — делать нечего.
+    """
+    tagging_batch_size = config_get('memory.tagging_batch_size', 10)
+    chunk_size = config_get('memory.chunk_size', 10)
+    max_tag_batches = config_get('memory.worker.max_tag_batches_per_tick', 8)
+    max_chunks = config_get('memory.worker.max_chunks_per_tick', 20)
+    max_vectors = config_get('memory.worker.max_vectors_per_tick', 256)
+    
+    untagged_count = db_count_untagged_messages()
+    unchunked_count = db_count_unchunked_messages()
+    log_system("debug", f"Нетэгированных сообщений {untagged_count}, незачанкованных сообщений {unchunked_count}")
+    
+    work_done = 0
+    
+    # 1. Тэгирование — когда накопилась пачка; большая очередь разбирается параллельно.
+    # Хвост меньше пачки тоже тэгируется, если ждёт дольше memory.tagging_flush_seconds:
+    # иначе последние реплики разговора не попадут в чанки и поиск, пока не придут новые
+    if untagged_count >= tagging_batch_size:
+        work_done += mm_tag_backlog(max_batches=max_tag_batches)
+    elif untagged_count:
+        oldest_age = db_get_oldest_untagged_age()
+        if oldest_age is not None and oldest_age >= config_get('memory.tagging_flush_seconds', 600):
+            log_system("info", f"Тэгирование неполной пачки: {untagged_count} сообщений ждут {oldest_age:.0f} сек")
+            work_done += mm_tag_backlog(max_batches=1)
+    
+    # 1a. Повторы неудачного тэгирования — своими пачками, по расписанию backoff
+    if not _worker_stop.is_set():
+        work_done += mm_retry_failed_tags()
+    
+    # 2. Чанкование
+    if unchunked_count >= chunk_size:
+        log_system("info", f"Запуск чанкования для {unchunked_count} сообщений")
+        work_done += mm_create_chunks(max_chunks=max_chunks)
+    
+    # 3. Векторизация
+    if not _worker_stop.is_set():
+        work_done += mm_create_vectors(limit=max_vectors)
+    
+    return work_done
+
+
+def mm_background_worker():
+    """
+    Фоновая задача памяти.
+    Просыпается по mm_notify_new_messages() или раз в memory.worker.poll_interval_seconds.
+    Пока проходы находят работу — запускает следующий сразу, между проходами проверяет остановку.
+    """
+    poll_interval = config_get('memory.worker.poll_interval_seconds', 60)
+    log_system("info", f"Фоновая задача памяти работает (опрос раз в {poll_interval} сек)")
+    
+    while not _worker_stop.is_set():
+        _worker_wake.wait(timeout=poll_interval)
+        _worker_wake.clear()
+        if _worker_stop.is_set():
+            break
+        
+        try:
+            work_done = mm_run_pipeline_tick()
+        except Exception as e:
+            log_system("error", f"Ошибка фоновой задачи памяти: {e}")
+            work_done = 0
+        
+        # Бюджет прохода мог закончиться раньше очереди — продолжаем без ожидания
+        if work_done:
+            _worker_wake.set()
+    
+    log_system("info", "Фоновая задача памяти остановлена")
 
 
 # ============ ЗАПУСК ============
 def mm_start_background():
     """Запускает фоновую задачу в отдельном потоке"""
-    thread = threading.Thread(target=mm_background_worker, daemon=True)
+    global _worker_thread
+    if mm_background_running():
+        return _worker_thread
+    
+    _worker_stop.clear()
+    _worker_wake.set()      # первый проход сразу: разобрать то, что накопилось до старта
+    thread = threading.Thread(target=mm_background_worker, name="memory_worker", daemon=True)
     thread.start()
+    _worker_thread = thread
     log_system("info", "Фоновая задача памяти запущена в отдельном потоке")
-    return thread
\ No newline at end of file
+    return thread
+
+
+def mm_stop_background(timeout: float = None):
+    """Останавливает фоновую задачу: текущий этап доделывается, новые не начинаются"""
+    global _worker_thread
+    if _worker_thread is None:
+        return
+    
+    if timeout is None:
+        timeout = config_get('memory.worker.shutdown_timeout_seconds', 30)
+    
+    _worker_stop.set()
+    _worker_wake.set()
+    _worker_thread.join(timeout=timeout)
+    if _worker_thread.is_alive():
+        log_system("warning", f"Фоновая задача памяти не остановилась за {timeout} сек")
+    _worker_thread = None
@@ -5,17 +5,23 @@
 Обрабатывает поисковые запросы AI (<SEARCH>...</SEARCH>).
 """
 
-import os
 import re
+import sys
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
 from typing import List, Dict, Any, Optional
 
 import psycopg2
 import psycopg2.extras
-from openai import OpenAI
 
 from logger import log_system
 from config_loader import config_get
-from database import db_get_connection
+from database import db_connection, db_get_embedding_settings, db_embedding_model_key
+from ai_provider import ai_get_client
+from vector_index import vi_apply_search_params, VI_INDEX_NAME
 
 
 # ============ УТИЛИТЫ ============
@@ -33,68 +39,214 @@ def ms_extract_search_query(ai_response: str) -> Optional[str]:
     return None
 
 
-def ms_query_embedding(query_text: str) -> Optional[List[float]]:
+# ============ КЭШ ЭМБЕДДИНГОВ ЗАПРОСОВ ============
+# Уровень 1 — LRU в памяти процесса с TTL, уровень 2 — таблица query_embeddings в Postgres.
+# Ключ — модель эмбеддингов + нормализованный текст запроса.
+_query_cache = OrderedDict()        # (model, query) -> (expires_at, embedding)
+_query_cache_lock = threading.Lock()
+_query_cache_stats = {'memory_hits': 0, 'db_hits': 0, 'misses': 0}
+
+
+def ms_normalize_query(query_text: str) -> str:
+    """Нормализует запрос для кэша: нижний регистр, схлопнутые пробелы"""
+    return ' '.join(query_text.lower().split())
+
+
+def ms_query_cache_stats() -> Dict[str, Any]:
+    """Возвращает счётчики кэша эмбеддингов запросов и долю попаданий"""
+    with _query_cache_lock:
+        stats = dict(_query_cache_stats)
+        stats['memory_size'] = len(_query_cache)
+    
+    total = stats['memory_hits'] + stats['db_hits'] + stats['misses']
+    stats['hit_rate'] = (stats['memory_hits'] + stats['db_hits']) / total if total else 0.0
+    return stats
+
+
+def _ms_cache_count(counter: str):
+    with _query_cache_lock:
+        _query_cache_stats[counter] += 1
+
+
+def _ms_cache_memory_get(key: tuple) -> Optional[List[float]]:
+    """Ищет эмбеддинг в LRU; просроченные записи удаляет"""
+    with _query_cache_lock:
+        item = _query_cache.get(key)
+        if item is None:
+            return None
+        expires_at, embedding = item
+        if expires_at < time.monotonic():
+            del _query_cache[key]
+            return None
+        _query_cache.move_to_end(key)
+        return embedding
+
+
+def _ms_cache_memory_put(key: tuple, embedding: List[float]):
+    """Кладёт эмбеддинг в LRU, вытесняя самые старые записи"""
+    max_size = config_get('memory.query_cache.memory_size', 256)
+    ttl = config_get('memory.query_cache.memory_ttl_seconds', 3600)
+    with _query_cache_lock:
+        _query_cache[key] = (time.monotonic() + ttl, embedding)
+        _query_cache.move_to_end(key)
+        while len(_query_cache) > max_size:
+            _query_cache.popitem(last=False)
+
+
+def _ms_cache_db_get(model: str, query: str) -> Optional[List[float]]:
+    """Ищет эмбеддинг в query_embeddings и сразу отмечает попадание"""
+    query_hash = hashlib.sha256(query.encode('utf-8')).hexdigest()
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            UPDATE query_embeddings
+            SET hits = hits + 1, last_used_at = NOW()
+            WHERE query_hash = %s AND model = %s
+            RETURNING embedding::real[]
+        ''', (query_hash, model))
+        row = cur.fetchone()
+    return list(row[0]) if row else None
+
+
+def _ms_cache_db_put(model: str, query: str, embedding: List[float]):
+    """Сохраняет эмбеддинг запроса в query_embeddings"""
+    query_hash = hashlib.sha256(query.encode('utf-8')).hexdigest()
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            INSERT INTO query_embeddings (query_hash, model, query_text, embedding)
+            VALUES (%s, %s, %s, %s::vector)
+            ON CONFLICT (query_hash, model) DO NOTHING
+        ''', (query_hash, model, query, embedding))
+
+
+def ms_query_embedding(query_text: str, refresh_settings: bool = False) -> Optional[List[float]]:
     """
     Векторизует текстовый запрос через OpenAI Embeddings API.
-    Возвращает список из 1536 float или None при ошибке.
+    Сначала ищет вектор в кэше (память процесса, затем query_embeddings).
+    refresh_settings=True — перечитать параметры эмбеддингов из БД в обход кэша.
+    Возвращает вектор (размерность — как у эмбеддингов чанков) или None при ошибке.
     """
-    api_key = os.getenv('API_KEY_OPENAI')
-    if not api_key:
-        log_system("error", "API_KEY_OPENAI не задан")
-        return None
+    # Запрос векторизуется той же моделью, что и чанки (после backfill.py она может отличаться от конфига)
+    try:
+        settings = db_get_embedding_settings(refresh=refresh_settings)
+    except Exception as e:
+        log_system("warning", f"Ошибка чтения параметров эмбеддингов, используется конфиг: {e}")
+        settings = {'model': config_get('memory.embedding_model', 'text-embedding-3-small'), 'dimensions': None}
+    model = settings['model']
+    dimensions = settings['dimensions']
+    use_cache = config_get('memory.query_cache.enabled', True)
+    use_db_cache = use_cache and config_get('memory.query_cache.persistent', True)
+    query = ms_normalize_query(query_text)
+    cache_model = db_embedding_model_key(model, dimensions)
+    key = (cache_model, query)
+    
+    if use_cache:
+        embedding = _ms_cache_memory_get(key)
+        if embedding is not None:
+            _ms_cache_count('memory_hits')
+            log_system("info", f"Эмбеддинг поискового запроса взят из кэша (память): '{query_text}'")
+            return embedding
+    
+    if use_db_cache:
+        try:
+            embedding = _ms_cache_db_get(cache_model, query)
+        except Exception as e:
+            log_system("warning", f"Ошибка чтения кэша эмбеддингов запросов: {e}")
+            embedding = None
+        if embedding is not None:
+            _ms_cache_count('db_hits')
+            _ms_cache_memory_put(key, embedding)
+            log_system("info", f"Эмбеддинг поискового запроса взят из кэша (БД): '{query_text}'")
+            return embedding
     
     try:
-        client = OpenAI(api_key=api_key)
+        client = ai_get_client('openai')
+        params = {'dimensions': dimensions} if dimensions else {}
         response = client.embeddings.create(
-            model="text-embedding-3-small",
+            model=model,
             input=query_text,
-            encoding_format="float"
+            encoding_format="float",
+            **params
         )
         embedding = response.data[0].embedding
         log_system("info", f"Векторизован поисковый запрос: '{query_text}...'")
-        return embedding
     except Exception as e:
         log_system("error", f"Ошибка векторизации поискового запроса: {e}")
         return None
+    
+    if use_cache:
+        _ms_cache_count('misses')
+        _ms_cache_memory_put(key, embedding)
+    if use_db_cache:
+        try:
+            _ms_cache_db_put(cache_model, query, embedding)
+        except Exception as e:
+            log_system("warning", f"Ошибка записи в кэш эмбеддингов запросов: {e}")
+    
+    if use_cache:
+        stats = ms_query_cache_stats()
+        log_system("debug", f"Кэш эмбеддингов запросов: память {stats['memory_hits']}, БД {stats['db_hits']}, промахи {stats['misses']}, попадания {stats['hit_rate']:.0%}")
+    return embedding
+
+
+# Ближайшие соседи сортируются прямо по оператору расстояния (<=>), чтобы работал ANN-индекс.
+# Порог сходства применяется к уже выбранным top-k внутри SQL: результат тот же, что при фильтре
+# в Python, но лишние строки не передаются и индекс не теряется.
+_MS_SEARCH_SQL = '''
+    SELECT id, chunk_text, token_count, 1 - distance AS similarity
+    FROM (
+        SELECT id, chunk_text, token_count, embedding <=> %(query)s::vector AS distance
+        FROM chunks
+        WHERE embedding IS NOT NULL
+        ORDER BY embedding <=> %(query)s::vector
+        LIMIT %(limit)s
+    ) AS nearest
+    WHERE distance <= %(max_distance)s
+    ORDER BY distance
+'''
 
 
-def ms_search_similar_chunks(query_embedding: List[float], limit: int = None) -> List[Dict[str, Any]]:
+def _ms_is_dimension_mismatch(error: Exception) -> bool:
+    """Ошибка pgvector о разной размерности векторов: вектор запроса посчитан не той моделью"""
+    return 'different vector dimensions' in str(error)
+
+
+def ms_search_similar_chunks(query_embedding: List[float], limit: int = None) -> Optional[List[Dict[str, Any]]]:
     """
     Ищет в БД чанки, наиболее близкие к вектору запроса (косинусное сходство).
-    Возвращает список словарей с ключами: chunk_text, similarity (косинусная близость), chunk_id.
-    Фильтрует по порогу сходства.
+    Возвращает список словарей с ключами: chunk_text, similarity (косинусная близость), chunk_id,
+    token_count (None у чанков, нарезанных до появления счётчика).
+    Фильтрует по порогу сходства (в SQL).
+    None — размерность вектора запроса не совпала с чанками (параметры эмбеддингов устарели после backfill.py).
     """
     if limit is None:
         limit = config_get('memory.search_chunks_limit', 3)
     
     similarity_threshold = config_get('memory.search_similarity_threshold', 0.28)
     
-    conn = db_get_connection()
     try:
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        
-        # Косинусное сходство: embedding <=> query_embedding
-        cur.execute('''
-            SELECT 
-                id,
-                chunk_text,
-                1 - (embedding <=> %s::vector) AS similarity
-            FROM chunks
-            WHERE embedding IS NOT NULL
-            ORDER BY similarity DESC
-            LIMIT %s
-        ''', (query_embedding, limit))
+        with db_connection() as conn:
+            cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            vi_apply_search_params(cur)
+            
+            # Косинусное расстояние: embedding <=> query_embedding, сходство = 1 - расстояние
+            cur.execute(_MS_SEARCH_SQL, {
+                'query': query_embedding,
+                'limit': limit,
+                'max_distance': 1 - similarity_threshold
+            })
+            
+            rows = cur.fetchall()
         
-        rows = cur.fetchall()
         results = []
         for row in rows:
-            similarity = float(row['similarity'])
-            if similarity >= similarity_threshold:
-                results.append({
-                    'chunk_id': row['id'],
-                    'chunk_text': row['chunk_text'],
-                    'similarity': similarity
-                })
+            results.append({
+                'chunk_id': row['id'],
+                'chunk_text': row['chunk_text'],
+                'token_count': row['token_count'],
+                'similarity': float(row['similarity'])
+            })
         
         # Логируем статистику с ID
         log_system("info", f"Найдено {len(results)} чанков после фильтрации по порогу {similarity_threshold}")
@@ -119,10 +271,76 @@ def ms_search_similar_chunks(query_embedding: List[float], limit: int = None) ->
         return results
         
     except Exception as e:
+        if _ms_is_dimension_mismatch(e):
+            log_system("warning", f"Размерность вектора запроса не совпала с чанками: {e}")
+            return None
         log_system("error", f"Ошибка поиска чанков: {e}")
         return []
-    finally:
-        conn.close()
+
+
+def ms_explain_search(query_embedding: List[float] = None, limit: int = None, allow_seqscan: bool = True) -> dict:
+    """
+    Возвращает план (EXPLAIN FORMAT JSON) поискового запроса ms_search_similar_chunks.
+    Если вектор не передан — берётся эмбеддинг любого чанка из БД (без обращения к API).
+    По умолчанию — с настройками планировщика как у настоящего поиска.
+    allow_seqscan=False запрещает seq scan: так проверяется только то, что форма запроса
+    в принципе позволяет использовать индекс, даже на маленькой таблице.
+    """
+    if limit is None:
+        limit = config_get('memory.search_chunks_limit', 3)
+    similarity_threshold = config_get('memory.search_similarity_threshold', 0.28)
+    
+    with db_connection() as conn:
+        cur = conn.cursor()
+        
+        if query_embedding is None:
+            cur.execute('SELECT embedding::real[] FROM chunks WHERE embedding IS NOT NULL LIMIT 1')
+            row = cur.fetchone()
+            if not row:
+                raise ValueError("В chunks нет ни одного эмбеддинга для проверки плана")
+            query_embedding = row[0]
+        
+        vi_apply_search_params(cur)
+        if not allow_seqscan:
+            cur.execute("SELECT set_config('enable_seqscan', 'off', true)")
+        
+        cur.execute('EXPLAIN (FORMAT JSON) ' + _MS_SEARCH_SQL, {
+            'query': query_embedding,
+            'limit': limit,
+            'max_distance': 1 - similarity_threshold
+        })
+        return cur.fetchone()[0][0]['Plan']
+
+
+def _ms_plan_index_names(plan: dict) -> List[str]:
+    """Собирает имена индексов из всех узлов плана"""
+    names = []
+    if plan.get('Index Name'):
+        names.append(plan['Index Name'])
+    for child in plan.get('Plans', []):
+        names.extend(_ms_plan_index_names(child))
+    return names
+
+
+def ms_check_search_uses_index(allow_seqscan: bool = True) -> bool:
+    """
+    Проверяет через EXPLAIN, что поиск по памяти идёт по ANN-индексу chunks.embedding
+    при настоящих настройках планировщика (allow_seqscan=False — только форма запроса, см. ms_explain_search).
+    Возвращает False (и пишет план в лог), если индекс не используется.
+    """
+    try:
+        plan = ms_explain_search(allow_seqscan=allow_seqscan)
+    except Exception as e:
+        log_system("error", f"Не удалось получить план поискового запроса: {e}")
+        return False
+    
+    index_names = _ms_plan_index_names(plan)
+    if VI_INDEX_NAME in index_names:
+        log_system("info", f"Поиск по памяти использует индекс {VI_INDEX_NAME}")
+        return True
+    
+    log_system("error", f"Поиск по памяти НЕ использует индекс {VI_INDEX_NAME}. План: {json.dumps(plan, ensure_ascii=False)}")
+    return False
 
 
 def ms_format_search_results(query: str, chunks: List[Dict]) -> str:
@@ -162,6 +380,12 @@ def ms_process_search_request(ai_response: str) -> Optional[str]:
     
     # 3. Ищем чанки
     chunks = ms_search_similar_chunks(query_embedding)
+    if chunks is None:
+        # Чанки перевекторизованы в другом процессе, а параметры в кэше ещё старые — перечитываем и повторяем один раз
+        query_embedding = ms_query_embedding(query, refresh_settings=True)
+        if query_embedding is None:
+            return "Ошибка векторизации запроса. Поиск невозможен."
+        chunks = ms_search_similar_chunks(query_embedding) or []
     
     # 4. Форматируем результаты
     results_text = ms_format_search_results(query, chunks)
@@ -172,7 +396,15 @@ def ms_process_search_request(ai_response: str) -> Optional[str]:
 
 
 # Для тестирования модуля
+# python memory_search.py --check-index — проверка плана поиска (код выхода 1, если индекс не используется)
+# python memory_search.py --check-index --force-index — то же с запретом seq scan (только форма запроса)
 if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv('conf/.env')
+    
+    if '--check-index' in sys.argv:
+        sys.exit(0 if ms_check_search_uses_index(allow_seqscan='--force-index' not in sys.argv) else 1)
+    
     # Тестовый запрос
     test_response = "<SEARCH>любимый офильм пользователя</SEARCH>"
     print(f"Тестовый ответ AI: {test_response}")
@@ -0,0 +1,47 @@
+-- 001: исходная схема (то, что раньше создавал db_init_tables)
+
+-- chatlog
+CREATE TABLE IF NOT EXISTS chatlog (
+    id SERIAL PRIMARY KEY,
+    source VARCHAR(50) NOT NULL,
+    author VARCHAR(50) NOT NULL,
+    message TEXT NOT NULL,
+    tag_weight INTEGER,
+    tag_topics TEXT[],
+    session_id BIGINT,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+-- Индекс для быстрого чанкования (сортировка по времени)
+CREATE INDEX IF NOT EXISTS idx_chatlog_created
+ON chatlog (created_at DESC);
+
+-- chunks
+CREATE TABLE IF NOT EXISTS chunks (
+    id SERIAL PRIMARY KEY,
+    chunk_text TEXT NOT NULL,
+    message_ids INTEGER[] DEFAULT '{}',
+    created_at TIMESTAMP DEFAULT NOW(),
+    embedding vector(1536)
+);
+
+-- Векторный индекс для быстрого поиска (IVFFlat для pgvector)
+CREATE INDEX IF NOT EXISTS idx_chunks_embedding
+ON chunks
+USING ivfflat (embedding vector_cosine_ops);
+
+-- Водяные знаки этапов конвейера памяти (chunking)
+CREATE TABLE IF NOT EXISTS pipeline_state (
+    stage VARCHAR(50) PRIMARY KEY,
+    last_id BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+-- Начальные значения для уже существующих данных (подзапрос выполняется, только пока записи нет)
+INSERT INTO pipeline_state (stage, last_id)
+SELECT 'chunking', (
+    SELECT COALESCE(MAX(message_id), 0)
+    FROM chunks, unnest(message_ids) AS message_id
+)
+WHERE NOT EXISTS (SELECT 1 FROM pipeline_state WHERE stage = 'chunking');
+
@@ -0,0 +1,16 @@
+-- 002: частичные индексы под очереди конвейера памяти
+
+-- Нетэгированные сообщения: db_claim_untagged_messages / db_count_untagged_messages
+CREATE INDEX IF NOT EXISTS idx_chatlog_untagged
+ON chatlog (created_at)
+WHERE tag_weight IS NULL;
+
+-- Чанки без эмбеддингов: db_claim_chunks_without_embeddings
+CREATE INDEX IF NOT EXISTS idx_chunks_without_embedding
+ON chunks (created_at)
+WHERE embedding IS NULL;
+
+-- Поиск сообщений по тегам (tag_topics @> ARRAY[...], '...' = ANY(tag_topics))
+CREATE INDEX IF NOT EXISTS idx_chatlog_tag_topics
+ON chatlog
+USING GIN (tag_topics);
@@ -0,0 +1,14 @@
+-- 003: состояние векторного индекса chunks.embedding
+
+-- Параметры последней сборки индекса (пишет vector_index.py)
+CREATE TABLE IF NOT EXISTS vector_index_state (
+    index_name VARCHAR(100) PRIMARY KEY,
+    method VARCHAR(20) NOT NULL,
+    params JSONB NOT NULL DEFAULT '{}',
+    rows_at_build BIGINT NOT NULL,
+    built_at TIMESTAMP DEFAULT NOW()
+);
+
+-- IVFFlat, построенный на пустой таблице, не имеет осмысленных центроидов.
+-- Удаляем его: vi_maintain_index() при старте построит индекс под фактический объём данных.
+DROP INDEX IF EXISTS idx_chunks_embedding;
@@ -0,0 +1,12 @@
+-- 004: постоянный кэш эмбеддингов поисковых запросов (второй уровень кэша memory_search.py)
+
+CREATE TABLE IF NOT EXISTS query_embeddings (
+    query_hash CHAR(64) NOT NULL,               -- sha256 нормализованного текста запроса
+    model VARCHAR(100) NOT NULL,
+    query_text TEXT NOT NULL,
+    embedding vector NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT NOW(),
+    last_used_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (query_hash, model)
+);
@@ -0,0 +1,5 @@
+-- 005: граница чанкования — первое нетэгированное сообщение после водяного знака (MIN(id) WHERE tag_weight IS NULL)
+
+CREATE INDEX IF NOT EXISTS idx_chatlog_untagged_id
+ON chatlog (id)
+WHERE tag_weight IS NULL;
@@ -0,0 +1,3 @@
+-- 006: размер чанка в токенах (считается при нарезке), чтобы сборка промпта не пересчитывала текст
+
+ALTER TABLE chunks ADD COLUMN IF NOT EXISTS token_count INTEGER;
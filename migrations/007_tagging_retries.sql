@@ -0,0 +1,21 @@
+-- 007: очередь повторного тэгирования сообщений, получивших #_ошибка_тегирования
+
+CREATE TABLE IF NOT EXISTS tagging_retries (
+    message_id INTEGER PRIMARY KEY REFERENCES chatlog (id) ON DELETE CASCADE,
+    attempts INTEGER NOT NULL DEFAULT 0,        -- неудачных попыток тэгирования
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    last_error TEXT,
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+-- Выборка повторов, срок которых наступил: db_claim_due_tagging_retries
+CREATE INDEX IF NOT EXISTS idx_tagging_retries_due
+ON tagging_retries (next_attempt_at);
+
+-- Сообщения, застрявшие с тегом ошибки до появления очереди, — в очередь сразу
+INSERT INTO tagging_retries (message_id, attempts, next_attempt_at, last_error)
+SELECT id, 1, NOW(), 'ошибка тэгирования до появления очереди повторов'
+FROM chatlog
+WHERE '#_ошибка_тегирования' = ANY (tag_topics)
+ON CONFLICT (message_id) DO NOTHING;
@@ -0,0 +1,9 @@
+-- 008: аренда элементов конвейера памяти — несколько процессов не берут одну и ту же работу
+
+CREATE TABLE IF NOT EXISTS pipeline_leases (
+    stage VARCHAR(50) NOT NULL,                 -- 'tagging', 'tagging_retry', 'embedding'
+    item_id INTEGER NOT NULL,                   -- chatlog.id или chunks.id, в зависимости от этапа
+    owner VARCHAR(200) NOT NULL,                -- хост:pid:поток захватившего процесса
+    lease_until TIMESTAMP NOT NULL,             -- после этого момента элемент снова доступен
+    PRIMARY KEY (stage, item_id)
+);
@@ -0,0 +1,17 @@
+-- 009: перевекторизация чанков (backfill.py) — теневая колонка chunks.embedding_new и журнал запусков
+
+CREATE TABLE IF NOT EXISTS embedding_backfill (
+    id SERIAL PRIMARY KEY,
+    model VARCHAR(100) NOT NULL,
+    dimensions INTEGER,                         -- параметр dimensions запроса; NULL — размерность модели по умолчанию
+    vector_size INTEGER NOT NULL,               -- размерность колонки embedding_new
+    status VARCHAR(20) NOT NULL DEFAULT 'running',    -- running / switched / aborted
+    started_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW(),
+    switched_at TIMESTAMP
+);
+
+-- Одновременно идёт не больше одной перевекторизации
+CREATE UNIQUE INDEX IF NOT EXISTS idx_embedding_backfill_running
+ON embedding_backfill (status)
+WHERE status = 'running';
@@ -0,0 +1,21 @@
+-- 010: дедупликация эмбеддингов чанков — хэш текста и хранилище векторов по (хэш, модель)
+
+ALTER TABLE chunks ADD COLUMN IF NOT EXISTS content_hash CHAR(64);
+
+-- Хэш для уже существующих чанков (тот же sha256 от UTF-8 текста, что считает db_save_chunks)
+UPDATE chunks
+SET content_hash = encode(sha256(convert_to(chunk_text, 'UTF8')), 'hex')
+WHERE content_hash IS NULL;
+
+CREATE INDEX IF NOT EXISTS idx_chunks_content_hash
+ON chunks (content_hash);
+
+CREATE TABLE IF NOT EXISTS embedding_store (
+    content_hash CHAR(64) NOT NULL,             -- sha256 текста чанка
+    model VARCHAR(100) NOT NULL,                -- модель, с размерностью если она задана: 'text-embedding-3-large/1024'
+    embedding vector NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,            -- сколько раз вектор переиспользован вместо запроса к API
+    created_at TIMESTAMP DEFAULT NOW(),
+    last_used_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (content_hash, model)
+);
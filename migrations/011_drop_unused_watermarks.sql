@@ -0,0 +1,4 @@
+-- 011: водяные знаки 'tagging' и 'embedding' не читались — очереди выбираются по tag_weight / embedding IS NULL
+-- и арендам. Убираем записи, чтобы параллельные транзакции не блокировали одну горячую строку.
+
+DELETE FROM pipeline_state WHERE stage IN ('tagging', 'embedding');
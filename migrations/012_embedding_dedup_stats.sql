@@ -0,0 +1,11 @@
+-- 012: накопительная статистика дедупликации эмбеддингов по модели (пишут воркер и backfill.py)
+
+CREATE TABLE IF NOT EXISTS embedding_dedup_stats (
+    model VARCHAR(100) PRIMARY KEY,             -- как embedding_store.model: 'text-embedding-3-large/1024'
+    store_hits BIGINT NOT NULL DEFAULT 0,       -- векторов взято из embedding_store
+    chunk_reuses BIGINT NOT NULL DEFAULT 0,     -- векторов взято у уже векторизованного чанка с тем же content_hash
+    batch_duplicates BIGINT NOT NULL DEFAULT 0, -- повторов текста внутри одной выборки
+    embedded BIGINT NOT NULL DEFAULT 0,         -- текстов отправлено в API
+    tokens_saved BIGINT NOT NULL DEFAULT 0,     -- токенов, за которые не пришлось платить
+    updated_at TIMESTAMP DEFAULT NOW()
+);
@@ -0,0 +1,118 @@
+# prompt_registry.py
+
+"""
+Реестр файлов промптов (персона, алгоритм памяти, тэгирование).
+Файл читается и разбирается один раз в готовые системные сообщения с подсчитанными токенами;
+повторно — только когда меняется его mtime. Сборка промпта — копия готового списка.
+"""
+
+import os
+import threading
+from typing import Optional
+
+from logger import log_system
+from token_counter import tc_count_tokens, TC_MESSAGE_OVERHEAD_TOKENS
+
+_prompts = {}
+_prompts_lock = threading.Lock()
+
+
+class PromptEntry:
+    """Разобранный файл промпта: текст, системные сообщения и их токены"""
+
+    def __init__(self, path: str, mtime_ns: int, text: str, split_blocks: bool):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.text = text
+        self.split_blocks = split_blocks
+        self.messages = []
+        self.tokens = 0
+
+        for header, content in _pr_parse_blocks(text, split_blocks):
+            self.messages.append({"role": "system", "content": content})
+            self.tokens += tc_count_tokens(content) + TC_MESSAGE_OVERHEAD_TOKENS
+            log_system("debug", f"Промпт {path} [{len(self.messages)}] '{header or 'без заголовка'}': {content[:200]!r}")
+
+
+# ============ РАЗБОР ============
+def _pr_parse_blocks(text: str, split_blocks: bool) -> list:
+    """
+    Делит текст на блоки по заголовкам '## ' (split_blocks) или оставляет одним блоком.
+    Строки-заголовки из содержимого убираются. Возвращает [(заголовок, содержимое)], пустые блоки пропускаются.
+    """
+    blocks = []
+    current = []
+    for line in text.split('\n'):
+        line = line.strip()
+        if split_blocks and line.startswith('## ') and current:
+            blocks.append(current)
+            current = []
+        # Пустые строки внутри блоков персоны не нужны; цельный промпт сохраняет абзацы
+        if line or not split_blocks:
+            current.append(line)
+    if current:
+        blocks.append(current)
+
+    parsed = []
+    for block in blocks:
+        header = None
+        for line in block:
+            if line.startswith('## '):
+                header = line[3:].strip()
+                break
+        content = '\n'.join(line for line in block if not line.startswith('##')).strip()
+        if content:
+            parsed.append((header, content))
+    return parsed
+
+
+# ============ РЕЕСТР ============
+def pr_get(path: str, split_blocks: bool = True) -> Optional[PromptEntry]:
+    """
+    Возвращает разобранный промпт; файл перечитывается, только если изменился его mtime.
+    None — если файла нет или его не удалось прочитать.
+    """
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        with _prompts_lock:
+            _prompts.pop((path, split_blocks), None)
+        return None
+
+    key = (path, split_blocks)
+    with _prompts_lock:
+        entry = _prompts.get(key)
+    if entry is not None and entry.mtime_ns == mtime_ns:
+        return entry
+
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read().strip()
+    except Exception as e:
+        log_system("error", f"Ошибка загрузки промпта {path}: {e}")
+        return None
+
+    reloaded = entry is not None
+    entry = PromptEntry(path, mtime_ns, text, split_blocks)
+    with _prompts_lock:
+        _prompts[key] = entry
+    log_system("info", f"Промпт {path} {'перечитан' if reloaded else 'загружен'}: "
+                       f"{len(entry.messages)} сообщ., {entry.tokens} токенов")
+    return entry
+
+
+def pr_get_system_messages(path: str, split_blocks: bool = True) -> tuple:
+    """
+    Системные сообщения промпта (новый список, можно дополнять) и их токены.
+    Для отсутствующего файла — ([], 0).
+    """
+    entry = pr_get(path, split_blocks)
+    if entry is None:
+        return [], 0
+    return [dict(message) for message in entry.messages], entry.tokens
+
+
+def pr_get_text(path: str) -> Optional[str]:
+    """Текст промпта целиком (шаблоны вроде prompt_tags.md); None — если файла нет"""
+    entry = pr_get(path, split_blocks=False)
+    return entry.text if entry is not None else None
@@ -0,0 +1,79 @@
+# rate_limiter.py
+
+"""
+Ограничение частоты запросов к AI-провайдерам: запросы в минуту (RPM) и токены в минуту (TPM).
+Два token bucket'а, пополняются равномерно; acquire() блокирует поток, пока в обоих хватает запаса.
+"""
+
+import time
+import threading
+
+from logger import log_system
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class RateLimiter:
+    """Потокобезопасный лимитер RPM + TPM. Лимит 0 или None — без ограничения"""
+
+    def __init__(self, name: str, rpm: int = None, tpm: int = None):
+        self.name = name
+        self.rpm = rpm or 0
+        self.tpm = tpm or 0
+        self.lock = threading.Lock()
+        self.requests_available = float(self.rpm)
+        self.tokens_available = float(self.tpm)
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        if self.rpm:
+            self.requests_available = min(self.rpm, self.requests_available + elapsed * self.rpm / 60)
+        if self.tpm:
+            self.tokens_available = min(self.tpm, self.tokens_available + elapsed * self.tpm / 60)
+
+    def acquire(self, tokens: int = 0):
+        """Ждёт, пока можно отправить один запрос на tokens токенов, и списывает их"""
+        # Запрос больше минутного лимита целиком не поместится — ждём полного bucket'а
+        if self.tpm:
+            tokens = min(tokens, self.tpm)
+
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+
+                wait_requests = 0.0
+                if self.rpm and self.requests_available < 1:
+                    wait_requests = (1 - self.requests_available) * 60 / self.rpm
+                wait_tokens = 0.0
+                if self.tpm and self.tokens_available < tokens:
+                    wait_tokens = (tokens - self.tokens_available) * 60 / self.tpm
+
+                wait = max(wait_requests, wait_tokens)
+                if wait <= 0:
+                    if self.rpm:
+                        self.requests_available -= 1
+                    if self.tpm:
+                        self.tokens_available -= tokens
+                    break
+
+            time.sleep(wait)
+            waited += wait
+
+        if waited >= 1:
+            log_system("debug", f"Лимит {self.name}: ожидание {waited:.1f} сек")
+
+
+def rl_get_limiter(name: str, rpm: int = None, tpm: int = None) -> RateLimiter:
+    """Возвращает общий лимитер по имени; при смене лимитов в конфиге создаёт новый"""
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+        if limiter is None or limiter.rpm != (rpm or 0) or limiter.tpm != (tpm or 0):
+            limiter = RateLimiter(name, rpm, tpm)
+            _limiters[name] = limiter
+            log_system("info", f"Лимит {name}: {rpm or 'без ограничения'} запросов/мин, {tpm or 'без ограничения'} токенов/мин")
+        return limiter
@@ -4,9 +4,9 @@ from datetime import datetime  # <--- ДОБАВИЛ ИМПОРТ
 
 from logger import log_system, log_chat
 from ai_provider import ai_get_response
-from database import db_save_message, db_count_untagged_messages, db_count_unchunked_messages, db_check_new_session  # <--- ДОБАВИЛ db_check_new_session
+from database import db_save_message, db_check_new_session, db_message_batch  # <--- ДОБАВИЛ db_check_new_session
 from config_loader import config_get_aliases, config_get
-from memory_manager import mm_create_tags, mm_create_chunks, mm_create_vectors
+from memory_manager import mm_background_running, mm_notify_new_messages, mm_run_pipeline_tick
 from memory_search import ms_process_search_request
 
 alias_user, alias_ai = config_get_aliases()
@@ -29,11 +29,82 @@ def _extract_first_search_query(ai_response: str):
     return query, response_without_tags
 
 
-def route_message(user_data: dict) -> dict:
+_SEARCH_OPEN_TAG = '<SEARCH>'
+
+
+def _visible_stream_text(raw: str) -> str:
+    """
+    Часть недописанного ответа AI, которую можно показывать пользователю:
+    без законченных тегов <SEARCH>...</SEARCH>, без открытого, но ещё не закрытого тега
+    и без хвоста, похожего на начало '<SEARCH>' ('<', '<SE', ...).
+    """
+    text = re.sub(r'<SEARCH>.*?</SEARCH>', '', raw, flags=re.DOTALL)
+    start = text.find(_SEARCH_OPEN_TAG)
+    if start != -1:
+        return text[:start]
+    for i in range(min(len(_SEARCH_OPEN_TAG) - 1, len(text)), 0, -1):
+        if text.endswith(_SEARCH_OPEN_TAG[:i]):
+            return text[:-i]
+    return text
+
+
+class _StreamRelay:
+    """
+    Передаёт потоковый ответ AI во фронтенд (объект stream с методами delta(text) и complete(text)).
+    delta — новый видимый кусок текущего сообщения, complete — окончательный текст сообщения
+    (без тегов); следующий delta начинает новое сообщение.
+    """
+    
+    def __init__(self, stream):
+        self.stream = stream
+        self.raw = ""
+        self.sent = ""
+        self.delivered = []
+        self.open = False           # начатое потоком сообщение ещё не зафиксировано complete
+    
+    def on_delta(self, piece: str):
+        self.raw += piece
+        visible = _visible_stream_text(self.raw)
+        if len(visible) > len(self.sent) and visible.startswith(self.sent):
+            self.stream.delta(visible[len(self.sent):])
+            self.sent = visible
+            self.open = True
+    
+    def complete(self, text: str):
+        text = (text or "").strip()
+        self.stream.complete(text)
+        if text:
+            self.delivered.append(text)
+        self.raw = ""
+        self.sent = ""
+        self.open = False
+    
+    def finish(self, messages: list) -> bool:
+        """
+        Доводит доставку хода до конца: сообщения из messages (по порядку), которых нет среди
+        доставленных, отправляются через complete — черновик, оборвавшийся на середине,
+        дописывается до полного текста; оставшийся пустой черновик убирается.
+        Возвращает True, если ход доставлен через поток (было что доставлять).
+        """
+        position = 0
+        for text in messages:
+            if text in self.delivered[position:]:
+                position = self.delivered.index(text, position) + 1
+                continue
+            self.complete(text)
+            position = len(self.delivered)
+        if self.open:
+            self.complete("")
+        return bool(messages)
+
+
+def route_message(user_data: dict, stream=None) -> dict:
     """
     Основной маршрутизатор сообщений (синхронный).
     Поддерживает рекурсивные поисковые запросы с ограничением глубины.
     Обрабатывает ответы AI, содержащие текст + тег <SEARCH> в одном сообщении.
+    stream — потоковая выдача во фронтенд (delta(text) / complete(text)): токены ответа AI
+    показываются по мере генерации, каждый промежуточный текст доставляется сразу.
     """
     
     # Извлекаем данные
@@ -57,136 +128,131 @@ def route_message(user_data: dict) -> dict:
     log_system("debug", f"{alias_user}: {message.replace('\n', ' ')}")
     log_chat(source, alias_user, message.replace('\n', ' '))
 
-    # --- ПРОВЕРКА НОВОЙ СЕССИИ (ДОБАВИЛ) ---
-    is_new_session, current_session_id, hours_passed = db_check_new_session()
-    log_system("info", f"Проверка сессии: is_new={is_new_session}, session_id={current_session_id}, hours_passed={hours_passed}")
+    # Все сообщения хода копятся в пакете и пишутся в БД одной транзакцией при выходе из блока.
+    # Пока пакет открыт, история для AI (db_get_recent_messages) уже видит их.
+    with db_message_batch():
+        # --- ПРОВЕРКА НОВОЙ СЕССИИ (ДОБАВИЛ) ---
+        is_new_session, current_session_id, hours_passed = db_check_new_session()
+        log_system("info", f"Проверка сессии: is_new={is_new_session}, session_id={current_session_id}, hours_passed={hours_passed}")
 
-    if is_new_session:
-        # Форматируем день недели по-русски
-        days_ru = ["понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье"]
-        now = datetime.now()
-        weekday_ru = days_ru[now.weekday()]
+        if is_new_session:
+            # Форматируем день недели по-русски
+            days_ru = ["понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье"]
+            now = datetime.now()
+            weekday_ru = days_ru[now.weekday()]
         
-        session_msg = f"Начата новая сессия #{current_session_id}. Текущая дата {now.strftime('%Y-%m-%d %H:%M')}, {weekday_ru}. С окончания прошлой сессии прошло {hours_passed} часов."
+            session_msg = f"Начата новая сессия #{current_session_id}. Текущая дата {now.strftime('%Y-%m-%d %H:%M')}, {weekday_ru}. С окончания прошлой сессии прошло {hours_passed} часов."
         
-        db_save_message(source="system", author="system", 
-                       message=session_msg, tag_weight=0, 
-                       tag_topics=["#_начало_сессии"],
-                       session_id=current_session_id)
-    else:
-        log_system("debug", f"Продолжена текущая сессия #{current_session_id}")
+            db_save_message(source="system", author="system", 
+                           message=session_msg, tag_weight=0, 
+                           tag_topics=["#_начало_сессии"],
+                           session_id=current_session_id)
+        else:
+            log_system("debug", f"Продолжена текущая сессия #{current_session_id}")
 
-    # Сохраняем входящее сообщение в БД (с явным session_id)
-    db_save_message(source=source, author=alias_user, message=message, session_id=current_session_id)
+        # Сохраняем входящее сообщение в БД (с явным session_id, без тегов — их поставит тэгирование памяти)
+        db_save_message(source=source, author=alias_user, message=message, tag_weight=None, session_id=current_session_id)
 
-    # --- РЕКУРСИВНАЯ ОБРАБОТКА С ГЛУБИНОЙ ---
-    max_recursion_depth = config_get('memory.max_recursion_depth', 3)
-    current_depth = 0
-    final_ai_response = ""
-    ai_provider_used = ""
+        # --- РЕКУРСИВНАЯ ОБРАБОТКА С ГЛУБИНОЙ ---
+        max_recursion_depth = config_get('memory.max_recursion_depth', 3)
+        current_depth = 0
+        final_ai_response = ""
+        ai_provider_used = ""
     
-    # Сообщения для отправки пользователю (текст без тегов)
-    messages_to_send = []
+        # Сообщения для отправки пользователю (текст без тегов)
+        messages_to_send = []
+        relay = _StreamRelay(stream) if stream is not None else None
+        on_delta = relay.on_delta if relay else None
     
-    while current_depth <= max_recursion_depth:
-        # Вызов AI (всегда загружает историю из БД через include_history=True)
-        log_system("info", f"Цикл AI, глубина {current_depth}")
-        ai_response, ai_provider = _ai_processor(user_id, message, source, metadata)
-        ai_provider_used = ai_provider
+        while current_depth <= max_recursion_depth:
+            # Вызов AI (всегда загружает историю из БД через include_history=True)
+            log_system("info", f"Цикл AI, глубина {current_depth}")
+            ai_response, ai_provider = _ai_processor(user_id, message, source, metadata, on_delta)
+            ai_provider_used = ai_provider
         
-        # Извлекаем поисковый запрос и очищаем ответ от тегов
-        search_query, clean_response = _extract_first_search_query(ai_response)
+            # Извлекаем поисковый запрос и очищаем ответ от тегов
+            search_query, clean_response = _extract_first_search_query(ai_response)
+            
+            # Потоковый режим: текст этого ответа уже у пользователя — фиксируем его окончательный вид
+            if relay:
+                relay.complete(clean_response)
         
-        # Если есть текст помимо тега - сохраняем его и готовим к отправке
-        if clean_response:
-            log_system("debug", f"Текст ответа AI без тегов: '{clean_response.replace('\n', ' ')}...'")
-            messages_to_send.append(clean_response)  # Запоминаем для отправки пользователю
+            # Если есть текст помимо тега - сохраняем его и готовим к отправке
+            if clean_response:
+                log_system("debug", f"Текст ответа AI без тегов: '{clean_response.replace('\n', ' ')}...'")
+                messages_to_send.append(clean_response)  # Запоминаем для отправки пользователю
             
-            # Сохраняем очищенный ответ в БД (но только если это не дубликат)
-            # Проверяем, не было ли уже такого сообщения в этой сессии
-            if not messages_to_send or clean_response != messages_to_send[-1]:
-                db_save_message(source=ai_provider, author=alias_ai, message=clean_response, session_id=current_session_id)
+                # Сохраняем очищенный ответ в БД (но только если это не дубликат)
+                # Проверяем, не было ли уже такого сообщения в этой сессии
+                if not messages_to_send or clean_response != messages_to_send[-1]:
+                    db_save_message(source=ai_provider, author=alias_ai, message=clean_response, tag_weight=None, session_id=current_session_id)
         
-        # Проверяем, есть ли поисковый запрос
-        if search_query:
-            log_system("info", f"Обнаружен поисковый запрос в ответе AI: '{search_query}'")
+            # Проверяем, есть ли поисковый запрос
+            if search_query:
+                log_system("info", f"Обнаружен поисковый запрос в ответе AI: '{search_query}'")
             
-            # Достигнут лимит глубины?
-            if current_depth >= max_recursion_depth:
-                # Сохраняем запрос AI (несмотря на лимит)
+                # Достигнут лимит глубины?
+                if current_depth >= max_recursion_depth:
+                    # Сохраняем запрос AI (несмотря на лимит)
+                    db_save_message(source=ai_provider, author=alias_ai, 
+                                   message=f"<SEARCH>{search_query}</SEARCH>",
+                                   tag_weight=0, tag_topics=["#_поиск_запрос_лимит"],
+                                   session_id=current_session_id)
+                    # Выходим из цикла, финальный ответ - последний clean_response
+                    final_ai_response = clean_response if clean_response else ai_response
+                    break
+            
+                # Нормальная обработка поискового запроса
+                # 1. Сохраняем поисковый запрос (от AI) в БД
                 db_save_message(source=ai_provider, author=alias_ai, 
                                message=f"<SEARCH>{search_query}</SEARCH>",
-                               tag_weight=0, tag_topics=["#_поиск_запрос_лимит"],
+                               tag_weight=0, tag_topics=["#_поиск_запрос"],
                                session_id=current_session_id)
-                # Выходим из цикла, финальный ответ - последний clean_response
-                final_ai_response = clean_response if clean_response else ai_response
-                break
             
-            # Нормальная обработка поискового запроса
-            # 1. Сохраняем поисковый запрос (от AI) в БД
-            db_save_message(source=ai_provider, author=alias_ai, 
-                           message=f"<SEARCH>{search_query}</SEARCH>",
-                           tag_weight=0, tag_topics=["#_поиск_запрос"],
-                           session_id=current_session_id)
+                # 2. Выполняем поиск
+                search_results = ms_process_search_request(f"<SEARCH>{search_query}</SEARCH>")
             
-            # 2. Выполняем поиск
-            search_results = ms_process_search_request(f"<SEARCH>{search_query}</SEARCH>")
+                # 3. Сохраняем результаты поиска (от системы) в БД
+                if search_results:
+                    db_save_message(source="memory_search", author=alias_user, 
+                                   message=search_results,
+                                   tag_weight=0, tag_topics=["#_поиск_результаты"],
+                                   session_id=current_session_id)
             
-            # 3. Сохраняем результаты поиска (от системы) в БД
-            if search_results:
-                db_save_message(source="memory_search", author=alias_user, 
-                               message=search_results,
-                               tag_weight=0, tag_topics=["#_поиск_результаты"],
-                               session_id=current_session_id)
+                # 4. Увеличиваем глубину и продолжаем цикл
+                current_depth += 1
+                log_system("info", f"Глубина увеличена до {current_depth}")
+                continue  # Цикл начнётся заново, AI загрузит из БД свежие сообщения
             
-            # 4. Увеличиваем глубину и продолжаем цикл
-            current_depth += 1
-            log_system("info", f"Глубина увеличена до {current_depth}")
-            continue  # Цикл начнётся заново, AI загрузит из БД свежие сообщения
-            
-        else:
-            # Поискового запроса нет - это финальный ответ
-            final_ai_response = clean_response if clean_response else ai_response
-            break
-    
-    # Если вышли по лимиту глубины (все ответы содержали поисковые запросы)
-    if not final_ai_response and current_depth > max_recursion_depth:
-        # Делаем финальный вызов AI (он загрузит всю историю из БД, включая последний запрос)
-        log_system("info", "Финальный вызов AI после достижения лимита глубины")
-        final_ai_response, ai_provider_used = _ai_processor(user_id, message, source, metadata)
-        
-        # Очищаем от тега на случай, если в финальном ответе тоже есть тег
-        _, final_ai_response = _extract_first_search_query(final_ai_response)
+            else:
+                # Поискового запроса нет - это финальный ответ
+                final_ai_response = clean_response if clean_response else ai_response
+                break
     
-    # Отправляем пользователю ВСЕ накопленные сообщения (текст без тегов)
-    for msg in messages_to_send:
-        log_system("debug", f"Промежуточное сообщение для отправки: '{msg.replace('\n', ' ')}...'")
-        # Здесь нужно отправить msg в ТГ, если твоя архитектура это поддерживает
-        # Пока просто логируем
+        # Если вышли по лимиту глубины (все ответы содержали поисковые запросы)
+        if not final_ai_response and current_depth > max_recursion_depth:
+            # Делаем финальный вызов AI (он загрузит всю историю из БД, включая последний запрос)
+            log_system("info", "Финальный вызов AI после достижения лимита глубины")
+            final_ai_response, ai_provider_used = _ai_processor(user_id, message, source, metadata, on_delta)
+        
+            # Очищаем от тега на случай, если в финальном ответе тоже есть тег
+            _, final_ai_response = _extract_first_search_query(final_ai_response)
+            if relay:
+                relay.complete(final_ai_response)
+        
+        # Отправляем пользователю ВСЕ накопленные сообщения (текст без тегов)
+        for msg in messages_to_send:
+            log_system("debug", f"Промежуточное сообщение для отправки: '{msg.replace('\n', ' ')}...'")
+            # В потоковом режиме сообщение уже доставлено через stream, иначе уходит в общем ответе
     
-    # Логируем исходящий ответ (финальный)
-    log_system("info", f"Сформировано исходящее сообщение из роутера")
-    log_system("debug", f"{alias_ai}: {final_ai_response.replace('\n', ' ')}")
-    log_chat(ai_provider_used, alias_ai, final_ai_response.replace('\n', ' '))
-
-    # Сохраняем исходящее сообщение в БД (финальный ответ)
-    db_save_message(source=ai_provider_used, author=alias_ai, message=final_ai_response, session_id=current_session_id)
-
-    # Инициализация процессов памяти
-    untagged_count = db_count_untagged_messages()
-    unchunked_count = db_count_unchunked_messages()
-
-    tagging_batch_size = config_get('memory.tagging_batch_size', 10)
-    chunk_size = config_get('memory.chunk_size', 10)
-
-    log_system("info", f"Нетэгированных сообщений {untagged_count}, незачанкованных сообщений {unchunked_count}")
+        # Логируем исходящий ответ (финальный)
+        log_system("info", f"Сформировано исходящее сообщение из роутера")
+        log_system("debug", f"{alias_ai}: {final_ai_response.replace('\n', ' ')}")
+        log_chat(ai_provider_used, alias_ai, final_ai_response.replace('\n', ' '))
 
-    if unchunked_count >= chunk_size:
-        log_system("info", f"Запуск чанкования для {unchunked_count} сообщений")
-        mm_create_chunks()
+        # Сохраняем исходящее сообщение в БД (финальный ответ)
+        db_save_message(source=ai_provider_used, author=alias_ai, message=final_ai_response, tag_weight=None, session_id=current_session_id)
 
-    mm_create_vectors()
-    
     # Формируем ответ для фронтенда
     # Объединяем все промежуточные сообщения и финальный ответ
     all_messages = []
@@ -207,25 +273,38 @@ def route_message(user_data: dict) -> dict:
     else:
         full_response = final_ai_response if final_ai_response else ""
     
+    # Потоковый режим: то, что не дошло через поток (оборвавшийся черновик, финальный ответ
+    # с тегом на пределе глубины), доставляется до запуска процессов памяти
+    streamed = relay.finish(all_messages) if relay else False
+    
+    # Процессы памяти (тэгирование, чанкование, векторизация) — вне пути ответа
+    if mm_background_running():
+        mm_notify_new_messages()
+    else:
+        mm_run_pipeline_tick()
+    
     return {
         "user_id": user_id,
         "source": source,
         "message": full_response,
-        "metadata": metadata
+        "metadata": metadata,
+        "streamed": streamed        # ответ уже доставлен через stream
     }
 
 
-def _ai_processor(user_id, message: str, source: str, metadata: dict) -> tuple:
+def _ai_processor(user_id, message: str, source: str, metadata: dict, on_delta=None) -> tuple:
     """
     AI-процессор. Вызывает реальный AI-провайдер.
     Вся история загружается из БД через ai_get_response.
+    on_delta — колбэк потоковой выдачи (куски текста по мере генерации).
     """
     try:
         response_text, provider = ai_get_response(
             user_message=message,
             provider_name=None,
-            persona=None
+            persona=None,
             # additional_context не передаём - всё уже в БД
+            on_delta=on_delta
         )
         return response_text, provider
     except Exception as e:
@@ -0,0 +1,58 @@
+# tests/test_token_counter.py
+
+import sys
+import os
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import token_counter
+
+
+class _BytesEncoding:
+    """Энкодер-заглушка: токен — каждые size байт UTF-8, так разрезы попадают внутрь многобайтных символов"""
+
+    def __init__(self, size: int):
+        self.size = size
+
+    def encode(self, text, disallowed_special=()):
+        data = text.encode('utf-8')
+        self.vocab = [data[i:i + self.size] for i in range(0, len(data), self.size)]
+        return list(range(len(self.vocab)))
+
+    def decode_single_token_bytes(self, token):
+        return self.vocab[token]
+
+
+@pytest.fixture
+def pair_encoding(monkeypatch):
+    monkeypatch.setattr(token_counter, 'tc_get_encoding', lambda model=None: _BytesEncoding(2))
+
+
+@pytest.fixture
+def triple_encoding(monkeypatch):
+    monkeypatch.setattr(token_counter, 'tc_get_encoding', lambda model=None: _BytesEncoding(3))
+
+
+@pytest.mark.parametrize('text', [
+    "a😀б😃漢字",
+    "xПривет, мир — как дела?",
+    "😀" * 7,
+])
+@pytest.mark.parametrize('max_tokens', [1, 2, 3, 5])
+def test_split_tokens_keeps_multibyte_characters(pair_encoding, text, max_tokens):
+    pieces = token_counter.tc_split_tokens(text, max_tokens)
+
+    assert ''.join(pieces) == text
+    assert all('�' not in piece for piece in pieces)
+
+
+def test_split_tokens_respects_limit_when_characters_fit(triple_encoding):
+    # Кириллица со сдвигом на один байт: каждая вторая граница токенов — внутри символа
+    text = "x" + "Привет" * 10
+    pieces = token_counter.tc_split_tokens(text, 4)
+
+    assert ''.join(pieces) == text
+    assert len(pieces) > 1
+    assert all(len(piece.encode('utf-8')) <= 4 * 3 for piece in pieces)
@@ -0,0 +1,95 @@
+# token_counter.py
+
+"""
+Подсчёт токенов через tiktoken.
+Энкодеры кэшируются по модели. Для моделей, которых tiktoken не знает (deepseek и т.п.),
+используется cl100k_base. Если словарь tiktoken недоступен — грубая оценка по длине текста.
+"""
+
+import threading
+
+import tiktoken
+
+from logger import log_system
+
+_DEFAULT_ENCODING = 'cl100k_base'
+TC_MESSAGE_OVERHEAD_TOKENS = 4          # служебные токены на каждое сообщение чата (роль, разделители)
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+
+def tc_get_encoding(model: str = None):
+    """Возвращает энкодер tiktoken для модели (или None, если tiktoken не смог его загрузить)"""
+    key = model or _DEFAULT_ENCODING
+    with _encodings_lock:
+        if key in _encodings:
+            return _encodings[key]
+        
+        try:
+            try:
+                encoding = tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding(_DEFAULT_ENCODING)
+            except KeyError:
+                encoding = tiktoken.get_encoding(_DEFAULT_ENCODING)
+        except Exception as e:
+            log_system("warning", f"Не удалось загрузить энкодер tiktoken для {key}, используется оценка по длине: {e}")
+            encoding = None
+        
+        _encodings[key] = encoding
+        return encoding
+
+
+def tc_count_tokens(text: str, model: str = None) -> int:
+    """Считает токены в тексте"""
+    if not text:
+        return 0
+    
+    encoding = tc_get_encoding(model)
+    if encoding is None:
+        return len(text) // 3 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def tc_split_tokens(text: str, max_tokens: int, model: str = None) -> list:
+    """
+    Режет текст на куски не длиннее max_tokens токенов (по границам токенов, без потери текста).
+    Разрез сдвигается назад к границе символа UTF-8: токен может содержать часть многобайтного
+    символа (эмодзи, кириллица, CJK), и раздельное декодирование превратило бы его в U+FFFD.
+    Если один символ занимает больше max_tokens токенов, кусок продлевается до конца символа.
+    """
+    if not text:
+        return []
+    max_tokens = max(1, max_tokens)
+    
+    encoding = tc_get_encoding(model)
+    if encoding is None:
+        # Та же оценка, что в tc_count_tokens: ~3 символа на токен
+        step = max_tokens * 3
+        return [text[i:i + step] for i in range(0, len(text), step)]
+    
+    tokens = encoding.encode(text, disallowed_special=())
+    token_bytes = [encoding.decode_single_token_bytes(token) for token in tokens]
+    data = b''.join(token_bytes)
+    offsets = [0]
+    for chunk in token_bytes:
+        offsets.append(offsets[-1] + len(chunk))
+    
+    def on_char_boundary(k: int) -> bool:
+        # Байт-продолжение UTF-8 имеет вид 10xxxxxx
+        pos = offsets[k]
+        return pos >= len(data) or (data[pos] & 0xC0) != 0x80
+    
+    pieces = []
+    start = 0
+    while start < len(tokens):
+        end = min(start + max_tokens, len(tokens))
+        cut = end
+        while cut > start + 1 and not on_char_boundary(cut):
+            cut -= 1
+        if not on_char_boundary(cut):
+            cut = end
+            while not on_char_boundary(cut):
+                cut += 1
+        pieces.append(data[offsets[start]:offsets[cut]].decode('utf-8'))
+        start = cut
+    return pieces
@@ -0,0 +1,270 @@
+# vector_index.py
+
+"""
+Управление ANN-индексом chunks.embedding (pgvector).
+Выбирает HNSW или IVFFlat, подбирает параметры под текущее число векторов,
+перестраивает индекс без блокировки записи (CREATE INDEX CONCURRENTLY)
+и выставляет параметры поиска (ivfflat.probes / hnsw.ef_search) на каждый запрос.
+"""
+
+import json
+import math
+import threading
+from typing import Dict, Any, Optional
+
+from logger import log_system
+from config_loader import config_get
+from database import db_connection, db_get_connection
+
+VI_INDEX_NAME = 'idx_chunks_embedding'
+_VI_BUILD_LOCK_KEY = 4_711_002      # advisory-блокировка: индекс строит только один процесс
+
+_vi_cache = {'loaded': False, 'method': None}
+_vi_cache_lock = threading.Lock()
+
+
+# ============ СОСТОЯНИЕ ИНДЕКСА ============
+def vi_count_vectors(conn) -> int:
+    """Возвращает количество чанков с эмбеддингами"""
+    cur = conn.cursor()
+    cur.execute('SELECT COUNT(*) FROM chunks WHERE embedding IS NOT NULL')
+    return cur.fetchone()[0]
+
+
+def vi_estimate_vectors(conn) -> Optional[int]:
+    """
+    Оценка числа векторов без прохода по таблице: pg_class.reltuples для chunks
+    (обновляется ANALYZE/autovacuum; векторов не больше, чем чанков). None — таблицу ещё не анализировали.
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT reltuples FROM pg_class WHERE oid = 'chunks'::regclass")
+    row = cur.fetchone()
+    if not row or row[0] is None or row[0] < 0:
+        return None
+    return int(row[0])
+
+
+def _vi_count_threshold(info: Optional[Dict[str, Any]]) -> Optional[int]:
+    """
+    Число векторов, с которого от него может зависеть решение о перестройке:
+    min_rows — пока индекса нет, rows_at_build * growth_factor — для IVFFlat.
+    None — не зависит (HNSW уже построен: перестраивается только при смене метода или параметров).
+    """
+    min_rows = config_get('memory.vector_index.min_rows', 1000)
+    if info is None:
+        return min_rows
+    if info['method'] == 'ivfflat':
+        growth_factor = config_get('memory.vector_index.rebuild_growth_factor', 2.0)
+        return max(min_rows, math.ceil(max(1, info['rows_at_build']) * growth_factor))
+    return None
+
+
+def _vi_load_state(conn, exact: bool = False) -> tuple:
+    """
+    Возвращает (info, rows_now, exact); info = None, если индекс ещё не строился или был удалён.
+    Точный COUNT(*) выполняется, только если exact, оценки нет или она дошла до порога перестройки
+    (_vi_count_threshold); иначе rows_now — оценка по pg_class.reltuples.
+    """
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT method, params, rows_at_build, built_at
+        FROM vector_index_state
+        WHERE index_name = %s
+          AND to_regclass(%s) IS NOT NULL
+    ''', (VI_INDEX_NAME, VI_INDEX_NAME))
+    row = cur.fetchone()
+    
+    info = None
+    if row:
+        method, params, rows_at_build, built_at = row
+        info = {
+            'index_name': VI_INDEX_NAME,
+            'method': method,
+            'params': params,
+            'rows_at_build': rows_at_build,
+            'built_at': built_at
+        }
+    
+    rows_now = None if exact else vi_estimate_vectors(conn)
+    if rows_now is None:
+        exact = True
+    else:
+        threshold = _vi_count_threshold(info)
+        exact = threshold is not None and rows_now >= threshold
+    if exact:
+        rows_now = vi_count_vectors(conn)
+    
+    if info is not None:
+        info['rows_now'] = rows_now
+    return info, rows_now, exact
+
+
+def vi_get_index_info() -> Optional[Dict[str, Any]]:
+    """
+    Возвращает параметры текущего индекса:
+    index_name, method, params, rows_at_build, built_at, rows_now.
+    None — если индекс ещё не строился (или был удалён).
+    """
+    with db_connection() as conn:
+        info, _, _ = _vi_load_state(conn, exact=True)
+    return info
+
+
+def vi_choose_params(rows: int) -> tuple:
+    """
+    Подбирает метод и параметры сборки под число векторов.
+    IVFFlat: lists = rows / 1000 до миллиона строк, дальше sqrt(rows) (рекомендация pgvector).
+    Возвращает (method, params).
+    """
+    method = config_get('memory.vector_index.method', 'hnsw')
+
+    if method == 'hnsw':
+        return method, {
+            'm': config_get('memory.vector_index.hnsw_m', 16),
+            'ef_construction': config_get('memory.vector_index.hnsw_ef_construction', 64)
+        }
+    if method == 'ivfflat':
+        lists = rows // 1000 if rows <= 1_000_000 else int(math.sqrt(rows))
+        return method, {'lists': max(1, lists)}
+
+    raise ValueError(f"Неизвестный метод векторного индекса: {method}")
+
+
+def _vi_rebuild_reason(info: Optional[Dict[str, Any]], rows: int) -> Optional[str]:
+    """Возвращает причину перестройки индекса или None, если индекс актуален"""
+    if rows < config_get('memory.vector_index.min_rows', 1000):
+        return None
+
+    if info is None:
+        return "индекса нет"
+
+    method, params = vi_choose_params(rows)
+    if info['method'] != method:
+        return f"сменился метод {info['method']} -> {method}"
+
+    if method == 'hnsw':
+        # HNSW дополняется при вставке и не деградирует — перестраиваем только при смене параметров
+        if info['params'] != params:
+            return f"сменились параметры HNSW {info['params']} -> {params}"
+        return None
+
+    # IVFFlat: центроиды считаются при сборке, после роста корпуса recall падает
+    growth_factor = config_get('memory.vector_index.rebuild_growth_factor', 2.0)
+    if rows >= max(1, info['rows_at_build']) * growth_factor:
+        return f"векторов стало {rows} (при сборке было {info['rows_at_build']})"
+    return None
+
+
+# ============ СБОРКА ============
+def vi_build_index(method: str, params: Dict[str, Any], rows: int):
+    """
+    Строит индекс под новым именем через CREATE INDEX CONCURRENTLY и атомарно подменяет старый.
+    Работает на отдельном (непулированном) подключении: CONCURRENTLY нельзя выполнять внутри транзакции.
+    """
+    if method == 'hnsw':
+        using = f"hnsw (embedding vector_cosine_ops) WITH (m = {int(params['m'])}, ef_construction = {int(params['ef_construction'])})"
+    else:
+        using = f"ivfflat (embedding vector_cosine_ops) WITH (lists = {int(params['lists'])})"
+
+    tmp_name = f"{VI_INDEX_NAME}_new"
+    conn = db_get_connection()
+    try:
+        conn.autocommit = True
+        cur = conn.cursor()
+
+        # Сессионная блокировка снимается при закрытии подключения, в т.ч. после ошибки
+        cur.execute('SELECT pg_try_advisory_lock(%s)', (_VI_BUILD_LOCK_KEY,))
+        if not cur.fetchone()[0]:
+            log_system("info", "Векторный индекс уже перестраивается другим процессом")
+            return False
+        
+        maintenance_work_mem = config_get('memory.vector_index.maintenance_work_mem')
+        if maintenance_work_mem:
+            cur.execute('SELECT set_config(%s, %s, false)', ('maintenance_work_mem', str(maintenance_work_mem)))
+        
+        log_system("info", f"Строим векторный индекс {method} {params} для {rows} векторов")
+        # Остаток от прерванной сборки (невалидный индекс) мешает CREATE INDEX
+        cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {tmp_name}')
+        cur.execute(f'CREATE INDEX CONCURRENTLY {tmp_name} ON chunks USING {using}')
+        
+        # Подмена индекса и запись параметров — одной транзакцией
+        conn.autocommit = False
+        cur.execute(f'DROP INDEX IF EXISTS {VI_INDEX_NAME}')
+        cur.execute(f'ALTER INDEX {tmp_name} RENAME TO {VI_INDEX_NAME}')
+        cur.execute('''
+            INSERT INTO vector_index_state (index_name, method, params, rows_at_build, built_at)
+            VALUES (%s, %s, %s, %s, NOW())
+            ON CONFLICT (index_name) DO UPDATE
+            SET method = EXCLUDED.method,
+                params = EXCLUDED.params,
+                rows_at_build = EXCLUDED.rows_at_build,
+                built_at = EXCLUDED.built_at
+        ''', (VI_INDEX_NAME, method, json.dumps(params), rows))
+        conn.commit()
+    finally:
+        conn.close()
+    
+    with _vi_cache_lock:
+        _vi_cache['loaded'] = True
+        _vi_cache['method'] = method
+
+    log_system("info", f"Векторный индекс {VI_INDEX_NAME} построен ({method}, {params}, {rows} векторов)")
+    return True
+
+
+def vi_maintain_index() -> bool:
+    """
+    Проверяет индекс и перестраивает его, если он отсутствует, устарел или сменился метод.
+    Вызывается на каждом такте векторизации, поэтому число векторов берётся по оценке
+    и пересчитывается точно только у порога перестройки или перед самой сборкой.
+    Возвращает True, если индекс был перестроен.
+    """
+    try:
+        with db_connection() as conn:
+            info, rows, exact = _vi_load_state(conn)
+            if not exact and _vi_rebuild_reason(info, rows) is not None:
+                # Сборка (и lists для IVFFlat) — по точному числу
+                info, rows, exact = _vi_load_state(conn, exact=True)
+
+        with _vi_cache_lock:
+            _vi_cache['loaded'] = True
+            _vi_cache['method'] = info['method'] if info else None
+
+        reason = _vi_rebuild_reason(info, rows)
+        if reason is None:
+            log_system("debug", f"Векторный индекс актуален ({info['method'] if info else 'нет'}, векторов {rows})")
+            return False
+
+        log_system("info", f"Перестройка векторного индекса: {reason}")
+        method, params = vi_choose_params(rows)
+        return vi_build_index(method, params, rows)
+
+    except Exception as e:
+        log_system("error", f"Ошибка обслуживания векторного индекса: {e}")
+        return False
+
+
+# ============ ПАРАМЕТРЫ ПОИСКА ============
+def vi_apply_search_params(cur):
+    """
+    Выставляет параметры поиска для текущей транзакции (SET LOCAL):
+    ivfflat.probes или hnsw.ef_search — в зависимости от метода построенного индекса.
+    """
+    with _vi_cache_lock:
+        loaded = _vi_cache['loaded']
+        method = _vi_cache['method']
+
+    if not loaded:
+        cur.execute('SELECT method FROM vector_index_state WHERE index_name = %s', (VI_INDEX_NAME,))
+        row = cur.fetchone()
+        method = row[0] if row else None
+        with _vi_cache_lock:
+            _vi_cache['loaded'] = True
+            _vi_cache['method'] = method
+
+    if method == 'ivfflat':
+        probes = config_get('memory.vector_index.ivfflat_probes', 10)
+        cur.execute("SELECT set_config('ivfflat.probes', %s, true)", (str(probes),))
+    elif method == 'hnsw':
+        ef_search = config_get('memory.vector_index.hnsw_ef_search', 40)
+        cur.execute("SELECT set_config('hnsw.ef_search', %s, true)", (str(ef_search),))